@@ -6,14 +6,35 @@ const adress = '10.0.2.2:8000';
 
 // Socket response handlers (unchanged)
 function responseMessageDelivered(set, get, data) {
+    // Reconnect receipts arrive grouped per sender as message_ids
+    const ids = new Set(data.message_ids || [data.message_id]);
     set(state => {
         const updatedMessages = (state.messagesList || []).map(msg =>
-            msg.id === data.message_id ? { ...msg, status: data.status } : msg
+            ids.has(msg.id) ? { ...msg, status: data.status } : msg
         );
         return { messagesList: [...updatedMessages] };
     });
 }
 
+function responseMessageSaved(set, get, data) {
+    // Write-behind servers confirm once a sent message is stored
+    set(state => {
+        let messages = state.messagesList || [];
+        if (data.replaces) {
+            // A resend stored as an earlier copy: keep one, under the stored id
+            const stored = messages.some(msg => msg.id === data.message_id);
+            messages = stored
+                ? messages.filter(msg => msg.id !== data.replaces)
+                : messages.map(msg => msg.id === data.replaces ? { ...msg, id: data.message_id } : msg);
+        }
+        return {
+            messagesList: messages.map(msg =>
+                msg.id === data.message_id ? { ...msg, saved: true } : msg
+            )
+        };
+    });
+}
+
 function responseThumbnail(set, get, data) {
     if (data && data.thumbnail) {
         console.log("Received thumbnail URL from backend:", data.thumbnail);
@@ -24,9 +45,14 @@ function responseThumbnail(set, get, data) {
 }
 
 function responseMessageRead(set, get, data) {
+    // Watermark receipts mark every message up to data.up_to in the connection
     set(state => {
+        const watermark = (state.messagesList || []).find(msg => msg.id === data.up_to);
+        const isRead = msg => data.up_to
+            ? (msg.connection === data.connection_id && !!watermark && !utils.isAfter(msg, watermark))
+            : msg.id === data.message_id;
         const updatedMessages = (state.messagesList || []).map(msg =>
-            msg.id === data.message_id ? { ...msg, status: data.status } : msg
+            isRead(msg) ? { ...msg, status: data.status } : msg
         );
         return { messagesList: updatedMessages };
     });
@@ -91,6 +117,67 @@ function responseRequestAccept(set, get, data) {
 function responseFriendList(set, get, data) {
     console.log("Received friend list:", data);
     set({ FriendList: data });
+    // Status updates are only pushed for users this socket says it is showing
+    get().presenceWatch(data.map(item => item.friend && item.friend.username).filter(Boolean));
+}
+
+function responseSync(set, get, data) {
+    const socket = get().socket;
+    set({ syncCursor: data.cursor });
+    if (data.reset) {
+        // Too far behind for a delta: reload as on a first connect
+        if (socket) {
+            ['request.list', 'friend.list'].forEach(source => socket.send(JSON.stringify({ source })));
+        }
+        return;
+    }
+    const currentUser = get().user;
+    const activeConnectionId = get().activeConnectionId;
+    // Messages of the open conversation, added or updated in place
+    const byId = new Map((get().messagesList || []).map(msg => [msg.id, msg]));
+    let elsewhere = false;
+    data.messages.forEach(message => {
+        if (message.connection !== activeConnectionId) {
+            elsewhere = true;
+            return;
+        }
+        byId.set(message.id, {
+            ...byId.get(message.id),
+            ...message,
+            is_me: message.sender && currentUser && message.sender.username === currentUser.username,
+            connection_id: message.connection
+        });
+    });
+    // Newest first by (created, id): with write-behind a higher id is not a newer message
+    const messagesList = [...byId.values()].sort((a, b) => (utils.isAfter(a, b) ? -1 : utils.isAfter(b, a) ? 1 : 0));
+
+    const pending = data.requests.filter(request => !request.accepted);
+    const requestList = [
+        ...(get().requestList || []).filter(request => !data.requests.some(r => r.id === request.id)),
+        ...pending
+    ];
+
+    const profiles = new Map(data.profiles.map(card => [card.username, card]));
+    const FriendList = (get().FriendList || []).map(item =>
+        item.friend && profiles.has(item.friend.username)
+            ? { ...item, friend: profiles.get(item.friend.username) }
+            : item
+    );
+    set({ messagesList, requestList, FriendList });
+
+    // Previews and unread counts of the other conversations, in one read
+    if (!data.more && socket && (elsewhere || data.requests.length > pending.length)) {
+        socket.send(JSON.stringify({ source: 'friend.list' }));
+    }
+}
+
+function responsePresenceWatch(set, get, data) {
+    const FriendList = (get().FriendList || []).map(item =>
+        item.friend && item.friend.username in data
+            ? { ...item, online: data[item.friend.username] }
+            : item
+    );
+    set({ FriendList });
 }
 
 function responseMessageList(set, get, data) {
@@ -116,6 +203,15 @@ function responseMessageSend(set, get, data) {
         is_me: data.sender && currentUser && data.sender.username === currentUser.username,
         connection_id: data.connection
     };
+    if (newMessage.is_me && data.client_id) {
+        const outbox = { ...(get().outbox || {}) };
+        delete outbox[data.client_id];
+        set({ outbox });
+    }
+    // A resent message comes back as the one already stored
+    if ((get().messagesList || []).some(msg => msg.id === data.id)) {
+        return;
+    }
     const messagesList = [newMessage, ...(get().messagesList || [])];
 
     const activeConnectionId = get().activeConnectionId;
@@ -218,7 +314,15 @@ const useGlobalStore = create((set, get) => ({
             };
             
             ws.onmessage = (event) => {
-                const data = JSON.parse(event.data);
+                const frame = JSON.parse(event.data);
+                // ICE candidates arrive batched; hand them to the call screen one at a time
+                const signals = frame.action === 'candidates'
+                    ? frame.candidates.map(candidate => ({ ...frame, action: 'candidate', candidate }))
+                    : [frame];
+                signals.forEach(data => handleVideoSignal(data));
+            };
+
+            const handleVideoSignal = (data) => {
                 console.log('[global.js] WebSocket received:', data);
                 
                 // Global call handling
@@ -242,7 +346,7 @@ const useGlobalStore = create((set, get) => ({
                     } catch (e) {
                         console.warn('[VideoCall] activeCallHandler error', e);
                     }
-                } else if (['offer', 'answer', 'candidate', 'end-call', 'accept'].includes(data.action)) {
+                } else if (['offer', 'answer', 'candidate', 'end-call', 'accept', 'busy'].includes(data.action)) {
                     // Buffer until handler is set by the call screen
                     const buf = get().pendingVideoSignals || [];
                     set({ pendingVideoSignals: [...buf, data] });
@@ -363,6 +467,8 @@ const useGlobalStore = create((set, get) => ({
                     user: {}, 
                     tokens: null, 
                     socket: null,
+                    outbox: {},
+                    syncCursor: null,
                     videoSocket: null,
                     videoSocketReady: false
                 };
@@ -380,21 +486,37 @@ const useGlobalStore = create((set, get) => ({
                 throw new Error("No access token available");
             }
 
-            const socket = new WebSocket(`ws://${adress}/chat/?token=${tokens.access}`);
+            // batch=1: the server may coalesce events into one 'batch' frame
+            const socket = new WebSocket(`ws://${adress}/chat/?token=${tokens.access}&batch=1`);
             
             socket.onopen = () => {
                 utils.log("WebSocket connection established");
                 set({ socket });
-                socket.send(JSON.stringify({
-                    source : 'request.list'
-                })),
-                socket.send(JSON.stringify({
-                    source : 'friend.list'
-                }))
+                const cursor = get().syncCursor;
+                if (cursor === null) {
+                    // First connect: take the cursor before loading, so the next sync misses nothing
+                    socket.send(JSON.stringify({ source: 'sync' }));
+                    socket.send(JSON.stringify({
+                        source : 'request.list'
+                    }));
+                    socket.send(JSON.stringify({
+                        source : 'friend.list'
+                    }));
+                } else {
+                    // Reconnect: only what changed while away
+                    socket.send(JSON.stringify({ source: 'sync', cursor }));
+                }
+                // Messages sent while the connection was failing; the server stores each once
+                Object.values(get().outbox || {}).forEach(frame => socket.send(JSON.stringify(frame)));
             };
 
             socket.onmessage = (event) => {
-                const data = JSON.parse(event.data);
+                const frame = JSON.parse(event.data);
+                const events = frame.source === 'batch' ? frame.data : [frame];
+                events.forEach(data => handleSocketEvent(data));
+            };
+
+            const handleSocketEvent = (data) => {
                 utils.log("WebSocket message received:", data);
                 const responses = {
                     'thumbnail': responseThumbnail,
@@ -409,6 +531,9 @@ const useGlobalStore = create((set, get) => ({
                     "user.status": responseUserStatus,
                     "message.read": responseMessageRead,
                     "message.delivered": responseMessageDelivered,
+                    "message.saved": responseMessageSaved,
+                    "presence.watch": responsePresenceWatch,
+                    "sync": responseSync,
                 };
                 const resp = responses[data.source];
                 if (!resp){
@@ -444,17 +569,29 @@ const useGlobalStore = create((set, get) => ({
         });
     },
 
-    // Thumbnail upload
-    uploadTHumbnail: (file) => {
-        const socket = get().socket;
-        if (socket && socket.readyState === 1 && file && file.base64) {
-            socket.send(JSON.stringify({
-                source: 'thumbnail',
-                base64: file.base64,
-                filename: file.fileName
-            }));
-        } else {
-            console.warn("WebSocket not connected or file invalid");
+    // Thumbnail upload (multipart over HTTP, the server pushes the result on the socket too)
+    uploadTHumbnail: async (file) => {
+        if (!file || !file.uri) {
+            console.warn("Invalid thumbnail file");
+            return;
+        }
+        try {
+            const tokens = await secure.getSecureData('tokens');
+            const form = new FormData();
+            form.append('file', {
+                uri: file.uri,
+                name: file.fileName || 'thumbnail.jpg',
+                type: file.type || 'image/jpeg'
+            });
+            const response = await api.post('thumbnail/', form, {
+                headers: {
+                    'Content-Type': 'multipart/form-data',
+                    Authorization: `Bearer ${tokens?.access}`
+                }
+            });
+            set(state => ({ user: { ...state.user, ...response.data } }));
+        } catch (error) {
+            console.error("Thumbnail upload error:", error);
         }
     },
 
@@ -497,6 +634,17 @@ const useGlobalStore = create((set, get) => ({
     // Friends list
     FriendList : null,
 
+    // Users whose online status this socket wants pushed
+    presenceWatch: (usernames) => {
+        const socket = get().socket;
+        if (socket && socket.readyState === 1) {
+            socket.send(JSON.stringify({
+                source: 'presence.watch',
+                usernames: usernames
+            }));
+        }
+    },
+
     // Messaging
     messagesList: [],
     messagesNext: null,
@@ -517,15 +665,23 @@ const useGlobalStore = create((set, get) => ({
         }
     },
     
+    // Sent messages not yet echoed back, by client_id
+    outbox: {},
+    // Last change seen, see `sync` on the server
+    syncCursor: null,
+
     // Send message
     messageSend: (connectionId, text) => {
+        const frame = {
+            source: 'message.send',
+            connection_id: connectionId,
+            text: text,
+            client_id: Date.now().toString(36) + Math.random().toString(36).slice(2, 10)
+        };
+        set({ outbox: { ...(get().outbox || {}), [frame.client_id]: frame } });
         const socket = get().socket;
         if (socket && socket.readyState === 1) {
-            socket.send(JSON.stringify({
-                source: 'message.send',
-                connection_id: connectionId,
-                text: text
-            }));
+            socket.send(JSON.stringify(frame));
         }
     },
     
@@ -45,8 +45,17 @@ function formatTime(dateString) {
     return date.toLocaleDateString([], { month: 'short', day: 'numeric' });
 }
 
+// Whether message a comes after message b in history order: created, then id.
+// Ids alone are not ordered when the server stores messages write-behind.
+function isAfter(a, b) {
+    const ta = Date.parse(a.created);
+    const tb = Date.parse(b.created);
+    return ta !== tb ? ta > tb : a.id > b.id;
+}
+
 export default {
     log,
     thumbnail,
-    formatTime  // Added formatTime function
+    formatTime,  // Added formatTime function
+    isAfter
 };
\ No newline at end of file
@@ -579,20 +579,26 @@ function MessagesScreen({ navigation, route }) {
 	// Mark messages as read when they become visible in the chat, with debug logging
 	const handleViewableItemsChanged = ({ viewableItems }) => {
 		const socket = useGlobal.getState().socket;
+		// Send one watermark for the newest visible unread message instead of one frame per message
+		let newest = null;
 		viewableItems.forEach(({ item }) => {
 			if (item && item.id && item.status === 'delivered' && !item.is_me) {
-				console.log('[DEBUG] Marking message as read:', item.id, item.text);
-				if (socket && socket.readyState === 1) {
-					socket.send(JSON.stringify({
-						source: 'message.read',
-						message_id: item.id
-					}));
-					console.log('[DEBUG] Sent message.read event for:', item.id);
-				} else {
-					console.log('[DEBUG] Socket not ready for message.read:', item.id);
-				}
+				if (!newest || utils.isAfter(item, newest)) newest = item;
 			}
 		});
+		const upTo = newest && newest.id;
+		if (upTo) {
+			if (socket && socket.readyState === 1) {
+				socket.send(JSON.stringify({
+					source: 'message.read',
+					connection_id: connectionId,
+					up_to: upTo
+				}));
+				console.log('[DEBUG] Sent message.read watermark up to:', upTo);
+			} else {
+				console.log('[DEBUG] Socket not ready for message.read:', upTo);
+			}
+		}
 	};
 
 	const onType = (value) => {
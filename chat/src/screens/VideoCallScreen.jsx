@@ -265,6 +265,10 @@ function VideoCallScreenCore({ route, navigation }) {
             handleCandidate(data.candidate);
         } else if (data.action === 'end-call') {
             endCall();
+        } else if (data.action === 'busy') {
+            // Recipient is already in another call
+            console.log('[VideoCall] Recipient is busy');
+            endCall();
         } else if (data.action === 'accept') {
             console.log('[VideoCall] Remote accepted call');
             setRemoteAccepted(true);
@@ -17,7 +17,7 @@ function ProfileScreen() {
                 <TouchableOpacity
                     style={styles.avatarWrap}
                     onPress={() => {
-                        launchImageLibrary({ includeBase64: true }, (response) => {
+                        launchImageLibrary({ mediaType: 'photo' }, (response) => {
                             if (!response.didCancel && response.assets && response.assets.length > 0) {
                                 const file = response.assets[0];
                                 uploadThumbnail(file);
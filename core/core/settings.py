@@ -85,6 +85,106 @@ CHANNEL_LAYERS = {
     'default': {
         'BACKEND': 'channels.layers.InMemoryChannelLayer',
     },
+    # Call signaling (VideoCallConsumer) gets its own layer so offers, answers
+    # and ICE candidates never queue behind chat traffic
+    'signaling': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+    },
+}
+
+# Presence (see main/presence.py). With more than one ASGI worker switch to
+# 'main.presence.SQLitePresenceBackend' with 'OPTIONS': {'path': BASE_DIR / 'presence.sqlite3'}
+PRESENCE = {
+    'BACKEND': 'main.presence.InMemoryPresenceBackend',
+    'TTL': 90,
+    # seconds a user may be gone before friends are told they went offline
+    'GRACE': 5,
+}
+
+# Video call sessions (see main/calls.py): seconds a call may ring, and may
+# stay active without any signaling, before it is dropped
+CALLS = {
+    'RINGING_TTL': 60,
+    'ACTIVE_TTL': 4 * 60 * 60,
+    # ICE candidates to the same recipient within this many seconds go out as one frame
+    'CANDIDATE_WINDOW': 0.01,
+}
+
+# Inbound traffic capture for replay (see main/capture.py and the replay_traffic
+# command). SAMPLE is the fraction of users captured; without a SALT every
+# process picks a random one, so logs of different workers cannot be joined.
+CAPTURE = {
+    'ENABLED': False,
+    'PATH': BASE_DIR / 'capture.jsonl',
+    'SAMPLE': 1.0,
+}
+
+# Per-process metrics served at /metrics in the Prometheus format (see
+# main/metrics.py). Set TOKEN to require "Authorization: Bearer <TOKEN>".
+METRICS = {
+    'ENABLED': True,
+    'TOKEN': None,
+}
+
+# Per-worker cache of who is connected to whom (see main/graph.py). SIZE
+# counts users and connections together.
+GRAPH = {
+    'SIZE': 50000,
+    'TTL': 300,
+}
+
+# Per-worker cache of the user cards embedded in message, request and friend
+# payloads (see main/payloads.py)
+PROFILE_CARDS = {
+    'SIZE': 10000,
+    'TTL': 300,
+}
+
+# Per-worker window of recent message.send client ids, so a resent message
+# is answered without a query (see main/dedup.py)
+RECENT_SENDS = {
+    'SIZE': 20000,
+    'TTL': 600,
+}
+
+# Reconnect sync from the change log (see main/sync.py): CHUNK changes per
+# frame; `manage.py prune_changes` keeps the newest RETAIN
+SYNC = {
+    'CHUNK': 500,
+    'RETAIN': 1000000,
+}
+
+# Write-behind message persistence (see main/writebehind.py): messages are
+# fanned out at once and stored by group commits every WINDOW seconds or
+# MAX_ROWS rows. A crash loses at most one window. SQLite only.
+WRITE_BEHIND = {
+    'ENABLED': False,
+    'WINDOW': 0.005,
+    'MAX_ROWS': 200,
+    'MAX_PENDING': 5000,
+    'ID_BLOCK': 1000,
+}
+
+# JSON lines on stderr, written from a background thread (see main/logs.py).
+# Levels are per module; per-frame logs go to 'main.frames' and are rate
+# limited, set it to DEBUG to see a sample of inbound frames.
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {'()': 'main.logs.JsonFormatter'},
+    },
+    'filters': {
+        'sample': {'()': 'main.logs.RateLimitFilter', 'rate': 10, 'burst': 20},
+    },
+    'handlers': {
+        'async': {'()': 'main.logs.AsyncHandler', 'formatter': 'json', 'capacity': 10000},
+    },
+    'loggers': {
+        'main': {'handlers': ['async'], 'level': 'INFO', 'propagate': False},
+        'main.consumers': {'level': 'INFO'},
+        'main.frames': {'level': 'WARNING', 'filters': ['sample']},
+    },
 }
 
 WSGI_APPLICATION = 'core.wsgi.application'
@@ -97,9 +197,63 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # DB executor threads write concurrently, wait for the lock instead of failing.
+        # IMMEDIATE takes the write lock at BEGIN so read-then-write transactions cannot deadlock.
+        'OPTIONS': {'timeout': 20, 'transaction_mode': 'IMMEDIATE'},
+        # Executor threads are long lived, keep their connections open between calls
+        'CONN_MAX_AGE': None,
+        'CONN_HEALTH_CHECKS': True,
+        # Tests drive the consumers from several executor threads at once; the default
+        # shared-cache memory database fails those with "table is locked"
+        'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
     }
 }
 
+# Thread pools for consumer DB work (see main/executor.py). Slow reads get
+# their own pool so they cannot starve message sends.
+DB_EXECUTORS = {
+    'default': {'WORKERS': 8},
+    'heavy': {'WORKERS': 2},
+    # SQLite has a single writer; queueing writes here beats threads spinning on the lock
+    'writes': {'WORKERS': 1},
+    # Recipient lookup when a call starts, kept clear of chat load
+    'signaling': {'WORKERS': 1},
+    # SQLitePresenceBackend, which serializes its calls anyway
+    'presence': {'WORKERS': 1},
+}
+DB_EXECUTOR_ROUTES = {
+    'search': 'heavy',
+    'message.list': 'heavy',
+    'sync': 'heavy',
+    'message.send': 'writes',
+    'message.read': 'writes',
+    'call': 'signaling',
+    'presence': 'presence',
+}
+
+# Outbound event batching for sockets that opt in with ?batch=1 (see main/batching.py).
+# Call signaling runs on /ws/video/, which never batches.
+OUTBOUND_BATCH = {
+    'WINDOW': 0.01,
+    'MAX_EVENTS': 50,
+    'BYPASS': [],
+}
+
+# Multi-recipient sends (see main/fanout.py): max group_send calls in flight
+# at once on layers without a native group_send_many
+FANOUT = {
+    'CONCURRENCY': 100,
+}
+
+# User search (see main/search.py): per-socket debounce in seconds and the
+# shared prefix result cache
+SEARCH = {
+    'DEBOUNCE': 0.15,
+    'CACHE_SIZE': 1024,
+    'CACHE_TTL': 60,
+    'CACHE_ROWS': 200,
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -139,6 +293,16 @@ STATIC_URL = 'static/'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Profile thumbnails (see main/thumbnails.py): square variants rendered per upload
+THUMBNAILS = {
+    'SIZES': [64, 128, 512],
+    'FORMAT': 'WEBP',
+    'LIST_SIZE': 128,
+    'PROFILE_SIZE': 512,
+    'WORKERS': 2,
+    'MAX_UPLOAD': 10 * 1024 * 1024,
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
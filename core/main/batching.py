@@ -0,0 +1,85 @@
+"""
+Outbound event batching for ChatConsumer.
+
+Events that reach a socket within OUTBOUND_BATCH['WINDOW'] seconds of each
+other (up to MAX_EVENTS) go out as one frame:
+
+    {"source": "batch", "data": [{"source": ..., "data": ...}, ...]}
+
+A lone event is sent as is. Sources listed in BYPASS flush whatever is
+pending and go out immediately. Clients opt in with `batch=1` in the socket
+query string; everyone else gets one frame per event as before.
+"""
+import asyncio
+from urllib.parse import parse_qs
+
+from django.conf import settings
+
+from . import metrics
+
+_config = getattr(settings, 'OUTBOUND_BATCH', {})
+WINDOW = _config.get('WINDOW', 0.01)
+MAX_EVENTS = _config.get('MAX_EVENTS', 50)
+BYPASS = set(_config.get('BYPASS', ()))
+
+# Upper bounds of the batch size histogram buckets, +Inf is implied
+BUCKETS = (1, 2, 5, 10, 20, 50)
+
+batch_sizes = metrics.Histogram(
+    'ws_outbound_batch_size', 'Events per outbound frame of batching sockets', buckets=BUCKETS
+)
+
+
+def wants_batching(scope):
+    query = parse_qs(scope.get('query_string', b'').decode())
+    return query.get('batch', ['0'])[0] in ('1', 'true')
+
+
+class OutboundBatchMixin:
+    """
+    Use with CodecMixin: call `self.start_batching()` after accepting and
+    route outgoing events through `await self.queue_event(event)`.
+    """
+    batching = False
+
+    def start_batching(self):
+        self.batching = wants_batching(self.scope)
+        self._outbox = []
+        self._flush_task = None
+
+    async def queue_event(self, event):
+        if not self.batching or event.get('source') in BYPASS:
+            await self.flush_events()
+            await self.send_event(event)
+            return
+        self._outbox.append(event)
+        if len(self._outbox) >= MAX_EVENTS:
+            await self.flush_events()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(WINDOW)
+        self._flush_task = None
+        await self.flush_events()
+
+    async def flush_events(self):
+        if not self.batching or not self._outbox:
+            return
+        if self._flush_task is not None and self._flush_task is not asyncio.current_task():
+            self._flush_task.cancel()
+            self._flush_task = None
+        events, self._outbox = self._outbox, []
+        if metrics.enabled:
+            batch_sizes.observe(len(events))
+        if len(events) == 1:
+            await self.send_event(events[0])
+        else:
+            await self.send_event({'source': 'batch', 'data': events})
+
+    def stop_batching(self):
+        task = getattr(self, '_flush_task', None)
+        if task is not None:
+            task.cancel()
+        self._flush_task = None
+        self._outbox = []
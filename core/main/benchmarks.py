@@ -0,0 +1,64 @@
+"""
+Helpers shared by the bench_* management commands.
+
+Benchmarks run against a throwaway test database so they never touch the
+configured one.
+"""
+import contextlib
+import os
+import tempfile
+import time
+
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+
+@contextlib.contextmanager
+def test_database(verbosity=0, on_disk=False):
+    """
+    Create a test database for the duration of the block, by default the
+    DATABASES TEST NAME (test_db.sqlite3 next to manage.py). Pass
+    on_disk=True for benchmarks that write from several threads at once: they
+    get their own file in a temporary directory, in WAL mode.
+    """
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    old_test_name = connection.settings_dict['TEST'].get('NAME')
+    tmpdir = None
+    if on_disk and connection.vendor == 'sqlite':
+        tmpdir = tempfile.mkdtemp(prefix='bench-')
+        connection.settings_dict['TEST']['NAME'] = os.path.join(tmpdir, 'bench.sqlite3')
+    connection.creation.create_test_db(verbosity=verbosity, autoclobber=True)
+    if tmpdir:
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=verbosity)
+        connection.settings_dict['TEST']['NAME'] = old_test_name
+        teardown_test_environment()
+
+
+@contextlib.contextmanager
+def timer(results, key):
+    start = time.perf_counter()
+    yield
+    results.setdefault(key, []).append(time.perf_counter() - start)
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(samples):
+    return {
+        'count': len(samples),
+        'p50_ms': percentile(samples, 50) * 1000,
+        'p95_ms': percentile(samples, 95) * 1000,
+        'p99_ms': percentile(samples, 99) * 1000,
+    }
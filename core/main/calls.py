@@ -0,0 +1,144 @@
+"""
+Call sessions for VideoCallConsumer.
+
+A session is created by the `call` action, after the recipient has been
+looked up once, and every later signal between the two users (offer, answer,
+candidate, accept, decline, end-call) is checked against it in memory:
+
+    ringing --accept/offer/answer--> active --end-call--> ended
+    ringing --decline/end-call--> ended
+
+A user already in a ringing or active call with someone else is busy: the
+caller gets a `busy` frame, from its own worker or from the recipient's.
+Sessions expire after CALLS['RINGING_TTL'] seconds of ringing and
+CALLS['ACTIVE_TTL'] seconds without signaling once active. The registry is
+per process; the worker serving the recipient registers the same session
+when the call signal reaches it, so both ends can validate locally.
+"""
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+_config = getattr(settings, 'CALLS', {})
+RINGING_TTL = _config.get('RINGING_TTL', 60)
+ACTIVE_TTL = _config.get('ACTIVE_TTL', 4 * 60 * 60)
+CANDIDATE_WINDOW = _config.get('CANDIDATE_WINDOW', 0.01)
+
+RINGING = 'ringing'
+ACTIVE = 'active'
+ENDED = 'ended'
+
+# action -> state it moves the session to
+TRANSITIONS = {
+    'accept': ACTIVE,
+    'offer': ACTIVE,
+    'answer': ACTIVE,
+    'decline': ENDED,
+    'end-call': ENDED,
+}
+
+
+class Busy(Exception):
+    pass
+
+
+class CallSession:
+    def __init__(self, caller, recipient, session_id=None):
+        self.id = session_id or uuid.uuid4().hex
+        self.caller = caller
+        self.recipient = recipient
+        self.state = RINGING
+        self.started = time.monotonic()
+        self.touch()
+
+    def touch(self):
+        ttl = RINGING_TTL if self.state == RINGING else ACTIVE_TTL
+        self.expires = time.monotonic() + ttl
+
+    def expired(self, now):
+        return self.state == ENDED or self.expires < now
+
+    def peer(self, username):
+        return self.recipient if username == self.caller else self.caller
+
+
+class CallRegistry:
+    def __init__(self):
+        # username -> session, both participants point at the same session
+        self._by_user = {}
+        self._lock = threading.Lock()
+
+    def _current(self, username, now):
+        session = self._by_user.get(username)
+        if session is not None and session.expired(now):
+            self._drop(session)
+            return None
+        return session
+
+    def _drop(self, session):
+        for username in (session.caller, session.recipient):
+            if self._by_user.get(username) is session:
+                del self._by_user[username]
+
+    def start(self, caller, recipient, session_id=None):
+        """
+        Open a ringing session. Raises Busy if either user is in a call with
+        someone else; calling the same person again replaces the old session.
+        """
+        now = time.monotonic()
+        with self._lock:
+            for username, other in ((caller, recipient), (recipient, caller)):
+                current = self._current(username, now)
+                if current is None:
+                    continue
+                if session_id is not None and current.id == session_id:
+                    return current
+                if current.peer(username) != other:
+                    raise Busy(username)
+                self._drop(current)
+            session = CallSession(caller, recipient, session_id)
+            self._by_user[caller] = session
+            self._by_user[recipient] = session
+            return session
+
+    def find(self, username, peer):
+        # The live session between the two users, if any
+        with self._lock:
+            session = self._current(username, time.monotonic())
+            if session is None or session.peer(username) != peer:
+                return None
+            return session
+
+    def apply(self, username, peer, action):
+        """
+        Record a signal from `username` to `peer`. Returns the session, or
+        None if the two are not in a call.
+        """
+        with self._lock:
+            session = self._current(username, time.monotonic())
+            if session is None or session.peer(username) != peer:
+                return None
+            state = TRANSITIONS.get(action)
+            if state == ENDED:
+                session.state = ENDED
+                self._drop(session)
+            elif state is not None:
+                session.state = state
+                session.touch()
+            elif session.state == ACTIVE:
+                session.touch()
+            return session
+
+    def active_count(self):
+        now = time.monotonic()
+        with self._lock:
+            return len({id(s) for s in self._by_user.values() if not s.expired(now)})
+
+    def clear(self):
+        with self._lock:
+            self._by_user.clear()
+
+
+calls = CallRegistry()
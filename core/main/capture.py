@@ -0,0 +1,151 @@
+"""
+Traffic capture for ChatConsumer and VideoCallConsumer.
+
+With CAPTURE['ENABLED'] set, every inbound frame is appended to a JSON lines
+log along with socket open/close events, for replay by the replay_traffic
+command (see main/replay.py):
+
+    {"v": 1, "start": 1760000000.0}
+    {"t": 0.412, "s": 1, "e": "open", "k": "chat", "u": "u3fa9c2d1e0"}
+    {"t": 1.073, "s": 1, "f": {"source": "message.send", "connection_id": "c91d0...", "text": 12}}
+    {"t": 9.950, "s": 1, "e": "close"}
+
+`t` is seconds since capture start and `s` numbers the sockets. Users and
+connection ids are replaced with salted hashes, message text, search queries
+and SDP/ICE payloads with their lengths, and unknown string fields are
+dropped, so the log holds the shape and timing of the traffic, not its
+content. CAPTURE['SAMPLE'] captures that fraction of users. Give each
+worker its own PATH, and a shared SALT if their logs are to be combined.
+"""
+import hashlib
+import hmac
+import json
+import secrets
+import threading
+import time
+
+from django.conf import settings
+
+# Fields rewritten in captured frames
+USER_FIELDS = ('username', 'recipient')
+USER_LIST_FIELDS = ('usernames',)
+CONNECTION_FIELDS = ('connection_id',)
+# Hashed like users, so a resend still matches the frame it repeats
+CLIENT_ID_FIELDS = ('client_id',)
+LENGTH_FIELDS = ('text', 'query', 'base64')
+PAYLOAD_FIELDS = ('offer', 'answer', 'candidate')
+# Ids only meaningful in the live database: kept as True
+ID_FIELDS = ('message_id', 'up_to', 'cursor')
+KEPT_FIELDS = ('source', 'action')
+
+
+class TrafficCapture:
+    def __init__(self, path, sample=1.0, salt=None):
+        self.path = str(path)
+        self.sample = sample
+        # A fresh salt per process unless configured: hashes cannot be reversed from the log
+        self.salt = salt.encode() if isinstance(salt, str) else (salt or secrets.token_bytes(16))
+        self._file = None
+        self._start = None
+        self._sockets = {}
+        self._next_socket = 0
+        self._lock = threading.Lock()
+
+    def _hash(self, prefix, value):
+        return prefix + hmac.new(self.salt, str(value).encode(), hashlib.sha256).hexdigest()[:10]
+
+    def user(self, username):
+        return self._hash('u', username)
+
+    def connection(self, connection_id):
+        return self._hash('c', connection_id)
+
+    def sampled(self, username):
+        if self.sample >= 1:
+            return True
+        return int(self.user(username)[1:9], 16) / 0xffffffff < self.sample
+
+    def anonymize(self, frame):
+        out = {}
+        for key, value in frame.items():
+            if key in KEPT_FIELDS:
+                out[key] = value
+            elif key in USER_FIELDS:
+                out[key] = self.user(value) if value else value
+            elif key in USER_LIST_FIELDS:
+                out[key] = [self.user(name) for name in value or ()]
+            elif key in CONNECTION_FIELDS:
+                out[key] = self.connection(value) if value is not None else None
+            elif key in CLIENT_ID_FIELDS:
+                out[key] = self._hash('m', value) if value is not None else None
+            elif key in LENGTH_FIELDS:
+                out[key] = len(value) if isinstance(value, str) else 0
+            elif key in PAYLOAD_FIELDS:
+                out[key] = len(json.dumps(value)) if value else 0
+            elif key in ID_FIELDS:
+                out[key] = True if value is not None else None
+            elif value is None or isinstance(value, (bool, int, float)):
+                out[key] = value
+            elif isinstance(value, str):
+                # Cursors and other opaque strings: only whether one was sent
+                out[key] = True
+        return out
+
+    def _write(self, record):
+        now = time.time()
+        if self._file is None:
+            self._file = open(self.path, 'a', buffering=1 << 16)
+            self._start = now
+            self._file.write(json.dumps({'v': 1, 'start': now}) + '\n')
+        record = {'t': round(now - self._start, 3), **record}
+        self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+    def opened(self, channel_name, kind, username):
+        if not self.sampled(username):
+            return
+        with self._lock:
+            self._next_socket += 1
+            self._sockets[channel_name] = self._next_socket
+            self._write({'s': self._next_socket, 'e': 'open', 'k': kind, 'u': self.user(username)})
+
+    def frame(self, channel_name, frame):
+        socket = self._sockets.get(channel_name)
+        if socket is None or not isinstance(frame, dict):
+            return
+        record = {'s': socket, 'f': self.anonymize(frame)}
+        with self._lock:
+            self._write(record)
+
+    def closed(self, channel_name):
+        with self._lock:
+            socket = self._sockets.pop(channel_name, None)
+            if socket is None:
+                return
+            self._write({'s': socket, 'e': 'close'})
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+_capture = None
+
+
+def get_capture():
+    """
+    The process-wide TrafficCapture, or None when capture is off.
+    """
+    global _capture
+    config = getattr(settings, 'CAPTURE', {})
+    if not config.get('ENABLED'):
+        return None
+    if _capture is None:
+        _capture = TrafficCapture(
+            config.get('PATH', 'capture.jsonl'),
+            sample=config.get('SAMPLE', 1.0),
+            salt=config.get('SALT'),
+        )
+    return _capture
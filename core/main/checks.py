@@ -0,0 +1,32 @@
+from django.core import checks
+from django.db import connections
+from django.db.migrations.executor import MigrationExecutor
+
+from . import sync
+
+
+@checks.register(checks.Tags.database)
+def change_log_triggers(app_configs, databases=None, **kwargs):
+    """
+    The Change log is written only by SQLite triggers (main/sync.py). A
+    migration that rebuilds main_message, main_connection or main_user drops
+    them without a word, so every run of the test suite (and
+    `manage.py check --database default`) looks for them once migrated.
+    """
+    errors = []
+    for alias in databases or []:
+        connection = connections[alias]
+        if connection.vendor != 'sqlite':
+            continue
+        executor = MigrationExecutor(connection)
+        if executor.migration_plan(executor.loader.graph.leaf_nodes()):
+            # Not migrated yet, or the migration that puts them back is still to run
+            continue
+        missing = sync.missing_triggers(connection)
+        if missing:
+            errors.append(checks.Error(
+                f"Change log triggers missing from the '{alias}' database: {', '.join(missing)}",
+                hint='A migration rebuilt their table; recreate them in that migration as 0010 does.',
+                id='main.E001',
+            ))
+    return errors
@@ -0,0 +1,125 @@
+"""
+WebSocket frame codecs.
+
+Clients pick a codec with the WebSocket subprotocol header, in order of
+preference, e.g. `Sec-WebSocket-Protocol: msgpack, json`. MessagePack is
+sent as binary frames; JSON stays the default for clients that ask for
+nothing. JSON uses orjson or ujson when installed and falls back to the
+standard library.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class CodecError(ValueError):
+    pass
+
+
+class JSONCodec:
+    name = 'json'
+    binary = False
+
+    if orjson is not None:
+        def encode(self, payload):
+            return orjson.dumps(payload).decode()
+
+        def decode(self, frame):
+            try:
+                return orjson.loads(frame)
+            except orjson.JSONDecodeError as e:
+                raise CodecError(str(e))
+    elif ujson is not None:
+        def encode(self, payload):
+            return ujson.dumps(payload, ensure_ascii=False)
+
+        def decode(self, frame):
+            try:
+                return ujson.loads(frame)
+            except ValueError as e:
+                raise CodecError(str(e))
+    else:
+        def encode(self, payload):
+            return json.dumps(payload, separators=(',', ':'), ensure_ascii=False)
+
+        def decode(self, frame):
+            try:
+                return json.loads(frame)
+            except json.JSONDecodeError as e:
+                raise CodecError(str(e))
+
+
+class MsgPackCodec:
+    name = 'msgpack'
+    binary = True
+
+    def encode(self, payload):
+        return msgpack.packb(payload, use_bin_type=True)
+
+    def decode(self, frame):
+        try:
+            return msgpack.unpackb(frame, raw=False)
+        except Exception as e:
+            raise CodecError(str(e))
+
+
+DEFAULT = JSONCodec()
+CODECS = {'json': DEFAULT}
+if msgpack is not None:
+    CODECS['msgpack'] = MsgPackCodec()
+
+
+def negotiate(subprotocols):
+    """
+    First codec the client offered that we support, as (codec, subprotocol
+    to echo back). A client that offers no subprotocol gets JSON and no echo.
+    """
+    for name in subprotocols or ():
+        codec = CODECS.get(name)
+        if codec is not None:
+            return codec, name
+    return DEFAULT, None
+
+
+class CodecMixin:
+    """
+    For AsyncWebsocketConsumer: call `await self.accept_with_codec()` in
+    connect, then use `self.decode_frame` / `self.send_event` instead of
+    json.loads / self.send(text_data=json.dumps(...)).
+    """
+    codec = DEFAULT
+
+    async def accept_with_codec(self):
+        self.codec, subprotocol = negotiate(self.scope.get('subprotocols'))
+        await self.accept(subprotocol=subprotocol)
+
+    def decode_frame(self, text_data=None, bytes_data=None):
+        frame = bytes_data if bytes_data is not None else text_data
+        if frame is None:
+            raise CodecError('Empty frame')
+        # A frame of the other kind is still accepted, e.g. a JSON ping on a msgpack socket
+        if isinstance(frame, bytes) and not self.codec.binary:
+            return CODECS.get('msgpack', DEFAULT).decode(frame)
+        if isinstance(frame, str) and self.codec.binary:
+            return DEFAULT.decode(frame)
+        return self.codec.decode(frame)
+
+    async def send_event(self, payload):
+        frame = self.codec.encode(payload)
+        if self.codec.binary:
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
@@ -1,29 +1,54 @@
-from asgiref.sync import async_to_sync
 from channels.generic.websocket import AsyncWebsocketConsumer
-import json
-import base64
-from django.core.files.base import ContentFile
-from .serializer import UserSerializer , SearchSerializer , RequestSerializer , FriendListSerializer , MessageSerializer
-from asgiref.sync import sync_to_async
-from asgiref.sync import async_to_sync
-from .models import User , Connection , Message
-from django.db.models import Q , Exists, OuterRef
-from channels.layers import get_channel_layer
+import asyncio
+import functools
+from django.conf import settings
+from . import data as data_access
+from .codecs import CodecMixin, CodecError
+from .batching import OutboundBatchMixin
+from .fanout import group_send_many, group_send_each
+from . import search
+from .presence import get_presence, watch_group
+from .calls import calls, Busy, CANDIDATE_WINDOW
+from .capture import get_capture
+from .graph import graph
+from . import payloads, writebehind
+from . import sync as change_sync
+from .pagination import decode_cursor, page_size
+from . import metrics
+from . import logs
+
+SEARCH_DEBOUNCE = getattr(settings, 'SEARCH', {}).get('DEBOUNCE', 0.15)
+
+log = logs.get_logger(__name__)
+# Per-frame logs, rate limited (see LOGGING)
+frames = logs.get_logger('main.frames')
+
+# Metric labels, anything else is counted as 'unknown'
+CHAT_SOURCES = (
+    'search', 'thumbnail', 'request.accept', 'request.connect', 'request.list', 'friend.list',
+    'message.send', 'message.list', 'message.typing', 'message.read', 'presence.watch', 'sync',
+)
+VIDEO_ACTIONS = ('ping', 'call', 'offer', 'answer', 'candidate', 'accept', 'decline', 'end-call')
 
 # ...existing code...
-class VideoCallConsumer(AsyncWebsocketConsumer):
+class VideoCallConsumer(CodecMixin, AsyncWebsocketConsumer):
+    # Signaling has its own channel layer, see CHANNEL_LAYERS
+    channel_layer_alias = 'signaling'
+    # TrafficCapture when CAPTURE is enabled
+    traffic = None
+
     async def connect(self):
         self.user = self.scope["user"]
-        print(f"[VideoCallConsumer] Connecting for user: {getattr(self.user, 'username', None)}")
+        log.debug('video socket connecting', username=getattr(self.user, 'username', None))
         if not self.user or not self.user.is_authenticated:
-            print("[VideoCallConsumer] User is not authenticated, closing connection")
+            log.info('video socket not authenticated, closing')
             await self.close()
             return
         
         # FIX: Normalize username to lowercase
         self.username = self.user.username
         normalized_username = self.username.lower()
-        print(f"[VideoCallConsumer] Joining personal group: {normalized_username}")
+        log.debug('video socket joining group', group=f"video_{normalized_username}")
         # Use a dedicated group for video signaling to avoid conflicts with ChatConsumer
         self.video_group = f"video_{normalized_username}"
 
@@ -33,113 +58,156 @@ class VideoCallConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
 
-        await self.accept()
-        print(f"[VideoCallConsumer] Accepted connection for user: {self.username}")
+        await self.accept_with_codec()
+        log.info('video socket open', username=self.username)
+        metrics.ws_sockets.inc('video')
+        self.traffic = get_capture()
+        if self.traffic:
+            self.traffic.opened(self.channel_name, 'video', self.username)
+
+        # recipient -> (pending ICE candidates, flush task)
+        self.candidates = {}
 
         # Send connection success message
-        await self.send(text_data=json.dumps({
+        await self.send_event({
             "action": "connection_success",
             "message": "WebSocket connection established",
             "username": self.username,
             "group": self.video_group
-        }))
+        })
 
     async def disconnect(self, close_code):
+        if self.traffic:
+            self.traffic.closed(self.channel_name)
+        for recipient in list(getattr(self, 'candidates', {})):
+            await self.flush_candidates(recipient)
         if hasattr(self, 'video_group'):
+            metrics.ws_sockets.dec('video')
             # Remove user from their video group
             await self.channel_layer.group_discard(
                 self.video_group,
                 self.channel_name
             )
 
-    async def receive(self, text_data):
-        print(f"[VideoCallConsumer] Received WebSocket message: {text_data}")
+    async def receive(self, text_data=None, bytes_data=None):
         try:
-            data = json.loads(text_data)
-        except json.JSONDecodeError:
-            await self.send(text_data=json.dumps({
+            data = self.decode_frame(text_data, bytes_data)
+        except CodecError:
+            await self.send_event({
                 "action": "error",
-                "message": "Invalid JSON format"
-            }))
+                "message": "Invalid frame format"
+            })
             return
-        try:
-            action = data.get('action')
-            print(f"[VideoCallConsumer] Parsed action: {action}, data: {data}")
+        if self.traffic:
+            self.traffic.frame(self.channel_name, data)
+        action = data.get('action')
+        with metrics.track('video', action if action in VIDEO_ACTIONS else 'unknown') as tracked:
+            await self.handle_action(data, action, tracked)
 
+    async def handle_action(self, data, action, tracked):
+        try:
             if action == 'ping':
-                await self.send(text_data=json.dumps({'action': 'pong'}))
+                await self.send_event({'action': 'pong'})
                 return
 
             if not action:
-                await self.send(text_data=json.dumps({
+                await self.send_event({
                     "action": "error",
                     "message": "Missing action field"
-                }))
+                })
                 return
 
             recipient_username = data.get('recipient')
-            print(f"[VideoCallConsumer] Recipient username: {recipient_username}")
 
             if not recipient_username:
-                await self.send(text_data=json.dumps({
+                await self.send_event({
                     "action": "error",
                     "message": "Missing recipient field"
-                }))
-                return
-
-            recipient = await self.get_user(recipient_username)
-            print(f"[VideoCallConsumer] Recipient user object: {recipient}")
-
-            if not recipient:
-                await self.send(text_data=json.dumps({
-                    "action": "error",
-                    "message": "Recipient not found"
-                }))
+                })
                 return
 
             if action == 'call':
-                print(f"[VideoCallConsumer] Handling call from {self.user.username} to {recipient_username}")
                 await self.handle_call(recipient_username)
             elif action in ['offer', 'answer', 'candidate', 'accept', 'decline', 'end-call']:
                 if not data.get(action) and action not in ['accept', 'decline', 'end-call']:
-                    await self.send(text_data=json.dumps({
+                    await self.send_event({
                         "action": "error",
                         "message": f"Missing {action} field"
-                    }))
+                    })
                     return
 
-                print(f"[VideoCallConsumer] Forwarding signal: {action} to {recipient_username}")
-                await self.forward_signal(data, recipient_username)
+                # Checked against the call session, no DB lookup per signal
+                session = calls.apply(self.username.lower(), recipient_username.lower(), action)
+                if not session:
+                    await self.send_event({
+                        "action": "error",
+                        "message": "No active call with recipient"
+                    })
+                    return
+                await self.forward_signal(data, recipient_username, session)
             else:
-                await self.send(text_data=json.dumps({
+                await self.send_event({
                     "action": "error",
                     "message": "Invalid action"
-                }))
+                })
         except Exception as e:
-            print(f"[VideoCallConsumer] Exception: {str(e)}")
-            await self.send(text_data=json.dumps({
+            tracked.failed = True
+            log.exception('video signal failed', action=action)
+            await self.send_event({
                 "action": "error",
                 "message": str(e)
-            }))
+            })
 
     # --- Added/Updated: Handle initiating a call and broadcast proper signal ---
     async def handle_call(self, recipient_username):
         # FIX: Use normalized username for recipient lookup
         normalized_recipient = recipient_username.lower()
-        print(f"[VideoCallConsumer] Sending call signal to: {normalized_recipient}")
-        await self.channel_layer.group_send(
-            f"video_{normalized_recipient}",
-            {
-                "type": "call.signal",
-                "action": "call",
-                "caller": self.user.username,
-                "recipient": recipient_username,
-                "recipient_online": normalized_recipient in ONLINE_USERS,
-            }
-        )
+        # The recipient is resolved once here and the session remembers them
+        recipient = await data_access.get_user(recipient_username, 'call')
+        if not recipient:
+            await self.send_event({
+                "action": "error",
+                "message": "Recipient not found"
+            })
+            return
+        try:
+            session = calls.start(self.username.lower(), normalized_recipient)
+        except Busy:
+            await self.send_event({
+                "action": "busy",
+                "recipient": recipient_username
+            })
+            return
+        with metrics.timed_send('group_send'):
+            await self.channel_layer.group_send(
+                f"video_{normalized_recipient}",
+                {
+                    "type": "call.signal",
+                    "action": "call",
+                    "call_id": session.id,
+                    "caller": self.user.username,
+                    "recipient": recipient_username,
+                    "recipient_online": bool(await get_presence().online([recipient.username])),
+                }
+            )
 
     # Handle delivery of call.signal to the recipient client
     async def call_signal(self, event):
+        try:
+            # Register the session on this worker too, so the recipient's signals validate locally
+            calls.start(event["caller"].lower(), self.username.lower(), event.get("call_id"))
+        except Busy:
+            # In a call the caller's worker did not know of: don't ring, tell the caller
+            with metrics.timed_send('group_send'):
+                await self.channel_layer.group_send(
+                    f"video_{event['caller'].lower()}",
+                    {
+                        "type": "call.busy",
+                        "call_id": event.get("call_id"),
+                        "recipient": event.get("recipient"),
+                    }
+                )
+            return
         try:
             payload = {
                 "action": "call",
@@ -147,39 +215,87 @@ class VideoCallConsumer(AsyncWebsocketConsumer):
                 "recipient": event.get("recipient"),
                 "recipient_online": event.get("recipient_online", False),
             }
-            await self.send(text_data=json.dumps(payload))
-        except Exception as e:
-            print(f"[VideoCallConsumer] call_signal error: {e}")
+            await self.send_event(payload)
+        except Exception:
+            log.exception('call signal delivery failed', caller=event.get("caller"))
+
+    async def call_busy(self, event):
+        recipient = event["recipient"].lower()
+        session = calls.find(self.username.lower(), recipient)
+        if session is not None:
+            if session.id != event.get("call_id"):
+                # Answer to an older call, a newer one is ringing
+                return
+            calls.apply(self.username.lower(), recipient, 'end-call')
+        await self.send_event({
+            "action": "busy",
+            "recipient": event.get("recipient")
+        })
 
-    async def forward_signal(self, data, recipient_username):
+    async def forward_signal(self, data, recipient_username, session):
         # FIX: Normalize recipient to lowercase
         normalized_recipient = recipient_username.lower()
+        if data.get('action') == 'candidate':
+            await self.queue_candidate(data, normalized_recipient, session)
+            return
+        # Candidates queued before this signal go first
+        await self.flush_candidates(normalized_recipient)
         data_to_send = {
             **data,
             "sender": self.user.username,
+            "call_id": session.id,
             "timestamp": self.get_timestamp()
         }
         
-        await self.channel_layer.group_send(
-            f"video_{normalized_recipient}",
-            {
-                "type": "webrtc.signal",  # Changed from "signal" to "webrtc.signal"
-                **data_to_send
-            }
-        )
+        with metrics.timed_send('group_send'):
+            await self.channel_layer.group_send(
+                f"video_{normalized_recipient}",
+                {
+                    "type": "webrtc.signal",  # Changed from "signal" to "webrtc.signal"
+                    **data_to_send
+                }
+            )
+
+    async def queue_candidate(self, data, recipient, session):
+        # Trickle ICE sends a burst of candidates; deliver them as one 'candidates' frame
+        pending = self.candidates.get(recipient)
+        if pending is None:
+            task = asyncio.create_task(self._flush_candidates_later(recipient))
+            pending = self.candidates[recipient] = ([], session, task)
+        pending[0].append(data['candidate'])
+
+    async def _flush_candidates_later(self, recipient):
+        await asyncio.sleep(CANDIDATE_WINDOW)
+        await self.flush_candidates(recipient)
+
+    async def flush_candidates(self, recipient):
+        pending = self.candidates.pop(recipient, None)
+        if pending is None:
+            return
+        candidates, session, task = pending
+        if task is not asyncio.current_task():
+            task.cancel()
+        with metrics.timed_send('group_send'):
+            await self.channel_layer.group_send(
+                f"video_{recipient}",
+                {
+                    "type": "webrtc.signal",
+                    "action": "candidates",
+                    "candidates": candidates,
+                    "recipient": recipient,
+                    "sender": self.user.username,
+                    "call_id": session.id,
+                    "timestamp": self.get_timestamp()
+                }
+            )
 
     # (removed duplicate call_signal that forwarded raw event)
 
     async def webrtc_signal(self, event):
-        print(f"[VideoCallConsumer] webrtc_signal for user={getattr(self, 'username', None)} event={ {k:v for k,v in event.items() if k!='type'} }")
-        await self.send(text_data=json.dumps({ k: v for k, v in event.items() if k != 'type' }))
-
-    @sync_to_async
-    def get_user(self, username):
-        try:
-            return User.objects.get(username=username)
-        except User.DoesNotExist:
-            return None
+        # Keep this worker's copy of the session in step (no-op when it is the sender's worker)
+        if event.get("sender"):
+            calls.apply(self.username.lower(), event["sender"].lower(), event.get("action"))
+        await self.send_event({ k: v for k, v in event.items() if k != 'type' })
 
     def get_timestamp(self):
         from datetime import datetime
@@ -187,129 +303,164 @@ class VideoCallConsumer(AsyncWebsocketConsumer):
 
     async def broadcast_group(self, event):
         event.pop('type', None)
-        await self.send(text_data=json.dumps(event))
+        await self.send_event(event)
 
-ONLINE_USERS = set()
+class ChatConsumer(OutboundBatchMixin, CodecMixin, AsyncWebsocketConsumer):
+    # TrafficCapture when CAPTURE is enabled
+    traffic = None
 
-class ChatConsumer(AsyncWebsocketConsumer):
     async def call_signal(self, event):
-        print(f"[ChatConsumer] call_signal received (ignored). event={ {k:v for k,v in event.items() if k!='type'} }")
+        frames.debug('call event ignored on chat socket', event=event)
         return
 
     async def webrtc_signal(self, event):
-        print(f"[ChatConsumer] webrtc_signal received (ignored). event={ {k:v for k,v in event.items() if k!='type'} }")
+        frames.debug('signal event ignored on chat socket', event=event)
         return
 
     async def receive_message_read(self, data):
         user = self.scope.get('user')
+        if data.get('up_to') is not None:
+            await self.receive_message_read_up_to(data)
+            return
         message_id = data.get('message_id')
-        print(f'[DEBUG] receive_message_read called by user: {getattr(user, "username", None)}, message_id: {message_id}')
         try:
-            def mark_message_read():
-                message = Message.objects.filter(id=message_id).first()
-                if not message:
-                    print(f'[DEBUG] Message not found for id: {message_id}')
-                    return None, None
-                # Only receiver can mark as read
-                if message.sender == user:
-                    print(f'[DEBUG] Sender cannot mark own message as read. user: {getattr(user, "username", None)}')
-                    return None, None
-                if message.status != 'read':
-                    message.status = 'read'
-                    message.save()
-                    sender_username = message.sender.username
-                    print(f'[DEBUG] Message {message_id} marked as read by {getattr(user, "username", None)}')
-                    return message.id, sender_username
-                print(f'[DEBUG] Message {message_id} already marked as read')
-                return None, None
-            msg_id, sender_username = await sync_to_async(mark_message_read)()
-            if msg_id and sender_username:
-                print(f'[DEBUG] Sending message.read event to sender: {sender_username} for message_id: {msg_id}')
-                await self.send_group(sender_username, 'message.read', {'message_id': msg_id, 'status': 'read'})
-        except Exception as e:
-            print(f"Error marking message as read: {str(e)}")
+            sender_username = await data_access.mark_read(user, message_id)
+            if sender_username:
+                await self.send_group(sender_username, 'message.read', {'message_id': message_id, 'status': 'read'})
+        except Exception:
+            log.exception('message.read failed', message_id=message_id)
+
+    async def receive_message_read_up_to(self, data):
+        # Watermark form: everything from the peer up to message `up_to` in the connection is read
+        user = self.scope.get('user')
+        connection_id = data.get('connection_id')
+        try:
+            up_to = int(data.get('up_to'))
+        except (TypeError, ValueError):
+            log.warning('invalid read watermark', up_to=data.get('up_to'))
+            return
+        try:
+            sender_username, count = await data_access.mark_read_up_to(user, connection_id, up_to)
+            if sender_username and count:
+                await self.send_group(sender_username, 'message.read', {
+                    'connection_id': connection_id,
+                    'up_to': up_to,
+                    'status': 'read'
+                })
+        except Exception:
+            log.exception('message.read up to failed', connection_id=connection_id)
+
     async def connect(self):
         user = self.scope.get('user')
         if not user or not user.is_authenticated:
-            print("User is not authenticated, closing connection")
+            log.info('chat socket not authenticated, closing')
             await self.close()
             return
         self.username = user.username
         await self.channel_layer.group_add(
             self.username, self.channel_name
         )
-        await self.accept()
-        print("WebSocket connection established")
-        ONLINE_USERS.add(self.username)
-        await self.broadcast_status(self.username, True)
-
-        # Mark all 'sent' messages as 'delivered' for this user and notify senders
-        def mark_all_sent_as_delivered():
-            delivered = []
-            # Find all connections where user is receiver
-            connections = Connection.objects.filter(receiver=user, accepted=True)
-            for conn in connections:
-                msgs = Message.objects.filter(connection=conn, status='sent')
-                for msg in msgs:
-                    msg.status = 'delivered'
-                    msg.save()
-                    delivered.append((msg.id, msg.sender.username))
-            return delivered
-        delivered_msgs = await sync_to_async(mark_all_sent_as_delivered)()
-        # Notify senders in real time
+        await self.accept_with_codec()
+        self.start_batching()
+        log.info('chat socket open', username=self.username)
+        metrics.ws_sockets.inc('chat')
+        self.traffic = get_capture()
+        if self.traffic:
+            self.traffic.opened(self.channel_name, 'chat', self.username)
+        self.watching = set()
+        # Pending message.saved acks, see main/writebehind.py
+        self.save_acks = set()
+        # Only the user's first socket flips them online, unless they were
+        # back within the grace period and nobody saw them leave
+        presence = get_presence()
+        if await presence.connect(self.username, self.channel_name) and not presence.cancel_offline(self.username):
+            await self.broadcast_status(self.username, True)
+
+        # Mark all 'sent' messages as 'delivered' for this user in one update
+        delivered_msgs = await data_access.mark_delivered_for(user)
+        # Notify each sender once with all of their delivered ids
+        await self.send_delivered(delivered_msgs)
+
+    async def send_delivered(self, delivered_msgs):
+        by_sender = {}
         for msg_id, sender_username in delivered_msgs:
-            await self.send_group(sender_username, 'message.delivered', {'message_id': msg_id, 'status': 'delivered'})
+            by_sender.setdefault(sender_username, []).append(msg_id)
+        with metrics.timed_send('group_send_each'):
+            await group_send_each(self.channel_layer, (
+                (sender_username, self.group_event('message.delivered', {'message_ids': message_ids, 'status': 'delivered'}))
+                for sender_username, message_ids in by_sender.items()
+            ))
 
     async def disconnect(self, close_code):
         # Guard against missing username (e.g., auth failed before connect)
         username = getattr(self, 'username', None)
         if not username:
-            print("[ChatConsumer] disconnect called without authenticated username; skipping group cleanup")
+            log.debug('chat socket closed before authenticating')
             return
         try:
             await self.channel_layer.group_discard(
                 username, self.channel_name
             )
         except Exception as e:
-            print(f"[ChatConsumer] Error discarding group for {username}: {e}")
-        print("WebSocket connection closed")
-        # Mark user as offline
-        ONLINE_USERS.discard(username)
-        await self.broadcast_status(username, False)
+            log.warning('group discard failed', username=username, error=str(e))
+        log.info('chat socket closed', username=username, code=close_code)
+        metrics.ws_sockets.dec('chat')
+        if self.traffic:
+            self.traffic.closed(self.channel_name)
+        task = getattr(self, 'search_task', None)
+        if task:
+            task.cancel()
+        self.stop_batching()
+        await self.set_watching(set())
+        # Mark user as offline once their last socket is gone and the grace period is over
+        if await get_presence().disconnect(username, self.channel_name):
+            get_presence().schedule_offline(username, functools.partial(self.broadcast_status, username, False))
 
     async def broadcast_status(self, username, online):
-        # Notify all friends about this user's status
+        # Only sockets currently showing this user hear about it
         try:
-            user = await sync_to_async(User.objects.get)(username=username)
-            # Find all connections where this user is sender or receiver and accepted
-            connections = await sync_to_async(lambda: list(
-                Connection.objects.filter(
-                    Q(sender=user) | Q(receiver=user),
-                    accepted=True
-                ).select_related('sender', 'receiver')
-            ))()
-            # Get all friend usernames
-            friend_usernames = set()
-            for conn in connections:
-                if conn.sender.username != username:
-                    friend_usernames.add(conn.sender.username)
-                if conn.receiver.username != username:
-                    friend_usernames.add(conn.receiver.username)
-            # Broadcast status to each friend
-            for friend_username in friend_usernames:
-                await self.send_group(
-                    friend_username,
-                    'user.status',
-                    {'username': username, 'online': online}
-                )
-        except Exception as e:
-            print(f"Error broadcasting status: {str(e)}")
-
-    async def receive(self, text_data):
-        data = json.loads(text_data)
+            await self.send_group(
+                watch_group(username),
+                'user.status',
+                {'username': username, 'online': online}
+            )
+        except Exception:
+            log.exception('status broadcast failed', username=username)
+
+    async def set_watching(self, usernames):
+        watching = getattr(self, 'watching', set())
+        await asyncio.gather(
+            *(self.channel_layer.group_discard(watch_group(name), self.channel_name) for name in watching - usernames),
+            *(self.channel_layer.group_add(watch_group(name), self.channel_name) for name in usernames - watching)
+        )
+        self.watching = usernames
+
+    async def receive_presence_watch(self, data):
+        # The socket lists the users it is showing (friend list, open chat); replaces the previous list
+        usernames = data.get('usernames') or []
+        friends = await data_access.friend_usernames(self.username)
+        await self.set_watching({name for name in usernames if name in friends})
+        online = await get_presence().online(self.watching)
+        # Current status of the watched users, to this socket only
+        await self.queue_event({
+            'source': 'presence.watch',
+            'data': {name: name in online for name in self.watching}
+        })
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            data = self.decode_frame(text_data, bytes_data)
+        except CodecError:
+            frames.warning('undecodable frame dropped')
+            return
+        if self.traffic:
+            self.traffic.frame(self.channel_name, data)
         data_source = data.get('source')
-        print('receive', data_source, data)
+        frames.debug('receive', source=data_source, frame=data)
+        with metrics.track('chat', data_source if data_source in CHAT_SOURCES else 'unknown'):
+            await self.dispatch_source(data_source, data)
 
+    async def dispatch_source(self, data_source, data):
         if data_source == 'search':
             # handle user search
             await self.receive_search(data)
@@ -343,132 +494,111 @@ class ChatConsumer(AsyncWebsocketConsumer):
         elif data_source == 'message.read':
             # handle message read
             await self.receive_message_read(data)
+        elif data_source == 'presence.watch':
+            # handle presence subscription
+            await self.receive_presence_watch(data)
+        elif data_source == 'sync':
+            # handle reconnect sync
+            await self.receive_sync(data)
 
     async def receive_search(self, data):
+        # One search per socket at a time: a newer query replaces the pending one
+        task = getattr(self, 'search_task', None)
+        if task and not task.done():
+            task.cancel()
+        self.search_task = asyncio.create_task(self.run_search(data))
+
+    async def run_search(self, data):
+        # Wait out the rest of the keystrokes before touching the index
+        await asyncio.sleep(SEARCH_DEBOUNCE)
         query = data.get('query')
-        # run DB query in thread, including annotate
-        def get_users_with_status():
-            return list(
-                User.objects.filter(
-                    Q(username__icontains=query) |
-                    Q(last_name__icontains=query) |
-                    Q(first_name__icontains=query)
-                ).exclude(
-                    username=self.scope.get('user').username
-                ).annotate(
-                    pending_them = Exists(
-                        Connection.objects.filter(
-                            sender=self.scope.get('user'),
-                            receiver=OuterRef('pk'),
-                            accepted=False
-                        )
-                    ),
-                    pending_me = Exists(
-                        Connection.objects.filter(
-                            receiver=self.scope.get('user'),
-                            sender=OuterRef('pk'),
-                            accepted=False
-                        )
-                    ),
-                    connected = Exists(
-                        Connection.objects.filter(
-                            Q(sender=self.scope.get('user'), receiver=OuterRef('pk'), accepted=True) |
-                            Q(receiver=self.scope.get('user'), sender=OuterRef('pk'), accepted=True),
-                            accepted=True
-                        )
-                    )
-                )
+        # ranked page of results, the client asks for more with offset
+        limit, offset = search.limit_and_offset(data.get('limit'), data.get('offset'))
+        try:
+            # Timed apart from 'search', which only schedules this task
+            with metrics.track('chat', 'search.run'):
+                serialized_users = await data_access.search_users(self.scope.get('user'), query, limit, offset)
+
+            # broadcast search results
+            await self.send_group(
+                self.username,
+                'search',
+                serialized_users
             )
-        users = await sync_to_async(get_users_with_status)()
-        serialized_users = SearchSerializer(users, many=True)
-        
-        # broadcast search results
-        await self.send_group(
-            self.username,
-            'search',
-            serialized_users.data
-        )
+        except Exception:
+            # Nothing awaits this task, so the failure stops here
+            log.exception('search failed', query=query)
 
     async def receive_thumbnail(self, data):
+        # Legacy path, clients upload to /api/thumbnail/ instead
         user = self.scope.get('user')
-        image_str = data.get('base64')
-        image = ContentFile(base64.b64decode(image_str))
-        filename = data.get('filename')
-        unique_filename = f"{user.id}_{filename.lstrip('/')}"
-        # delete old thumbnail
-        if user.thumbnail:
-            await sync_to_async(user.thumbnail.delete)(save=False)
-        print(f"Saving thumbnail to: thumbnails/{unique_filename}")
-        # save new thumbnail
-        await sync_to_async(user.thumbnail.save)(unique_filename, image, save=True)
-        await sync_to_async(user.refresh_from_db)()
-        serialized = UserSerializer(user)
-        print("Thumbnail URL returned to frontend:", serialized.data.get("thumbnail"))
+        try:
+            serialized = await data_access.save_thumbnail(user, data.get('base64'))
+        except Exception:
+            log.exception('thumbnail save failed')
+            return
+        log.debug('thumbnail saved', thumbnail=serialized.get("thumbnail"))
         # broadcast new thumbnail
         await self.send_group(
             self.username,
             'thumbnail',
-            serialized.data
+            serialized
         )
 
-    async def send_group(self, group, source, data):
-        response = {
+    def group_event(self, source, data):
+        return {
             'type': 'broadcast_group',
             'source': source,
             'data': data
         }
+
+    async def send_group(self, group, source, data):
         # send to group
-        await self.channel_layer.group_send(
-            group,
-            response
-        )
+        with metrics.timed_send('group_send'):
+            await self.channel_layer.group_send(
+                group,
+                self.group_event(source, data)
+            )
+
+    async def send_groups(self, groups, source, data):
+        # same event to several groups without a round trip per group
+        with metrics.timed_send('group_send_many'):
+            await group_send_many(
+                self.channel_layer,
+                groups,
+                self.group_event(source, data)
+            )
 
     async def broadcast_group(self, data):
         data.pop('type')
-        # send to client
-        await self.send(text_data=json.dumps({ **data }))
+        if data.get('source') in ('request.connect', 'request.accept'):
+            # This worker may have either side cached, see main/graph.py
+            request = data['data']
+            graph.invalidate((request['sender']['username'], request['receiver']['username']), (request['id'],))
+        elif data.get('source') == 'thumbnail':
+            # Uploads on another worker only reach this one through the user's own sockets
+            payloads.cards.invalidate(self.scope['user'].pk)
+        # send to client, coalesced with other events arriving in the same window
+        await self.queue_event(data)
 
     async def receive_request_connect(self, data):
         username = data.get('username')
-        #attempt to find recv user
-        try:
-            receiver = await sync_to_async(User.objects.get)(username=username)
-        except User.DoesNotExist:
-            print(f"User {username} does not exist")
-            return
         # create a connection request
-        connection, _ = await sync_to_async(Connection.objects.get_or_create)(
-            sender=self.scope.get('user'),
-            receiver=receiver
-        )
-        serialized = RequestSerializer(connection)
-        # get sender and receiver usernames asynchronously
-        sender_username = await sync_to_async(lambda: connection.sender.username)()
-        receiver_username = await sync_to_async(lambda: connection.receiver.username)()
-        #send back to sender
-        await self.send_group(
-            sender_username,
-            'request.connect',
-            serialized.data
-        )
-        #send back to receiver
-        await self.send_group(
-            receiver_username,
+        serialized = await data_access.request_connect(self.scope.get('user'), username)
+        if serialized is None:
+            log.info('request.connect to unknown user', username=username)
+            return
+        #send back to sender and receiver
+        await self.send_groups(
+            [serialized['sender']['username'], serialized['receiver']['username']],
             'request.connect',
-            serialized.data
+            serialized
         )
 
     async def receive_request_list(self, data):
         user = self.scope.get('user')
         # get all connections for the user (received or sent, not accepted)
-        connections = await sync_to_async(lambda: list(
-            Connection.objects.filter(
-                Q(receiver=user) | Q(sender=user),
-                accepted=False
-            ).select_related('sender', 'receiver')
-        ))()
-        # fetch all related objects in thread to avoid sync DB access during serialization
-        serialized = await sync_to_async(lambda: RequestSerializer(connections, many=True).data)()
+        serialized = await data_access.request_list(user)
         # send back to user
         await self.send_group(
             user.username,
@@ -478,49 +608,28 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
     async def receive_request_accept(self, data):
         username = data.get('username')
-        # wrap DB access in sync_to_async
-        async def get_connection():
-            # fetch related objects in thread to avoid sync DB access during serialization
-            return await sync_to_async(
-                lambda: Connection.objects.select_related('sender', 'receiver').filter(
-                    sender__username=username,
-                    receiver=self.scope.get('user')
-                ).order_by('-id').first()  # get the latest connection
-            )()
-        connection = await get_connection()
-        if not connection:
-            print(f"No connection found for {username}")
+        serialized = await data_access.request_accept(self.scope.get('user'), username)
+        if serialized is None:
+            log.info('request.accept without a pending request', username=username)
             return
-        # update connection to accepted
-        connection.accepted = True
-        await sync_to_async(connection.save)()
-        # serialize in thread to avoid sync DB access
-        serialized = await sync_to_async(lambda: RequestSerializer(connection).data)()
-        sender_username = await sync_to_async(lambda: connection.sender.username)()
-        receiver_username = await sync_to_async(lambda: connection.receiver.username)()
-        await self.send_group(sender_username, 'request.accept', serialized)
-        await self.send_group(receiver_username, 'request.accept', serialized)
+        await self.send_groups(
+            [serialized['sender']['username'], serialized['receiver']['username']],
+            'request.accept',
+            serialized
+        )
 
 
     async def receive_friend_list(self, data):
         user = self.scope.get('user')
-        # Fix the database query - should get connections where user is either sender or receiver
-        connections = await sync_to_async(lambda: list(
-            Connection.objects.filter(
-                Q(sender=user) | Q(receiver=user),
-                accepted=True
-            ).select_related('sender', 'receiver')
-        ))()
-        
-        # Serialize in thread to avoid sync DB access
-        serialized_data = await sync_to_async(
-            lambda: FriendListSerializer(connections, context={"user": user}, many=True).data
-        )()
-        
+        serialized_data = await data_access.friend_list(user)
+
         # Add online status to each friend
+        online = await get_presence().online(
+            item.get('friend', {}).get('username') for item in serialized_data
+        )
         for item in serialized_data:
             friend_username = item.get('friend', {}).get('username')
-            item['online'] = friend_username in ONLINE_USERS
+            item['online'] = friend_username in online
         # send back to user - pass .data instead of serializer object
         await self.send_group(user.username, 'friend.list', serialized_data)
 
@@ -529,131 +638,102 @@ class ChatConsumer(AsyncWebsocketConsumer):
         connection_id = data.get('connection_id')
         text = data.get('text')
 
-        print(f"Attempting to send message for connection_id: {connection_id}, text: {text}")
-
         try:
-            connection = await sync_to_async(lambda: Connection.objects.filter(id=connection_id).first())()
-            if not connection:
-                print(f"No connection found with id {connection_id}")
+            # Stored as 'delivered' straight away if the other user is online
+            serialized, other_username, duplicate = await data_access.send_message(
+                user, connection_id, text, get_presence().is_online, data.get('client_id')
+            )
+            if not serialized:
+                log.info('no connection with this id', connection_id=connection_id)
                 return
 
-            # Create a new message with status 'sent'
-            message = await sync_to_async(lambda: Message.objects.create(
-                connection=connection,
-                sender=user,
-                text=text,
-                status='sent'
-            ))()
-
-            # Determine who is the other user in this conversation
-            other_user = await sync_to_async(lambda: connection.receiver if connection.sender == user else connection.sender)()
+            # Send to both participants, a resend only back to the sender
+            recipients = [user.username] if duplicate else [user.username, other_username]
+            await self.send_groups(recipients, 'message.send', serialized)
 
+            # Send delivered event to sender only if delivered
+            if serialized['status'] == 'delivered':
+                await self.send_group(user.username, 'message.delivered', {'message_id': serialized['id'], 'status': 'delivered'})
 
-            # Mark as delivered only if receiver is online
-            def mark_delivered_if_online():
-                if message.sender != other_user and message.status == 'sent':
-                    if other_user.username in ONLINE_USERS:
-                        message.status = 'delivered'
-                        message.save()
-                return message
-            delivered_message = await sync_to_async(mark_delivered_if_online)()
-
-            # Serialize in thread to avoid sync DB access
-            serialized = await sync_to_async(lambda: MessageSerializer(delivered_message).data)()
+            writer = writebehind.get_writer()
+            if writer is not None:
+                task = asyncio.create_task(self.ack_saved(serialized))
+                self.save_acks.add(task)
+                task.add_done_callback(self.save_acks.discard)
 
-            # Send to both participants
-            await self.send_group(user.username, 'message.send', serialized)
-            await self.send_group(other_user.username, 'message.send', serialized)
+        except Exception:
+            log.exception('message.send failed', connection_id=connection_id)
 
-            # Send delivered event to sender only if delivered
-            if delivered_message.status == 'delivered':
-                await self.send_group(user.username, 'message.delivered', {'message_id': delivered_message.id, 'status': 'delivered'})
-
-        except Connection.DoesNotExist:
-            print(f"Connection with id {connection_id} does not exist")
-        except Exception as e:
-            print(f"Error sending message: {str(e)}")
+    async def ack_saved(self, serialized):
+        # Write-behind: the sender learns when the message is on disk
+        try:
+            stored = await data_access.message_saved(self.scope.get('user'), serialized)
+        except Exception:
+            log.warning('message not saved', message_id=serialized['id'])
+            return
+        saved = {
+            'message_id': stored['id'],
+            'connection_id': serialized['connection']
+        }
+        if stored is not serialized:
+            # A resend that lost to its first copy: that one stands in for it
+            saved['replaces'] = serialized['id']
+        await self.send_group(self.username, 'message.saved', saved)
 
     async def receive_message_list(self, data):
         user = self.scope.get('user')
         connection_id = data.get('connection_id')
-        next_page = data.get('next')
-        
+        cursor = decode_cursor(data.get('next'))
+        size = page_size(data.get('page_size'))
+
         try:
-            # Get connection
-            connection = await sync_to_async(lambda: Connection.objects.filter(id=connection_id).first())()
-            if not connection:
-                print(f"No connection found with id {connection_id}")
+            result = await data_access.list_messages(
+                user, connection_id, cursor, size, bool(await get_presence().online([user.username]))
+            )
+            if result is None:
+                log.info('no connection with this id', connection_id=connection_id)
                 return
-                
-            # Get and update messages in a single sync_to_async lambda
-            PAGE_SIZE = 20
-            def get_and_update_messages():
-                # If next_page is provided, use it as an offset
-                offset = 0
-                if next_page:
-                    try:
-                        offset = int(next_page)
-                    except Exception:
-                        offset = 0
-                messages = list(Message.objects.filter(connection=connection).order_by('-created')[offset:offset+PAGE_SIZE])
-                delivered_ids = []
-                sender_usernames = []
-                for msg in messages:
-                    if msg.sender != user and msg.status == 'sent':
-                        if user.username in ONLINE_USERS:
-                            msg.status = 'delivered'
-                            msg.save()
-                            delivered_ids.append(msg.id)
-                            sender_usernames.append(msg.sender.username)
-                # Re-fetch after status update
-                messages = list(Message.objects.filter(connection=connection).order_by('-created')[offset:offset+PAGE_SIZE])
-                # Calculate next token
-                total_count = Message.objects.filter(connection=connection).count()
-                next_token = None
-                if offset + PAGE_SIZE < total_count:
-                    next_token = str(offset + PAGE_SIZE)
-                return messages, delivered_ids, sender_usernames, next_token
-
-            messages_list, delivered_ids, sender_usernames, next_token = await sync_to_async(get_and_update_messages)()
-
-            serialized_messages = await sync_to_async(lambda: MessageSerializer(messages_list, many=True).data)()
-            result = {
-                'messages': serialized_messages,
-                'next': next_token
-            }
-            await self.send_group(user.username, 'message.list', result)
+            page, delivered = result
+            await self.send_group(user.username, 'message.list', page)
 
             # Send real-time delivered event to sender(s)
-            for msg_id, sender_username in zip(delivered_ids, sender_usernames):
-                await self.send_group(sender_username, 'message.delivered', {'message_id': msg_id, 'status': 'delivered'})
-            
-        except Exception as e:
-            print(f"Error fetching messages: {str(e)}")
+            await self.send_delivered(delivered)
+
+        except Exception:
+            log.exception('message.list failed', connection_id=connection_id)
+
+    async def receive_sync(self, data):
+        # Changes since the client's cursor, a chunk per frame, to this socket only
+        user = self.scope.get('user')
+        cursor = change_sync.parse_cursor(data.get('cursor'))
+        try:
+            while True:
+                chunk = await data_access.sync(user, cursor)
+                await self.queue_event({'source': 'sync', 'data': chunk})
+                if not chunk['more']:
+                    break
+                cursor = chunk['cursor']
+        except Exception:
+            log.exception('sync failed', cursor=cursor)
 
     async def receive_message_typing(self, data):
         user = self.scope.get('user')
         target_username = data.get('username')
         try:
             # Find connection where user is either sender or receiver and target is the other
-            connection = await sync_to_async(lambda: Connection.objects.filter(
-                (Q(sender=user, receiver__username=target_username) | Q(receiver=user, sender__username=target_username)),
-                accepted=True
-            ).order_by('-id').first())()
-            if not connection:
-                print(f"No active connection found for typing indicator between {user.username} and {target_username}")
+            connection_id = await data_access.typing_connection(user, target_username)
+            if not connection_id:
+                log.debug('typing without a connection', username=user.username, target=target_username)
                 return
 
             # Only send typing indicator to the receiver (not to the sender)
-            receiver = await sync_to_async(lambda: connection.receiver if connection.sender == user else connection.sender)()
-            if receiver.username == target_username:
-                await self.send_group(
-                    receiver.username,
-                    'message.typing',
-                    {
-                        'username': user.username,
-                        'connection_id': connection.id
-                    }
-                )
-        except Exception as e:
-            print(f"Error in typing indicator: {str(e)}")
\ No newline at end of file
+            await self.send_group(
+                target_username,
+                'message.typing',
+                {
+                    'username': user.username,
+                    'connection_id': connection_id
+                }
+            )
+        except Exception:
+            log.exception('message.typing failed', target=target_username)
@@ -0,0 +1,323 @@
+"""
+Async data access for the consumers.
+
+Every function here is one thread hop: the ORM work and serialization of an
+action run together on the DB executor pool routed for that action (see
+main/executor.py), instead of a chain of sync_to_async calls per handler.
+Django's own async ORM methods (aget, acreate, ...) are sync_to_async
+wrappers around the single thread-sensitive thread, so they are not used
+here; they would funnel everything back onto one thread.
+
+Who is in a connection and who is friends with whom comes from the social
+graph cache (main/graph.py), so authorizing and routing the hot actions
+takes no query once the cache is warm.
+"""
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.db.models import Q
+
+from . import payloads, search, sync as change_sync, thumbnails, writebehind
+from .dedup import clean_client_id, recent_sends
+from .executor import db_sync_to_async
+from .graph import graph
+from .models import User, Connection, Message
+from .pagination import encode_cursor, not_newer_than, older_than
+from .serializer import ProfileSerializer, SearchSerializer
+
+
+async def user_connection(user, connection_id, action=None):
+    # ConnectionInfo of the connection if `user` is one of its two participants
+    try:
+        connection_id = int(connection_id)
+    except (TypeError, ValueError):
+        return None
+    info = graph.connection(connection_id)
+    if info is None:
+        info = await db_sync_to_async(graph.load_connection, action)(connection_id)
+    if info is None or not info.has(user):
+        return None
+    return info
+
+
+async def friends_of(username, action=None):
+    # {friend username: connection id}
+    friends = graph.friends(username)
+    if friends is None:
+        friends = await db_sync_to_async(graph.load_friends, action)(username)
+    return friends
+
+
+async def get_user(username, action=None):
+    def fetch():
+        return User.objects.filter(username=username).first()
+    return await db_sync_to_async(fetch, action)()
+
+
+async def friend_usernames(username):
+    return set(await friends_of(username, 'presence.watch'))
+
+
+async def mark_delivered_for(user):
+    await writebehind.settled()
+    return await db_sync_to_async(Message.objects.mark_delivered_for, 'connect')(user)
+
+
+async def search_users(user, query, limit=search.DEFAULT_LIMIT, offset=0):
+    def fetch():
+        ids = search.search_user_ids(query, exclude_id=user.pk, limit=limit, offset=offset)
+        if not ids:
+            return []
+        found = User.objects.in_bulk(ids)
+        users = [found[pk] for pk in ids if pk in found]
+        # Connection status for just this page, in one query
+        pending_them, pending_me, connected = set(), set(), set()
+        for sender_id, receiver_id, accepted in Connection.objects.filter(
+            Q(sender=user, receiver_id__in=ids) | Q(receiver=user, sender_id__in=ids)
+        ).values_list('sender_id', 'receiver_id', 'accepted'):
+            if accepted:
+                connected.add(receiver_id if sender_id == user.pk else sender_id)
+            elif sender_id == user.pk:
+                pending_them.add(receiver_id)
+            else:
+                pending_me.add(sender_id)
+        for found_user in users:
+            found_user.pending_them = found_user.pk in pending_them
+            found_user.pending_me = found_user.pk in pending_me
+            found_user.connected = found_user.pk in connected
+        return SearchSerializer(users, many=True).data
+    return await db_sync_to_async(fetch, 'search')()
+
+
+async def save_thumbnail(user, image_str):
+    # Decode and resize off the event loop; the variants are rendered by the thumbnail process pool
+    def save():
+        thumbnails.store_base64_thumbnail(user, image_str)
+        return ProfileSerializer(user).data
+    return await db_sync_to_async(save, 'thumbnail')()
+
+
+async def request_connect(user, username):
+    # Returns the serialized request, or None if the receiver does not exist
+    def connect():
+        receiver = User.objects.filter(username=username).first()
+        if not receiver:
+            return None
+        connection, _ = Connection.objects.get_or_create(sender=user, receiver=receiver)
+        return payloads.request(connection)
+    return await db_sync_to_async(connect, 'request.connect')()
+
+
+async def request_list(user):
+    def fetch():
+        return payloads.requests(Connection.objects.filter(
+            Q(receiver=user) | Q(sender=user),
+            accepted=False
+        ))
+    return await db_sync_to_async(fetch, 'request.list')()
+
+
+async def request_accept(user, username):
+    def accept():
+        # get the latest request from `username`
+        connection = Connection.objects.filter(
+            sender__username=username,
+            receiver=user
+        ).order_by('-id').first()
+        if not connection:
+            return None
+        connection.accepted = True
+        connection.save()
+        return payloads.request(connection)
+    return await db_sync_to_async(accept, 'request.accept')()
+
+
+async def friend_list(user):
+    await writebehind.settled()
+
+    def fetch():
+        return payloads.friends(Connection.objects.filter(
+            Q(sender=user) | Q(receiver=user),
+            accepted=True
+        ), user)
+    return await db_sync_to_async(fetch, 'friend.list')()
+
+
+async def send_message(user, connection_id, text, is_online, client_id=None):
+    """
+    Store a message and return (serialized message, other username,
+    duplicate), or (None, None, False) if the connection is not the user's.
+    `is_online(username)` decides whether it is delivered straight away.
+    With a `client_id` the user already sent in this connection, nothing is
+    stored: the first message comes back with duplicate set (see main/dedup.py).
+    """
+    info = await user_connection(user, connection_id, 'message.send')
+    if not info:
+        return None, None, False
+    _, other_username = info.other(user)
+    client_id = clean_client_id(client_id)
+    key = (info.id, user.pk, client_id)
+    if client_id is not None:
+        sent = recent_sends.get(key)
+        if sent is not None:
+            return sent, other_username, True
+    writer = writebehind.get_writer()
+
+    def stored():
+        rows = list(Message.objects.filter(
+            connection_id=info.id, sender=user, client_id=client_id
+        ).values_list(*payloads.MESSAGE_COLUMNS))
+        return payloads.messages(rows)[0] if rows else None
+
+    def send():
+        status = 'delivered' if is_online(other_username) else 'sent'
+        if writer is not None:
+            if client_id is not None:
+                # Sent before this worker's window, or to another worker
+                existing = stored()
+                if existing is not None:
+                    return recent_sends.add(key, existing), True
+            # Fanned out now, stored by the next group commit
+            message = Message(
+                id=writer.ids.take(), connection=info.instance(), sender=user, text=text,
+                status=status, created=timezone.now(), client_id=client_id
+            )
+            payload = payloads.message(message)
+            if client_id is not None:
+                standing = recent_sends.add(key, payload)
+                if standing is not payload:
+                    return standing, True
+            writer.add(message)
+            return payload, False
+        try:
+            with transaction.atomic():
+                message = Message.objects.create(
+                    connection=info.instance(), sender=user, text=text, status=status, client_id=client_id
+                )
+                Connection.record_message(message)
+        except IntegrityError:
+            existing = stored() if client_id is not None else None
+            if existing is None:
+                raise
+            return recent_sends.add(key, existing), True
+        payload = payloads.message(message)
+        if client_id is not None:
+            recent_sends.add(key, payload)
+        return payload, False
+    serialized, duplicate = await db_sync_to_async(send, 'message.send')()
+    if writer is not None and not duplicate and writer.busy():
+        # Too much in memory already: this sender waits for the commit
+        first = await message_saved(user, serialized)
+        if first is not serialized:
+            return first, other_username, True
+    return serialized, other_username, duplicate
+
+
+async def message_saved(user, serialized):
+    """
+    Wait for the write-behind writer to commit a message `user` sent and
+    return its payload as stored: `serialized` itself, or for a resend whose
+    first copy was still queued on another worker, that first copy.
+    """
+    message_id = await writebehind.get_writer().saved(serialized['id'])
+    if message_id == serialized['id']:
+        return serialized
+
+    def fetch():
+        rows = list(Message.objects.filter(id=message_id).values_list(*payloads.MESSAGE_COLUMNS))
+        first = payloads.messages(rows)[0]
+        # Later resends to this worker get the stored copy too
+        recent_sends.replace((first['connection'], user.pk, first['client_id']), first)
+        return first
+    return await db_sync_to_async(fetch, 'message.send')()
+
+
+async def sync(user, cursor, limit=change_sync.CHUNK):
+    # One sync frame: what changed for `user` after `cursor` (see main/sync.py)
+    await writebehind.settled()
+    return await db_sync_to_async(change_sync.changes_since, 'sync')(user, cursor, limit)
+
+
+async def list_messages(user, connection_id, cursor, size, mark_delivered):
+    """
+    One page of history, newest first. Returns (page, delivered) where
+    delivered holds (message id, sender username) for messages flipped from
+    'sent' to 'delivered' by this read, or None if the connection is not the user's.
+    """
+    info = await user_connection(user, connection_id, 'message.list')
+    if not info:
+        return None
+    await writebehind.settled()
+
+    def fetch():
+        messages = Message.objects.filter(connection_id=info.id)
+        if cursor:
+            messages = messages.filter(older_than(cursor))
+        # One extra row tells us whether there is another page
+        rows = list(messages.order_by('-created', '-id').values_list(*payloads.MESSAGE_COLUMNS)[:size + 1])
+        next_token = None
+        if len(rows) > size:
+            rows = rows[:size]
+            next_token = encode_cursor(rows[-1][4], rows[-1][0])
+        page = payloads.messages(rows)
+        delivered = []
+        if mark_delivered:
+            pending = [payload for row, payload in zip(rows, page) if row[2] != user.id and row[5] == 'sent']
+            if pending:
+                Message.objects.filter(id__in=[payload['id'] for payload in pending], status='sent').update(status='delivered')
+                for payload in pending:
+                    payload['status'] = 'delivered'
+                    delivered.append((payload['id'], payload['sender']['username']))
+        page = {
+            'messages': page,
+            'next': next_token
+        }
+        return page, delivered
+    return await db_sync_to_async(fetch, 'message.list')()
+
+
+async def mark_read(user, message_id):
+    # Returns the sender's username if the message was newly read by `user`
+    await writebehind.settled()
+
+    def mark():
+        message = Message.objects.filter(id=message_id).select_related('sender').first()
+        if not message or message.status == 'read':
+            return None
+        # Only the other participant of the conversation can mark it as read
+        info = graph.connection(message.connection_id) or graph.load_connection(message.connection_id)
+        if info is None or not info.has(user) or message.sender_id == user.id:
+            return None
+        with transaction.atomic():
+            message.status = 'read'
+            message.save(update_fields=['status'])
+            Connection.record_read(message.connection_id, user, 1)
+        return message.sender.username
+    return await db_sync_to_async(mark, 'message.read')()
+
+
+async def mark_read_up_to(user, connection_id, up_to):
+    # Returns (peer username, number of messages newly read)
+    info = await user_connection(user, connection_id, 'message.read')
+    if not info:
+        return None, 0
+    await writebehind.settled()
+
+    def mark():
+        # Everything up to the watermark in history order, (created, id)
+        watermark = Message.objects.filter(connection_id=info.id, id=up_to).values_list('created', 'id').first()
+        if watermark is None:
+            return info.other(user)[1], 0
+        with transaction.atomic():
+            count = Message.objects.filter(
+                not_newer_than(watermark),
+                connection_id=info.id
+            ).exclude(sender=user).exclude(status='read').update(status='read')
+            Connection.record_read(info.id, user, count)
+        return info.other(user)[1], count
+    return await db_sync_to_async(mark, 'message.read')()
+
+
+async def typing_connection(user, target_username):
+    # Id of the accepted connection between `user` and `target_username`, if any
+    friends = await friends_of(user.username, 'message.typing')
+    return friends.get(target_username)
@@ -0,0 +1,87 @@
+"""
+Idempotent message.send.
+
+A client may put a `client_id` (any string of up to 64 characters, unique
+among its own sends in the conversation) on message.send and send the same
+frame again after a reconnect. The message is stored once: the database
+holds one row per (connection, sender, client_id), and a resend gets back the
+message created the first time instead of a new one.
+
+Each worker remembers the payloads of recent sends with a client id in an LRU
+of RECENT_SENDS['SIZE'] entries kept for RECENT_SENDS['TTL'] seconds, so a
+resend that reaches the same worker, the usual case after a quick reconnect,
+is answered without a query. Older or cross-worker resends fall through to
+the unique constraint. With write-behind, a resend that reaches another worker
+before the first copy is committed is fanned out again and dropped by the
+writer; its sender then hears the first copy's id in `message.saved`.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+CLIENT_ID_MAX = 64
+
+
+def clean_client_id(value):
+    # The client id to dedupe on, or None if there is no usable one
+    if isinstance(value, str) and 0 < len(value) <= CLIENT_ID_MAX:
+        return value
+    return None
+
+
+class RecentSends:
+    def __init__(self, size=20000, ttl=600):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+
+    def get(self, key):
+        # Payload sent for key (connection id, sender id, client id), or None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def add(self, key, payload):
+        """
+        Remember `payload` for `key` unless a live one is there already.
+        Returns the payload that stands, so two concurrent sends of the same
+        message agree on one.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] >= now:
+                self.hits += 1
+                return entry[0]
+            self._put(key, payload, now)
+            return payload
+
+    def replace(self, key, payload):
+        # Remember `payload` for `key` over whatever is there
+        with self._lock:
+            self._put(key, payload, time.monotonic())
+
+    def _put(self, key, payload, now):
+        self._entries[key] = (payload, now + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_config = getattr(settings, 'RECENT_SENDS', {})
+recent_sends = RecentSends(size=_config.get('SIZE', 20000), ttl=_config.get('TTL', 600))
@@ -0,0 +1,173 @@
+"""
+Database executors for the consumers.
+
+sync_to_async(thread_sensitive=True) runs all ORM work of the process on one
+shared thread, so a slow search stalls every socket's message sends. Here
+each pool is a bounded ThreadPoolExecutor whose threads hold their own
+database connections, and actions are routed to pools in settings:
+
+    DB_EXECUTORS = {
+        'default': {'WORKERS': 8},
+        'heavy': {'WORKERS': 2},
+    }
+    DB_EXECUTOR_ROUTES = {'search': 'heavy', 'message.list': 'heavy'}
+
+Unrouted actions use 'default'.
+
+While `query_counts.enabled` is set (replay and benchmarks), the SQL queries
+each call runs are counted per action. With metrics on, every call is timed
+and its queries counted and timed for /metrics.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+from django.db import connection
+
+from . import metrics
+
+
+class DatabaseExecutor:
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'db-{name}')
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.max_queued = 0
+
+    def wrap(self, func, action=None):
+        def tracked(picked, *args, **kwargs):
+            with self._lock:
+                # A call cancelled while queued was already taken off by its caller
+                if not picked[0]:
+                    picked[0] = True
+                    self.queued -= 1
+                self.running += 1
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.completed += 1
+
+        runner = DatabaseSyncToAsync(tracked, thread_sensitive=False, executor=self.pool)
+
+        label = action or 'default'
+
+        async def call(*args, **kwargs):
+            # Counted as queued until a pool thread picks it up
+            picked = [False]
+            with self._lock:
+                self.queued += 1
+                self.max_queued = max(self.max_queued, self.queued)
+            start = time.perf_counter()
+            try:
+                return await runner(picked, *args, **kwargs)
+            finally:
+                with self._lock:
+                    # Cancelled (a superseded search, a closed socket) before a thread picked it up
+                    if not picked[0]:
+                        picked[0] = True
+                        self.queued -= 1
+                if metrics.enabled:
+                    metrics.db_call_seconds.observe(time.perf_counter() - start, label)
+
+        return call
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'queued': self.queued,
+                'running': self.running,
+                'completed': self.completed,
+                'max_queued': self.max_queued,
+            }
+
+
+class QueryCounts:
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # action -> [calls, queries]
+            self.totals = {}
+
+    def add(self, action, queries):
+        with self._lock:
+            totals = self.totals.setdefault(action, [0, 0])
+            totals[0] += 1
+            totals[1] += queries
+
+    def per_call(self):
+        with self._lock:
+            return {action: queries / calls for action, (calls, queries) in self.totals.items()}
+
+
+query_counts = QueryCounts()
+
+
+def _counted(func, action):
+    label = action or 'default'
+
+    def run(*args, **kwargs):
+        if not (query_counts.enabled or metrics.enabled):
+            return func(*args, **kwargs)
+        # queries, seconds
+        totals = [0, 0.0]
+
+        def counter(execute, sql, params, many, context):
+            start = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                totals[0] += 1
+                totals[1] += time.perf_counter() - start
+
+        try:
+            with connection.execute_wrapper(counter):
+                return func(*args, **kwargs)
+        finally:
+            if query_counts.enabled:
+                query_counts.add(label, totals[0])
+            if metrics.enabled and totals[0]:
+                metrics.db_queries.inc(label, amount=totals[0])
+                metrics.db_query_seconds.inc(label, amount=totals[1])
+    return run
+
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(action=None):
+    routes = getattr(settings, 'DB_EXECUTOR_ROUTES', {})
+    name = routes.get(action, 'default')
+    executor = _executors.get(name)
+    if executor is None:
+        with _executors_lock:
+            executor = _executors.get(name)
+            if executor is None:
+                config = getattr(settings, 'DB_EXECUTORS', {}).get(name, {})
+                executor = _executors[name] = DatabaseExecutor(name, config.get('WORKERS', 4))
+    return executor
+
+
+def db_sync_to_async(func, action=None):
+    """
+    Drop-in for sync_to_async(func) that runs on the pool routed for `action`:
+        users = await db_sync_to_async(get_users, 'search')()
+    """
+    return get_executor(action).wrap(_counted(func, action), action)
+
+
+def executor_stats():
+    return {name: executor.stats() for name, executor in list(_executors.items())}
@@ -0,0 +1,78 @@
+"""
+Multi-recipient sends on the channel layer.
+
+`group_send_many` delivers one message to many groups without awaiting a
+layer round trip per group:
+
+- a layer that has its own `group_send_many` is used as is;
+- the in-memory layer gets each distinct channel of all the groups resolved
+  up front and the message queued once per channel. That reads the layer's
+  private `groups` table and `_clean_expired()`, as of Channels 4.3 (pinned
+  in requirements.txt); a layer without them is sent to group by group;
+- any other layer (e.g. channels_redis) gets its group_send calls issued
+  concurrently, at most FANOUT['CONCURRENCY'] in flight, which lets it
+  pipeline them over its connection pool.
+"""
+import asyncio
+
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer
+from django.conf import settings
+
+CONCURRENCY = getattr(settings, 'FANOUT', {}).get('CONCURRENCY', 100)
+
+
+def _in_memory_internals(layer):
+    # What _send_in_memory relies on, still there after a Channels upgrade
+    return callable(getattr(layer, '_clean_expired', None)) and isinstance(getattr(layer, 'groups', None), dict)
+
+
+async def _send_in_memory(layer, groups, message):
+    layer._clean_expired()
+    channels = {}
+    for group in groups:
+        layer.require_valid_group_name(group)
+        channels.update(dict.fromkeys(layer.groups.get(group, ())))
+    for channel in channels:
+        try:
+            await layer.send(channel, message)
+        except ChannelFull:
+            pass
+
+
+async def group_send_each(layer, sends):
+    """
+    Send a list of (group, message) pairs concurrently.
+    """
+    sends = list(sends)
+    if not sends:
+        return
+    if len(sends) == 1:
+        await layer.group_send(*sends[0])
+        return
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def send(group, message):
+        async with semaphore:
+            await layer.group_send(group, message)
+
+    results = await asyncio.gather(*(send(group, message) for group, message in sends), return_exceptions=True)
+    errors = [result for result in results if isinstance(result, Exception)]
+    if errors:
+        raise errors[0]
+
+
+async def group_send_many(layer, groups, message):
+    """
+    Send `message` to every group in `groups` (duplicates are sent once).
+    """
+    groups = list(dict.fromkeys(groups))
+    if not groups:
+        return
+    native = getattr(layer, 'group_send_many', None)
+    if native is not None:
+        await native(groups, message)
+    elif isinstance(layer, InMemoryChannelLayer) and _in_memory_internals(layer):
+        await _send_in_memory(layer, groups, message)
+    else:
+        await group_send_each(layer, ((group, message) for group in groups))
@@ -0,0 +1,133 @@
+"""
+Process-wide cache of the social graph for ChatConsumer.
+
+Two kinds of entries share one LRU of GRAPH['SIZE'] entries:
+
+- a connection id -> its two participants and whether it is accepted,
+  which authorizes and routes message.send, message.list and message.read;
+- a username -> {friend username: connection id} over accepted
+  connections, which answers message.typing and presence.watch.
+
+Misses are loaded from the database on the DB executor; hits need no query
+and no thread hop. Entries expire after GRAPH['TTL'] seconds. A user's
+entry, and the connection's, are dropped when one of their requests is made
+or accepted. The consumers invalidate on the request.connect/request.accept
+events they relay, so every worker with a socket of either user hears about
+it; the Connection signals cover changes made outside the consumers.
+Connections that do not exist are not cached, so a new one is seen at once.
+"""
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.db.models import Q
+
+from .models import Connection
+
+
+class ConnectionInfo(namedtuple('ConnectionInfo', 'id sender_id sender receiver_id receiver accepted')):
+    __slots__ = ()
+
+    def has(self, user):
+        return user.pk in (self.sender_id, self.receiver_id)
+
+    def other(self, user):
+        # (id, username) of the participant that is not `user`
+        if user.pk == self.sender_id:
+            return self.receiver_id, self.receiver
+        return self.sender_id, self.sender
+
+    def instance(self):
+        # Unsaved stand-in carrying the ids, enough to create messages against
+        return Connection(id=self.id, sender_id=self.sender_id, receiver_id=self.receiver_id, accepted=self.accepted)
+
+
+class SocialGraph:
+    def __init__(self, size=50000, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped by every invalidation, so a load that raced one is not stored
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def _put(self, key, value, generation):
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def connection(self, connection_id):
+        # Cached ConnectionInfo, or None on a miss
+        return self._get(('c', connection_id))
+
+    def friends(self, username):
+        # Cached {friend username: connection id}, or None on a miss
+        return self._get(('u', username))
+
+    def load_connection(self, connection_id):
+        """
+        Read a connection from the database into the cache. Returns its
+        ConnectionInfo, or None if there is no such connection.
+        """
+        generation = self._generation
+        row = Connection.objects.filter(id=connection_id).values_list(
+            'id', 'sender_id', 'sender__username', 'receiver_id', 'receiver__username', 'accepted'
+        ).first()
+        if row is None:
+            return None
+        info = ConnectionInfo(*row)
+        self._put(('c', info.id), info, generation)
+        return info
+
+    def load_friends(self, username):
+        generation = self._generation
+        friends = {}
+        for connection_id, sender, receiver in Connection.objects.filter(
+            Q(sender__username=username) | Q(receiver__username=username),
+            accepted=True
+        ).order_by('id').values_list('id', 'sender__username', 'receiver__username'):
+            friends[receiver if sender == username else sender] = connection_id
+        self._put(('u', username), friends, generation)
+        return friends
+
+    def invalidate(self, usernames=(), connection_ids=()):
+        """
+        Drop the friend lists of `usernames` and the given connections.
+        """
+        with self._lock:
+            self._generation += 1
+            for username in usernames:
+                self._entries.pop(('u', username), None)
+            for connection_id in connection_ids:
+                self._entries.pop(('c', connection_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_config = getattr(settings, 'GRAPH', {})
+graph = SocialGraph(size=_config.get('SIZE', 50000), ttl=_config.get('TTL', 300))
@@ -0,0 +1,488 @@
+"""
+WebSocket load generator for ChatConsumer and VideoCallConsumer.
+
+Simulated users sign in with the same JWT the API hands out
+(get_authenticated_user_data), open a chat socket and a video socket through
+the full ASGI stack, and run a weighted mix of actions with random think
+time in between. Each action is timed from the request frame to the frame
+that completes it:
+
+    message.send    until the sender gets its own message back
+    message.list    until the page arrives
+    message.typing  until the friend's socket shows the indicator
+    search          until results arrive (includes the server side debounce)
+    friend.list     until the list arrives
+    video.setup     call, accept, offer/answer and trickle ICE both ways
+
+Two transports are available: 'communicator' drives core.asgi.application
+in this process through channels.testing.WebsocketCommunicator, 'server'
+starts Daphne in a child process and connects over real sockets.
+Use the bench_load command to run it against a throwaway database.
+"""
+import asyncio
+import base64
+import functools
+import io
+import json
+import os
+import random
+import struct
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+
+from django.core.management import call_command
+from django.db import connections
+
+from . import payloads, search
+from .benchmarks import summarize
+from .dedup import recent_sends
+from .graph import graph
+from .models import User, Connection, Message
+from .views import get_authenticated_user_data
+
+DEFAULT_MIX = {
+    'message.send': 35,
+    'message.typing': 25,
+    'message.list': 15,
+    'friend.list': 10,
+    'search': 10,
+    'video.setup': 5,
+}
+TIMEOUT = 10
+CANDIDATES = 3
+
+
+def seed(users=50, friends=4, history=20):
+    """
+    Create `users` users, each connected to the next `friends` users, with
+    `history` messages per connection. Returns the usernames.
+    """
+    User.objects.bulk_create(
+        User(username=f'load{i}', first_name=f'Load{i}', last_name='User')
+        for i in range(users)
+    )
+    by_name = {user.username: user for user in User.objects.filter(username__startswith='load')}
+    pairs = {
+        tuple(sorted((i, (i + step) % users)))
+        for i in range(users) for step in range(1, friends + 1)
+        if (i + step) % users != i
+    }
+    Connection.objects.bulk_create(
+        Connection(sender=by_name[f'load{a}'], receiver=by_name[f'load{b}'], accepted=True)
+        for a, b in sorted(pairs)
+    )
+    Message.objects.bulk_create(
+        Message(connection=connection, sender=connection.sender, text=f'seed {n}', status='read')
+        for connection in Connection.objects.filter(sender__username__startswith='load')
+        for n in range(history)
+    )
+    # bulk_create skips the signals that keep these in step
+    search.rebuild()
+    graph.clear()
+    payloads.cards.clear()
+    recent_sends.clear()
+    call_command('rebuild_connection_stats', stdout=io.StringIO())
+    return sorted(by_name, key=lambda name: int(name[4:]))
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+
+    def record(self, action, elapsed):
+        self.samples.setdefault(action, []).append(elapsed)
+
+    def error(self, action):
+        self.errors[action] = self.errors.get(action, 0) + 1
+
+    def report(self, duration):
+        actions = {}
+        for action in sorted(set(self.samples) | set(self.errors)):
+            samples = self.samples.get(action, [])
+            actions[action] = {
+                **summarize(samples),
+                'errors': self.errors.get(action, 0),
+                'throughput_per_s': len(samples) / duration,
+                'mean_ms': sum(samples) / len(samples) * 1000 if samples else 0.0,
+            }
+        everything = [sample for samples in self.samples.values() for sample in samples]
+        return {
+            'actions': actions,
+            'total': {
+                **summarize(everything),
+                'errors': sum(self.errors.values()),
+                'throughput_per_s': len(everything) / duration,
+            },
+        }
+
+
+class CommunicatorSocket:
+    def __init__(self, application, path):
+        from channels.testing import WebsocketCommunicator
+
+        self.communicator = WebsocketCommunicator(application, path, headers=[(b'origin', b'http://localhost')])
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect(timeout=TIMEOUT)
+        return connected
+
+    async def send(self, payload):
+        await self.communicator.send_to(text_data=json.dumps(payload))
+
+    async def receive(self):
+        # A timeout here would cancel the consumer, so wait as long as it takes
+        message = await self.communicator.receive_output(timeout=24 * 60 * 60)
+        if message['type'] == 'websocket.close':
+            return None
+        return message.get('text') or message.get('bytes')
+
+    async def close(self):
+        await self.communicator.disconnect(timeout=TIMEOUT)
+
+
+class ServerSocket:
+    """
+    Minimal RFC 6455 client on asyncio streams, enough to talk to Daphne.
+    (autobahn's asyncio client cannot be loaded next to Daphne's Twisted one.)
+    """
+
+    def __init__(self, url):
+        self.url = urlsplit(url)
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.url.hostname, self.url.port), TIMEOUT
+        )
+        key = base64.b64encode(os.urandom(16)).decode()
+        path = self.url.path + (f'?{self.url.query}' if self.url.query else '')
+        self.writer.write((
+            f'GET {path} HTTP/1.1\r\n'
+            f'Host: {self.url.hostname}:{self.url.port}\r\n'
+            'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+            f'Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n'
+            'Origin: http://localhost\r\n\r\n'
+        ).encode())
+        response = await asyncio.wait_for(self.reader.readuntil(b'\r\n\r\n'), TIMEOUT)
+        return response.split(b' ', 2)[1] == b'101'
+
+    def _write(self, opcode, payload):
+        header = bytes([0x80 | opcode])
+        length = len(payload)
+        if length < 126:
+            header += bytes([0x80 | length])
+        elif length < 1 << 16:
+            header += bytes([0x80 | 126]) + struct.pack('!H', length)
+        else:
+            header += bytes([0x80 | 127]) + struct.pack('!Q', length)
+        mask = os.urandom(4)
+        self.writer.write(header + mask + bytes(b ^ mask[i % 4] for i, b in enumerate(payload)))
+
+    async def send(self, payload):
+        self._write(0x1, json.dumps(payload).encode())
+
+    async def receive(self):
+        message = b''
+        while True:
+            try:
+                first, second = await self.reader.readexactly(2)
+                length = second & 0x7f
+                if length == 126:
+                    length, = struct.unpack('!H', await self.reader.readexactly(2))
+                elif length == 127:
+                    length, = struct.unpack('!Q', await self.reader.readexactly(8))
+                payload = await self.reader.readexactly(length)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return None
+            opcode = first & 0x0f
+            if opcode == 0x8:
+                return None
+            if opcode == 0x9:
+                self._write(0xa, payload)
+                continue
+            if opcode in (0x1, 0x2):
+                kind = opcode
+            if opcode in (0x0, 0x1, 0x2):
+                message += payload
+                if first & 0x80:
+                    return message.decode() if kind == 0x1 else message
+
+    async def close(self):
+        try:
+            self._write(0x8, struct.pack('!H', 1000))
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+        self.writer.close()
+
+
+class Client:
+    """
+    One socket plus a reader that hands incoming events to whoever waits for them.
+    """
+
+    def __init__(self, socket, on_event=None):
+        self.socket = socket
+        self.on_event = on_event
+        self.waiters = []
+
+    async def start(self):
+        if not await self.socket.connect():
+            raise ConnectionError('WebSocket connection refused')
+        self.reader = asyncio.create_task(self.read())
+
+    async def read(self):
+        while True:
+            frame = await self.socket.receive()
+            if frame is None:
+                return
+            frame = json.loads(frame)
+            events = frame['data'] if frame.get('source') == 'batch' else [frame]
+            for event in events:
+                for waiter in list(self.waiters):
+                    matches, future = waiter
+                    if future.done():
+                        self.waiters.remove(waiter)
+                    elif matches(event):
+                        future.set_result(event)
+                        self.waiters.remove(waiter)
+                        break
+                if self.on_event is not None:
+                    await self.on_event(event)
+
+    def expect(self, matches):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((matches, future))
+        return future
+
+    async def close(self):
+        await self.socket.close()
+        self.reader.cancel()
+
+
+class SimUser:
+    def __init__(self, username, token, friends, rng, recorder):
+        self.username = username
+        self.token = token
+        # [(connection id, friend username)]
+        self.friends = friends
+        self.rng = rng
+        self.recorder = recorder
+
+    async def start(self, open_socket):
+        query = f'?token={self.token}&batch=1'
+        self.chat = Client(open_socket(f'/chat/{query}'))
+        self.video = Client(open_socket(f'/ws/video/{query}'), self.on_video)
+        await self.chat.start()
+        await self.video.start()
+
+    async def close(self):
+        await self.chat.close()
+        await self.video.close()
+
+    async def on_video(self, event):
+        # Play the callee: pick up and answer straight away
+        action, peer = event.get('action'), event.get('caller') or event.get('sender')
+        if action == 'call':
+            await self.video.socket.send({'action': 'accept', 'recipient': peer})
+        elif action == 'offer':
+            await self.video.socket.send({'action': 'answer', 'answer': {'type': 'answer', 'sdp': 'load'}, 'recipient': peer})
+            for n in range(CANDIDATES):
+                await self.video.socket.send({'action': 'candidate', 'candidate': {'candidate': f'load {n}'}, 'recipient': peer})
+
+    async def timed(self, action, future, send):
+        start = time.perf_counter()
+        await send
+        try:
+            result = await asyncio.wait_for(future, TIMEOUT)
+        except asyncio.TimeoutError:
+            self.recorder.error(action)
+            return None
+        self.recorder.record(action, time.perf_counter() - start)
+        return result
+
+    async def message_send(self, users):
+        connection_id, _ = self.rng.choice(self.friends)
+        text = f'load {self.username} {self.rng.random()}'
+        await self.timed('message.send', self.chat.expect(
+            lambda e: e.get('source') == 'message.send' and e['data'].get('text') == text
+        ), self.chat.socket.send({'source': 'message.send', 'connection_id': connection_id, 'text': text}))
+
+    async def message_list(self, users):
+        connection_id, _ = self.rng.choice(self.friends)
+        await self.timed('message.list', self.chat.expect(
+            lambda e: e.get('source') == 'message.list'
+        ), self.chat.socket.send({'source': 'message.list', 'connection_id': connection_id}))
+
+    async def message_typing(self, users):
+        _, friend = self.rng.choice(self.friends)
+        await self.timed('message.typing', users[friend].chat.expect(
+            lambda e: e.get('source') == 'message.typing' and e['data'].get('username') == self.username
+        ), self.chat.socket.send({'source': 'message.typing', 'username': friend}))
+
+    async def search(self, users):
+        query = self.rng.choice(list(users))[:self.rng.randint(2, 6)]
+        await self.timed('search', self.chat.expect(
+            lambda e: e.get('source') == 'search'
+        ), self.chat.socket.send({'source': 'search', 'query': query}))
+
+    async def friend_list(self, users):
+        await self.timed('friend.list', self.chat.expect(
+            lambda e: e.get('source') == 'friend.list'
+        ), self.chat.socket.send({'source': 'friend.list'}))
+
+    async def video_setup(self, users):
+        _, friend = self.rng.choice(self.friends)
+        start = time.perf_counter()
+        answered = self.video.expect(lambda e: e.get('action') in ('accept', 'busy'))
+        await self.video.socket.send({'action': 'call', 'recipient': friend})
+        try:
+            reply = await asyncio.wait_for(answered, TIMEOUT)
+            if reply['action'] == 'busy':
+                # The friend is in another call; a valid outcome, timed on its own
+                self.recorder.record('video.busy', time.perf_counter() - start)
+                return
+            received = []
+
+            def candidates(event):
+                if event.get('sender') != friend:
+                    return False
+                if event.get('action') == 'candidate':
+                    received.append(event['candidate'])
+                elif event.get('action') == 'candidates':
+                    received.extend(event['candidates'])
+                return len(received) >= CANDIDATES
+
+            answer = self.video.expect(lambda e: e.get('action') == 'answer' and e.get('sender') == friend)
+            gathered = self.video.expect(candidates)
+            await self.video.socket.send({'action': 'offer', 'offer': {'type': 'offer', 'sdp': 'load'}, 'recipient': friend})
+            for n in range(CANDIDATES):
+                await self.video.socket.send({'action': 'candidate', 'candidate': {'candidate': f'load {n}'}, 'recipient': friend})
+            await asyncio.wait_for(asyncio.gather(answer, gathered), TIMEOUT)
+        except asyncio.TimeoutError:
+            self.recorder.error('video.setup')
+        else:
+            self.recorder.record('video.setup', time.perf_counter() - start)
+        finally:
+            await self.video.socket.send({'action': 'end-call', 'recipient': friend})
+
+    async def run(self, users, mix, think, deadline):
+        actions = {
+            'message.send': self.message_send,
+            'message.list': self.message_list,
+            'message.typing': self.message_typing,
+            'search': self.search,
+            'friend.list': self.friend_list,
+            'video.setup': self.video_setup,
+        }
+        names = list(mix)
+        weights = [mix[name] for name in names]
+        while time.monotonic() < deadline:
+            await asyncio.sleep(self.rng.expovariate(1 / think) if think else 0)
+            action = self.rng.choices(names, weights)[0]
+            await actions[action](users)
+
+
+def _use_database(name):
+    # Runs in the server process: point it at the benchmark database
+    from django.conf import settings
+
+    settings.DATABASES['default']['NAME'] = name
+    connections['default'].settings_dict['NAME'] = name
+
+
+def _application():
+    from channels.routing import get_default_application
+
+    return get_default_application()
+
+
+class Server:
+    """
+    Daphne serving core.asgi.application in a child process.
+    """
+
+    def __init__(self, host='localhost'):
+        self.host = host
+
+    def __enter__(self):
+        from daphne.testing import DaphneProcess
+
+        # The child must open its own database connections
+        connections.close_all()
+        self.process = DaphneProcess(
+            self.host, _application,
+            setup=functools.partial(_use_database, connections['default'].settings_dict['NAME'])
+        )
+        self.process.start()
+        while not self.process.ready.wait(timeout=1):
+            if not self.process.is_alive():
+                raise RuntimeError('Server stopped')
+        self.url = f'ws://{self.host}:{self.process.port.value}'
+        return self
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        self.process.join()
+
+
+def _credentials(usernames):
+    # (username, access token, [(connection id, friend username)]) per user, read before going async
+    friends = {username: [] for username in usernames}
+    for connection_id, sender, receiver in Connection.objects.filter(
+        sender__username__in=usernames, accepted=True
+    ).values_list('id', 'sender__username', 'receiver__username'):
+        friends[sender].append((connection_id, receiver))
+        if receiver in friends:
+            friends[receiver].append((connection_id, sender))
+    users = User.objects.in_bulk(usernames, field_name='username')
+    return [
+        (username, get_authenticated_user_data(users[username])['tokens']['access'], friends[username])
+        for username in usernames
+    ]
+
+
+def run_load(usernames, duration=30, mix=None, think=0.5, seed=0, transport='communicator'):
+    """
+    Drive the seeded users for `duration` seconds and return the results dict.
+    """
+    mix = mix or DEFAULT_MIX
+    credentials = _credentials(usernames)
+    recorder = Recorder()
+    started = datetime.now(timezone.utc).isoformat()
+
+    async def drive(open_socket):
+        users = {}
+        for n, (username, token, friends) in enumerate(credentials):
+            users[username] = SimUser(username, token, friends, random.Random(seed * 100003 + n), recorder)
+            await users[username].start(open_socket)
+        started = time.monotonic()
+        await asyncio.gather(*(user.run(users, mix, think, started + duration) for user in users.values()))
+        elapsed = time.monotonic() - started
+        for user in users.values():
+            await user.close()
+        return elapsed
+
+    if transport == 'server':
+        with Server() as server:
+            elapsed = asyncio.run(drive(lambda path: ServerSocket(server.url + path)))
+    else:
+        from channels.routing import get_default_application
+
+        application = get_default_application()
+        elapsed = asyncio.run(drive(lambda path: CommunicatorSocket(application, path)))
+
+    return {
+        'started': started,
+        'config': {
+            'transport': transport,
+            'users': len(usernames),
+            'duration_s': duration,
+            'think_s': think,
+            'seed': seed,
+            'mix': mix,
+        },
+        'elapsed_s': elapsed,
+        **recorder.report(elapsed),
+    }
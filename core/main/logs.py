@@ -0,0 +1,135 @@
+"""
+Structured logging for the consumers.
+
+    log = logs.get_logger(__name__)
+    log.info('message sent', connection_id=7, text=text)
+
+Keyword arguments become fields of a JSON line:
+
+    {"ts": "2026-10-17T09:12:03.120Z", "level": "INFO", "logger": "main.consumers",
+     "msg": "message sent", "connection_id": 7, "text": "<12 chars>"}
+
+Message text, search queries, images and SDP/ICE payloads are redacted to
+their length when the line is formatted, so content never reaches the log.
+Nothing is formatted for records below the logger's level, which is set per
+module in settings.LOGGING.
+
+Per-frame logs go to the 'main.frames' logger, rate limited by
+RateLimitFilter. AsyncHandler hands records to a background thread through a
+bounded queue, so writing never blocks the event loop; when the queue is
+full records are dropped and counted instead of waiting.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+# Field names whose values are replaced by their size
+REDACTED_FIELDS = ('text', 'query', 'base64', 'offer', 'answer', 'candidate', 'candidates', 'password', 'token')
+
+
+def redact(value, key=None):
+    if key in REDACTED_FIELDS and value is not None:
+        if isinstance(value, str):
+            return f'<{len(value)} chars>'
+        if isinstance(value, (list, tuple)):
+            return f'<{len(value)} items>'
+        return '<redacted>'
+    if isinstance(value, dict):
+        return {k: redact(v, k) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(v) for v in value]
+    return value
+
+
+class StructuredLogger(logging.LoggerAdapter):
+    # Moves keyword arguments into record.fields
+    def __init__(self, logger):
+        super().__init__(logger, {})
+
+    def process(self, msg, kwargs):
+        fields = {
+            key: kwargs.pop(key) for key in list(kwargs)
+            if key not in ('exc_info', 'stack_info', 'stacklevel', 'extra')
+        }
+        kwargs['extra'] = {**kwargs.get('extra', {}), 'fields': fields}
+        return msg, kwargs
+
+
+def get_logger(name):
+    return StructuredLogger(logging.getLogger(name))
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        line = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds')[:-6] + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in getattr(record, 'fields', {}).items():
+            line[key] = redact(value, key)
+        if record.exc_info:
+            line['exc'] = self.formatException(record.exc_info)
+        return json.dumps(line, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Token bucket per message: at most `rate` records a second (bursts of
+    `burst`) get through for each distinct msg, and the next one that does
+    carries the number suppressed in between.
+    """
+
+    def __init__(self, rate=10, burst=20):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        # msg -> [tokens, last refill, suppressed]
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(record.msg)
+            if bucket is None:
+                bucket = self._buckets[record.msg] = [self.burst, now, 0]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            suppressed, bucket[2] = bucket[2], 0
+        if suppressed:
+            record.fields = {**getattr(record, 'fields', {}), 'suppressed': suppressed}
+        return True
+
+
+class AsyncHandler(logging.handlers.QueueHandler):
+    """
+    Formats on the calling thread and writes `stream` (stderr by default)
+    from a listener thread. At most `capacity` records wait; past that they
+    are dropped and counted in `dropped`.
+    """
+
+    def __init__(self, capacity=10000, stream=None):
+        super().__init__(queue.Queue(capacity))
+        self.dropped = 0
+        target = logging.StreamHandler(stream or sys.stderr)
+        self.listener = logging.handlers.QueueListener(self.queue, target)
+        self.listener.start()
+        atexit.register(self.listener.stop)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
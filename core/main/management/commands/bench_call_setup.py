@@ -0,0 +1,150 @@
+import asyncio
+import json
+import time
+
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from main import consumers
+from main.benchmarks import test_database, summarize
+from main.consumers import ChatConsumer, VideoCallConsumer
+from main.models import User, Connection, Message
+
+
+async def connect(consumer, path, user):
+    communicator = WebsocketCommunicator(consumer.as_asgi(), path)
+    communicator.scope['user'] = user
+    connected, _ = await communicator.connect()
+    assert connected
+    return communicator
+
+
+# Signaling frames received by the call's two sockets
+frames = []
+
+
+async def receive(communicator, action, timeout=10):
+    # Next frame with this action, skipping anything else
+    while True:
+        frame = json.loads(await communicator.receive_from(timeout))
+        frames.append(frame)
+        if frame.get('action') == action:
+            return frame
+
+
+async def receive_candidates(communicator, count, timeout=10):
+    got = 0
+    while got < count:
+        frame = json.loads(await communicator.receive_from(timeout))
+        frames.append(frame)
+        if frame.get('action') == 'candidate':
+            got += 1
+        elif frame.get('action') == 'candidates':
+            got += len(frame['candidates'])
+
+
+class Command(BaseCommand):
+    help = 'Time-to-connect for call setup (call, accept, offer/answer, trickle ICE), idle and under chat load'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=50)
+        parser.add_argument('--candidates', type=int, default=10)
+        parser.add_argument('--chatters', type=int, default=20)
+        parser.add_argument('--history', type=int, default=500)
+        parser.add_argument('--rate', type=float, default=10, help='chat requests per second per chatter')
+
+    def handle(self, *args, **options):
+        with test_database(on_disk=True):
+            caller = User.objects.create_user(username='caller', password='bench')
+            callee = User.objects.create_user(username='callee', password='bench')
+            chatters = [User.objects.create_user(username=f'chatter{i}', password='bench') for i in range(options['chatters'])]
+            connections = []
+            for i, user in enumerate(chatters):
+                connection = Connection.objects.create(sender=user, receiver=callee, accepted=True)
+                connections.append(connection)
+            Message.objects.bulk_create(
+                Message(connection=connection, sender=connection.sender, text='hi', status='read')
+                for connection in connections for _ in range(options['history'] // max(1, len(connections)))
+            )
+
+            routes = {k: v for k, v in settings.DB_EXECUTOR_ROUTES.items() if k != 'call'}
+            modes = [
+                # Before: shared channel layer and DB pool, candidates flushed as they come
+                ('shared lane, no window', 'default', 0, routes),
+                ('signaling lane, batched', 'signaling', consumers.CANDIDATE_WINDOW, settings.DB_EXECUTOR_ROUTES),
+            ]
+            for label, alias, window, routes in modes:
+                for loaded in (False, True):
+                    with override_settings(DB_EXECUTOR_ROUTES=routes):
+                        samples = asyncio.run(self.run(caller, callee, chatters, connections, options, loaded, alias, window))
+                    # Same history for every run
+                    Message.objects.filter(text='load').delete()
+                    stats = summarize(samples)
+                    self.stdout.write(
+                        f"{label:<25} {'chat load' if loaded else 'idle':<10} "
+                        f"p50 {stats['p50_ms']:.1f} ms  p95 {stats['p95_ms']:.1f} ms  p99 {stats['p99_ms']:.1f} ms  "
+                        f"{len(frames) / len(samples):.1f} frames/call"
+                    )
+
+    async def run(self, caller, callee, chatters, connections, options, loaded, alias, window):
+        original = (VideoCallConsumer.channel_layer_alias, consumers.CANDIDATE_WINDOW)
+        VideoCallConsumer.channel_layer_alias = alias
+        consumers.CANDIDATE_WINDOW = window
+        stop = asyncio.Event()
+        load = []
+        frames.clear()
+        try:
+            if loaded:
+                for user, connection in zip(chatters, connections):
+                    communicator = await connect(ChatConsumer, '/chat/', user)
+                    load.append((communicator, asyncio.create_task(self.chat(communicator, connection, stop, options['rate']))))
+            a = await connect(VideoCallConsumer, '/ws/video/', caller)
+            b = await connect(VideoCallConsumer, '/ws/video/', callee)
+            await receive(a, 'connection_success')
+            await receive(b, 'connection_success')
+            samples = []
+            for _ in range(options['calls']):
+                samples.append(await self.call(a, b, options['candidates']))
+            await a.disconnect()
+            await b.disconnect()
+            return samples
+        finally:
+            stop.set()
+            for communicator, task in load:
+                await task
+                await communicator.disconnect()
+            VideoCallConsumer.channel_layer_alias, consumers.CANDIDATE_WINDOW = original
+
+    async def chat(self, communicator, connection, stop, rate):
+        # Page through history and send a message, `rate` times a second
+        while not stop.is_set():
+            started = time.perf_counter()
+            await communicator.send_to(text_data=json.dumps({'source': 'message.list', 'connection_id': connection.id, 'page_size': 100}))
+            await communicator.send_to(text_data=json.dumps({'source': 'message.send', 'connection_id': connection.id, 'text': 'load'}))
+            while not await communicator.receive_nothing(0.005):
+                await communicator.receive_from()
+            await asyncio.sleep(max(0, 1 / rate - (time.perf_counter() - started)))
+
+    async def call(self, a, b, candidates):
+        start = time.perf_counter()
+        await a.send_to(text_data=json.dumps({'action': 'call', 'recipient': 'callee'}))
+        await receive(b, 'call')
+        await b.send_to(text_data=json.dumps({'action': 'accept', 'recipient': 'caller'}))
+        await receive(a, 'accept')
+        await a.send_to(text_data=json.dumps({'action': 'offer', 'offer': {'sdp': 'x'}, 'recipient': 'callee'}))
+        for i in range(candidates):
+            await a.send_to(text_data=json.dumps({'action': 'candidate', 'candidate': {'candidate': str(i)}, 'recipient': 'callee'}))
+        await receive(b, 'offer')
+        await b.send_to(text_data=json.dumps({'action': 'answer', 'answer': {'sdp': 'y'}, 'recipient': 'caller'}))
+        for i in range(candidates):
+            await b.send_to(text_data=json.dumps({'action': 'candidate', 'candidate': {'candidate': str(i)}, 'recipient': 'caller'}))
+        await receive_candidates(b, candidates)
+        await receive(a, 'answer')
+        await receive_candidates(a, candidates)
+        elapsed = time.perf_counter() - start
+        await a.send_to(text_data=json.dumps({'action': 'end-call', 'recipient': 'callee'}))
+        await receive(b, 'end-call')
+        frames.pop()
+        return elapsed
@@ -0,0 +1,50 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from main.codecs import CODECS
+
+
+def sample_event():
+    # Shape of a 20 message history page as broadcast_group sends it
+    sender = {'username': 'alice', 'first_name': 'Alice', 'last_name': 'Wong',
+              'thumbnail': '/media/thumbnails/94/9402dbab2a9c1e243a4595ac838b7da6ed507d577ff670c0d80e7fd203d446ff/128.webp'}
+    return {
+        'source': 'message.list',
+        'data': {
+            'messages': [
+                {'id': 1000 + i, 'connection': 7, 'sender': sender, 'text': f'message number {i} with some text',
+                 'created': '2025-08-11T19:21:00.123456Z', 'status': 'delivered'}
+                for i in range(20)
+            ],
+            'next': 'MjAyNS0wOC0xMVQxOToyMTowMC4xMjM0NTYrMDA6MDB8OTgw',
+        },
+    }
+
+
+class Command(BaseCommand):
+    help = 'Encode/decode throughput and frame size per WebSocket codec, against stdlib json'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20000)
+
+    def handle(self, *args, **options):
+        event = sample_event()
+        n = options['iterations']
+        codecs = [('stdlib json', json.dumps, json.loads)]
+        codecs += [(name, codec.encode, codec.decode) for name, codec in CODECS.items()]
+        for label, encode, decode in codecs:
+            frame = encode(event)
+            start = time.perf_counter()
+            for _ in range(n):
+                encode(event)
+            encoded = time.perf_counter() - start
+            start = time.perf_counter()
+            for _ in range(n):
+                decode(frame)
+            decoded = time.perf_counter() - start
+            size = len(frame.encode() if isinstance(frame, str) else frame)
+            self.stdout.write(
+                f'{label:<12} {size:>6} bytes  encode {n / encoded:>9.0f}/s  decode {n / decoded:>9.0f}/s'
+            )
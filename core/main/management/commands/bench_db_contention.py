@@ -0,0 +1,68 @@
+import asyncio
+import time
+
+from asgiref.sync import sync_to_async
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from main.benchmarks import test_database, summarize
+from main.executor import db_sync_to_async
+from main.models import User, Connection, Message
+
+
+class Command(BaseCommand):
+    help = 'p50/p99 message send latency while heavy searches run, shared sync_to_async thread vs DB executor pools'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20000)
+        parser.add_argument('--sends', type=int, default=200)
+        parser.add_argument('--searchers', type=int, default=4)
+
+    def handle(self, *args, **options):
+        with test_database(on_disk=True):
+            User.objects.bulk_create(
+                User(username=f'user{i}', first_name=f'first{i}', last_name=f'last{i}')
+                for i in range(options['users'])
+            )
+            sender, receiver = User.objects.order_by('id')[:2]
+            connection = Connection.objects.create(sender=sender, receiver=receiver, accepted=True)
+
+            def send():
+                message = Message.objects.create(connection=connection, sender=sender, text='hi')
+                Connection.record_message(message)
+
+            def search():
+                return len(User.objects.filter(
+                    Q(username__icontains='9') | Q(first_name__icontains='9') | Q(last_name__icontains='9')
+                ))
+
+            modes = {
+                'shared thread': (sync_to_async(send), sync_to_async(search)),
+                'executor pools': (db_sync_to_async(send, 'message.send'), db_sync_to_async(search, 'search')),
+            }
+            for label, (send_async, search_async) in modes.items():
+                for loaded in (False, True):
+                    samples = asyncio.run(self.run(send_async, search_async, options, loaded))
+                    stats = summarize(samples)
+                    self.stdout.write(
+                        f"{label:<15} {'with searches' if loaded else 'idle':<14} "
+                        f"p50 {stats['p50_ms']:.2f} ms  p99 {stats['p99_ms']:.2f} ms"
+                    )
+
+    async def run(self, send_async, search_async, options, loaded):
+        stop = asyncio.Event()
+
+        async def searcher():
+            while not stop.is_set():
+                await search_async()
+
+        searchers = [asyncio.create_task(searcher()) for _ in range(options['searchers'] if loaded else 0)]
+        samples = []
+        for _ in range(options['sends']):
+            start = time.perf_counter()
+            await send_async()
+            samples.append(time.perf_counter() - start)
+            await asyncio.sleep(0.001)
+        stop.set()
+        await asyncio.gather(*searchers)
+        return samples
@@ -0,0 +1,50 @@
+import asyncio
+import time
+
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+
+from main.benchmarks import summarize
+from main.fanout import group_send_many
+
+
+class Command(BaseCommand):
+    help = 'Time a presence broadcast to N friends, one group_send per friend vs group_send_many'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--friends', type=int, default=500)
+        parser.add_argument('--rounds', type=int, default=50)
+
+    def handle(self, *args, **options):
+        asyncio.run(self.run(options['friends'], options['rounds']))
+
+    async def run(self, friends, rounds):
+        layer = get_channel_layer()
+        groups = [f'friend{i}' for i in range(friends)]
+        channels = []
+        for group in groups:
+            channel = await layer.new_channel()
+            await layer.group_add(group, channel)
+            channels.append(channel)
+        message = {'type': 'broadcast_group', 'source': 'user.status', 'data': {'username': 'bench', 'online': True}}
+
+        async def serial():
+            for group in groups:
+                await layer.group_send(group, message)
+
+        async def many():
+            await group_send_many(layer, groups, message)
+
+        for label, func in [('serial', serial), ('group_send_many', many)]:
+            samples = []
+            for _ in range(rounds):
+                start = time.perf_counter()
+                await func()
+                samples.append(time.perf_counter() - start)
+                # drain so the queues never fill up
+                for channel in channels:
+                    await layer.receive(channel)
+            stats = summarize(samples)
+            self.stdout.write(
+                f"{label}: {friends} groups p50 {stats['p50_ms']:.2f} ms  p95 {stats['p95_ms']:.2f} ms  p99 {stats['p99_ms']:.2f} ms"
+            )
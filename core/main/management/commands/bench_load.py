@@ -0,0 +1,45 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from main import loadtest
+from main.benchmarks import test_database
+
+
+class Command(BaseCommand):
+    help = 'Simulate N authenticated WebSocket users and report per-action throughput and p50/p95/p99 latency'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--friends', type=int, default=4, help='connections per user')
+        parser.add_argument('--history', type=int, default=20, help='seeded messages per connection')
+        parser.add_argument('--duration', type=float, default=30)
+        parser.add_argument('--think', type=float, default=0.5, help='mean seconds between a user\'s actions')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--transport', choices=['communicator', 'server'], default='communicator')
+        parser.add_argument('--mix', help='JSON weights per action, default %s' % json.dumps(loadtest.DEFAULT_MIX))
+        parser.add_argument('--output', help='write the results as JSON to this file')
+
+    def handle(self, *args, **options):
+        mix = json.loads(options['mix']) if options['mix'] else None
+        with test_database(on_disk=True):
+            usernames = loadtest.seed(options['users'], options['friends'], options['history'])
+            results = loadtest.run_load(
+                usernames,
+                duration=options['duration'],
+                mix=mix,
+                think=options['think'],
+                seed=options['seed'],
+                transport=options['transport'],
+            )
+
+        self.stdout.write(f"{'action':<16}{'count':>8}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+        for action, stats in [*results['actions'].items(), ('total', results['total'])]:
+            self.stdout.write(
+                f"{action:<16}{stats['count']:>8}{stats['errors']:>8}{stats['throughput_per_s']:>9.1f}"
+                f"{stats['p50_ms']:>9.1f}{stats['p95_ms']:>9.1f}{stats['p99_ms']:>9.1f}"
+            )
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
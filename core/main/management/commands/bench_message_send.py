@@ -0,0 +1,84 @@
+import asyncio
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import override_settings
+
+from main import data as data_access
+from main import writebehind
+from main.benchmarks import test_database, summarize
+from main.models import User, Connection, Message
+from main.serializer import MessageSerializer
+
+
+async def legacy_send(user, connection_id, text, is_online):
+    # The hop-per-step sequence receive_message_send used before main.data
+    connection = await sync_to_async(lambda: Connection.objects.filter(id=connection_id).first())()
+    def create_message():
+        with transaction.atomic():
+            message = Message.objects.create(connection=connection, sender=user, text=text, status='sent')
+            Connection.record_message(message)
+        return message
+    message = await sync_to_async(create_message)()
+    other_user = await sync_to_async(lambda: connection.receiver if connection.sender == user else connection.sender)()
+
+    def mark_delivered_if_online():
+        if message.sender != other_user and is_online(other_user.username):
+            message.status = 'delivered'
+            message.save()
+        return message
+    delivered_message = await sync_to_async(mark_delivered_if_online)()
+    serialized = await sync_to_async(lambda: MessageSerializer(delivered_message).data)()
+    return serialized, other_user.username
+
+
+class Command(BaseCommand):
+    help = 'Server time per message.send: one hop per step, the single-hop data layer, and write-behind'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sends', type=int, default=1000)
+        parser.add_argument('--concurrency', type=int, default=1)
+
+    def handle(self, *args, **options):
+        with test_database(on_disk=True):
+            sender = User.objects.create_user(username='sender', password='bench')
+            receiver = User.objects.create_user(username='receiver', password='bench')
+            connection = Connection.objects.create(sender=sender, receiver=receiver, accepted=True)
+
+            async def client(send, samples, saved):
+                writer = writebehind.get_writer()
+                for i in range(options['sends'] // options['concurrency']):
+                    start = time.perf_counter()
+                    serialized = await send(sender, connection.id, f'message {i}', lambda username: True)
+                    samples.append(time.perf_counter() - start)
+                    if writer is not None:
+                        # Time until the sender would get message.saved
+                        await writer.saved(serialized[0]['id'])
+                        saved.append(time.perf_counter() - start)
+
+            async def run(send):
+                # `concurrency` sockets sending back to back
+                samples, saved = [], []
+                start = time.perf_counter()
+                await asyncio.gather(*(client(send, samples, saved) for _ in range(options['concurrency'])))
+                return samples, saved, len(samples) / (time.perf_counter() - start)
+
+            def report(label, send):
+                samples, saved, rate = asyncio.run(run(send))
+                stats = summarize(samples)
+                line = f"{label:<13} p50 {stats['p50_ms']:.2f} ms  p99 {stats['p99_ms']:.2f} ms  {rate:.0f} msg/s"
+                if saved:
+                    stats = summarize(saved)
+                    line += f"  saved p50 {stats['p50_ms']:.2f} ms  p99 {stats['p99_ms']:.2f} ms"
+                self.stdout.write(line)
+
+            for label, send in [('hop per step', legacy_send), ('main.data', data_access.send_message)]:
+                report(label, send)
+            with override_settings(WRITE_BEHIND={**getattr(settings, 'WRITE_BEHIND', {}), 'ENABLED': True}):
+                writebehind._writer = None
+                report('write-behind', data_access.send_message)
+                writebehind.get_writer().stop()
+                writebehind._writer = None
@@ -0,0 +1,75 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from main import loadtest, metrics
+from main.benchmarks import test_database
+from main.executor import _counted
+from main.models import User
+
+
+def per_call_ns(func, calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        func()
+    return (time.perf_counter() - start) / calls * 1e9
+
+
+class Command(BaseCommand):
+    help = 'Cost of the metrics instrumentation: per call, and on a load run with metrics off vs on'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=200000)
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--duration', type=float, default=10)
+        parser.add_argument('--think', type=float, default=0.2)
+        parser.add_argument('--rounds', type=int, default=2, help='off/on load runs, alternated')
+
+    def handle(self, *args, **options):
+        calls = options['calls']
+        was_enabled = metrics.enabled
+
+        def tracked():
+            with metrics.track('chat', 'bench'):
+                pass
+
+        self.stdout.write('per call')
+        for label, func in [
+            ('counter inc', lambda: metrics.ws_actions.inc('chat', 'bench', 'ok')),
+            ('histogram observe', lambda: metrics.ws_action_seconds.observe(0.003, 'chat', 'bench')),
+        ]:
+            self.stdout.write(f'  {label:<24}{per_call_ns(func, calls):>8.0f} ns')
+        for enabled in (False, True):
+            metrics.enabled = enabled
+            self.stdout.write(f"  {'track, ' + ('on' if enabled else 'off'):<24}{per_call_ns(tracked, calls):>8.0f} ns")
+
+        with test_database(on_disk=True):
+            User.objects.create_user(username='bench', password='bench')
+            query = _counted(lambda: User.objects.filter(username='bench').first(), 'bench')
+            for enabled in (False, True):
+                metrics.enabled = enabled
+                cost = per_call_ns(query, max(1, calls // 20)) / 1000
+                self.stdout.write(f"  {'1-query DB call, ' + ('on' if enabled else 'off'):<24}{cost:>8.1f} us")
+
+            usernames = loadtest.seed(options['users'])
+            runs = {False: [], True: []}
+            for _ in range(options['rounds']):
+                for enabled in (False, True):
+                    metrics.enabled = enabled
+                    runs[enabled].append(loadtest.run_load(
+                        usernames, duration=options['duration'], think=options['think']
+                    )['total'])
+
+        metrics.enabled = was_enabled
+        start = time.perf_counter()
+        size = len(metrics.render())
+        self.stdout.write(f'  {"render /metrics":<24}{(time.perf_counter() - start) * 1000:>8.1f} ms ({size} bytes)')
+
+        self.stdout.write(f"\nload, {options['users']} users, {options['rounds']} x {options['duration']:.0f} s per setting")
+        self.stdout.write(f"{'metrics':<10}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+        for enabled, totals in runs.items():
+            average = lambda key: sum(total[key] for total in totals) / len(totals)
+            self.stdout.write(
+                f"{'on' if enabled else 'off':<10}{average('throughput_per_s'):>9.1f}"
+                f"{average('p50_ms'):>9.2f}{average('p95_ms'):>9.2f}{average('p99_ms'):>9.2f}"
+            )
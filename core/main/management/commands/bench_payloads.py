@@ -0,0 +1,56 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from main import payloads
+from main.benchmarks import test_database, summarize
+from main.models import User, Connection, Message
+from main.serializer import MessageSerializer, FriendListSerializer
+
+
+def sample(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+class Command(BaseCommand):
+    help = 'Message page and friend list payloads: DRF serializers vs the values() fast path'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page', type=int, default=20)
+        parser.add_argument('--friends', type=int, default=50)
+        parser.add_argument('--repeat', type=int, default=500)
+
+    def handle(self, *args, **options):
+        with test_database():
+            me = User.objects.create_user(username='me', password='bench')
+            friends = [User(username=f'friend{n}', first_name='Friend', thumbnail_hash=f'{n:064x}') for n in range(options['friends'])]
+            User.objects.bulk_create(friends)
+            connections = Connection.objects.bulk_create(
+                Connection(sender=me, receiver=friend, accepted=True) for friend in User.objects.exclude(pk=me.pk)
+            )
+            chat = connections[0]
+            Message.objects.bulk_create(
+                Message(connection=chat, sender=chat.receiver if n % 2 else me, text=f'message {n}', status='read')
+                for n in range(options['page'])
+            )
+            messages = Message.objects.filter(connection=chat).order_by('-created', '-id')
+            accepted = Connection.objects.filter(accepted=True)
+
+            cases = [
+                ('message page, DRF', lambda: MessageSerializer(list(messages.select_related('sender')), many=True).data),
+                ('message page, fast', lambda: payloads.messages(list(messages.values_list(*payloads.MESSAGE_COLUMNS)))),
+                ('friend list, DRF', lambda: FriendListSerializer(
+                    list(accepted.select_related('sender', 'receiver', 'last_message')), context={'user': me}, many=True
+                ).data),
+                ('friend list, fast', lambda: payloads.friends(accepted, me)),
+            ]
+            self.stdout.write(f"{options['page']} messages, {options['friends']} friends, warm card cache")
+            for label, func in cases:
+                func()
+                stats = sample(func, options['repeat'])
+                self.stdout.write(f"{label:<22} p50 {stats['p50_ms']:.2f} ms  p99 {stats['p99_ms']:.2f} ms")
@@ -0,0 +1,48 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from main.benchmarks import test_database
+from main.models import User, Connection, Message
+
+
+def legacy_mark_delivered(user):
+    # The per-row loop ChatConsumer.connect used before the bulk update
+    delivered = []
+    for conn in Connection.objects.filter(receiver=user, accepted=True):
+        for msg in Message.objects.filter(connection=conn, status='sent'):
+            msg.status = 'delivered'
+            msg.save()
+            delivered.append((msg.id, msg.sender.username))
+    return delivered
+
+
+class Command(BaseCommand):
+    help = 'Time marking pending messages as delivered on reconnect, per-row loop vs bulk update'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=10000)
+        parser.add_argument('--friends', type=int, default=10)
+
+    def handle(self, *args, **options):
+        with test_database():
+            user = User.objects.create_user(username='bench', password='bench')
+            connections = []
+            for i in range(options['friends']):
+                friend = User.objects.create_user(username=f'friend{i}', password='bench')
+                connections.append(Connection.objects.create(sender=friend, receiver=user, accepted=True))
+
+            def seed():
+                Message.objects.all().delete()
+                Message.objects.bulk_create(
+                    Message(connection=conn, sender=conn.sender, text='hi', status='sent')
+                    for i in range(options['messages'])
+                    for conn in [connections[i % len(connections)]]
+                )
+
+            for label, func in [('loop', legacy_mark_delivered), ('bulk', Message.objects.mark_delivered_for)]:
+                seed()
+                start = time.perf_counter()
+                delivered = func(user)
+                elapsed = time.perf_counter() - start
+                self.stdout.write(f'{label}: {len(delivered)} messages in {elapsed * 1000:.1f} ms')
@@ -0,0 +1,85 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from main import payloads, sync
+from main.benchmarks import test_database, summarize
+from main.models import User, Connection, Change, Message
+from main.pagination import DEFAULT_PAGE_SIZE
+
+
+def sample(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def reload(user, open_ids):
+    # What a reconnect did before sync: friend.list, then a message.list page per open conversation
+    payloads.friends(Connection.objects.filter(Q(sender=user) | Q(receiver=user), accepted=True), user)
+    for connection_id in open_ids:
+        rows = list(Message.objects.filter(connection_id=connection_id).order_by('-created', '-id').values_list(
+            *payloads.MESSAGE_COLUMNS
+        )[:DEFAULT_PAGE_SIZE + 1])
+        payloads.messages(rows[:DEFAULT_PAGE_SIZE])
+
+
+def catch_up(user, cursor):
+    frames = 0
+    while True:
+        frame = sync.changes_since(user, cursor)
+        frames += 1
+        if not frame['more']:
+            return frames
+        cursor = frame['cursor']
+
+
+class Command(BaseCommand):
+    help = 'Reconnect cost: reloading the friend list and open conversations vs syncing from a cursor'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--friends', type=int, default=50)
+        parser.add_argument('--open', type=int, default=5)
+        parser.add_argument('--history', type=int, nargs='+', default=[100, 2000])
+        parser.add_argument('--missed', type=int, default=20)
+        parser.add_argument('--repeat', type=int, default=50)
+
+    def handle(self, *args, **options):
+        with test_database(on_disk=True):
+            me = User.objects.create_user(username='me', password='bench')
+            User.objects.bulk_create(User(username=f'friend{n}') for n in range(options['friends']))
+            connections = Connection.objects.bulk_create(
+                Connection(sender=friend, receiver=me, accepted=True) for friend in User.objects.exclude(pk=me.pk)
+            )
+            open_ids = [connection.id for connection in connections[:options['open']]]
+            self.stdout.write(
+                f"{options['friends']} friends, {options['open']} open conversations, {options['missed']} missed messages"
+            )
+            for history in options['history']:
+                Message.objects.all().delete()
+                Change.objects.all().delete()
+                # Every conversation, and every other user's, has this much history in messages and changes
+                for connection in connections:
+                    Message.objects.bulk_create(
+                        Message(connection=connection, sender=connection.sender, text=f'old {n}', status='read')
+                        for n in range(history)
+                    )
+                cursor = sync.head()
+                Message.objects.bulk_create(
+                    Message(connection=connections[n % len(connections)], sender=connections[n % len(connections)].sender, text=f'new {n}')
+                    for n in range(options['missed'])
+                )
+                Message.objects.mark_delivered_for(me)
+                for label, func in [
+                    ('reload', lambda: reload(me, open_ids)),
+                    ('sync', lambda: catch_up(me, cursor)),
+                ]:
+                    func()
+                    stats = sample(func, options['repeat'])
+                    self.stdout.write(
+                        f"history {history:>6}/conversation  {label:<7} p50 {stats['p50_ms']:.2f} ms  p99 {stats['p99_ms']:.2f} ms"
+                    )
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from main import sync
+
+
+class Command(BaseCommand):
+    help = 'Trim the sync change log to its newest rows; clients with an older cursor reload everything'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retain', type=int, default=sync.RETAIN)
+
+    def handle(self, *args, **options):
+        deleted = sync.prune(options['retain'])
+        self.stdout.write(f'Deleted {deleted} changes')
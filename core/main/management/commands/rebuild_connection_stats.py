@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery
+
+from main.models import Connection, Message
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the last message and unread counters stored on Connection from message history'
+
+    def handle(self, *args, **options):
+        latest = Message.objects.filter(connection=OuterRef('pk')).order_by('-created', '-id').values('id')[:1]
+        # (connection, sender) -> messages from that sender the other side has not read
+        unread = {
+            (row['connection'], row['sender']): row['count']
+            for row in Message.objects.exclude(status='read').values('connection', 'sender').annotate(count=Count('id'))
+        }
+        with transaction.atomic():
+            connections = list(Connection.objects.annotate(latest_id=Subquery(latest)))
+            for conn in connections:
+                conn.last_message_id = conn.latest_id
+                conn.sender_unread = unread.get((conn.id, conn.receiver_id), 0)
+                conn.receiver_unread = unread.get((conn.id, conn.sender_id), 0)
+            Connection.objects.bulk_update(connections, ['last_message', 'sender_unread', 'receiver_unread'], batch_size=500)
+        self.stdout.write(f'Rebuilt {len(connections)} connections')
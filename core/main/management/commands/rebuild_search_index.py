@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from main import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the user search index from the users table'
+
+    def handle(self, *args, **options):
+        count = search.rebuild()
+        self.stdout.write(f'Indexed {count} users')
@@ -0,0 +1,50 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main import replay
+from main.benchmarks import test_database
+
+
+class Command(BaseCommand):
+    help = 'Replay a traffic capture against a fresh seeded database and compare with a baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('capture', help='JSON lines file written with CAPTURE enabled')
+        parser.add_argument('--speed', type=float, default=1.0, help='replay this many times faster than captured')
+        parser.add_argument('--history', type=int, default=20, help='seeded messages per connection')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--baseline', help='results file to compare against; exits non-zero on regressions')
+        parser.add_argument('--save-baseline', help='write the results to this file')
+        parser.add_argument('--latency-tolerance', type=float, default=0.25, help='allowed p95 increase, as a fraction')
+        parser.add_argument('--min-ms', type=float, default=5.0, help='p95 increases below this many ms are ignored')
+
+    def handle(self, *args, **options):
+        records = replay.load(options['capture'])
+        with test_database(on_disk=True):
+            connection_ids = replay.seed(records, options['history'])
+            results = replay.Replay(records, connection_ids, options['speed'], options['seed']).run()
+
+        self.stdout.write(f"{results['config']['frames']} frames replayed, {results['config']['skipped']} skipped, in {results['elapsed_s']:.1f} s")
+        self.stdout.write(f"{'action':<16}{'count':>8}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+        for action, stats in results['actions'].items():
+            self.stdout.write(
+                f"{action:<16}{stats['count']:>8}{stats['errors']:>8}"
+                f"{stats['p50_ms']:>9.1f}{stats['p95_ms']:>9.1f}{stats['p99_ms']:>9.1f}"
+            )
+        self.stdout.write('queries per call: ' + ', '.join(
+            f'{action} {queries:.2f}' for action, queries in sorted(results['queries'].items())
+        ))
+
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(f"Baseline written to {options['save_baseline']}")
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            regressions = replay.compare(results, baseline, options['latency_tolerance'], options['min_ms'])
+            if regressions:
+                raise CommandError('Regressions against baseline:\n  ' + '\n  '.join(regressions))
+            self.stdout.write('No regressions against baseline')
@@ -0,0 +1,311 @@
+"""
+In-process metrics, served in the Prometheus text format at /metrics.
+
+    METRICS = {
+        'ENABLED': True,
+        'TOKEN': None,  # when set, scrapes need "Authorization: Bearer <TOKEN>"
+    }
+
+Recorded as they happen:
+
+    ws_actions_total{consumer, action, outcome}   frames handled per action
+    ws_action_seconds{consumer, action}           time to handle a frame
+    ws_sockets{consumer}                          open sockets of this process
+    db_call_seconds{action}                       executor call, queueing included
+    db_queries_total{action}, db_query_seconds_total{action}
+    channel_layer_send_seconds{op}                group_send and friends
+    http_requests_total{view, status}, http_request_seconds{view}
+    ws_outbound_batch_size                        events per frame of batching sockets
+
+and read at scrape time: DB executor pools, online users, active calls, the
+social graph cache, the recent message.send window and the write-behind
+writer. Values are per process; every worker exposes its own and Prometheus
+sums them. Recording is a dict lookup and a few additions under a lock,
+cheap enough to leave on (see bench_metrics). Labels are kept to known
+values so the number of series stays bounded.
+"""
+import bisect
+import threading
+import time
+
+from django.conf import settings
+
+_config = getattr(settings, 'METRICS', {})
+enabled = _config.get('ENABLED', True)
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values)
+    )
+    return '{' + pairs + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return self.header() + [
+            f'{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}'
+            for labels, value in values
+        ]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                # per bucket counts (the last one is +Inf), sum
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def count(self, *labels):
+        series = self._values.get(labels)
+        return sum(series[0]) if series else 0
+
+    def render(self):
+        with self._lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._values.items())
+        lines = self.header()
+        for labels, (counts, total) in values:
+            lines += _histogram_lines(self.name, self.labels, labels, self.buckets, counts, total)
+        return lines
+
+
+def _histogram_lines(name, names, values, buckets, counts, total):
+    lines = []
+    cumulative = 0
+    for bound, count in zip((*buckets, float('inf')), counts):
+        cumulative += count
+        label_text = _format_labels((*names, 'le'), (*values, _format_value(float(bound))))
+        lines.append(f'{name}_bucket{label_text} {cumulative}')
+    label_text = _format_labels(names, values)
+    lines.append(f'{name}_sum{label_text} {_format_value(total)}')
+    lines.append(f'{name}_count{label_text} {cumulative}')
+    return lines
+
+
+registry = []
+
+ws_actions = Counter('ws_actions_total', 'WebSocket frames handled', ('consumer', 'action', 'outcome'))
+ws_action_seconds = Histogram('ws_action_seconds', 'Time to handle a WebSocket frame', ('consumer', 'action'))
+ws_sockets = Gauge('ws_sockets', 'Open WebSocket connections', ('consumer',))
+db_call_seconds = Histogram('db_call_seconds', 'DB executor call time including queueing', ('action',))
+db_queries = Counter('db_queries_total', 'SQL queries run', ('action',))
+db_query_seconds = Counter('db_query_seconds_total', 'Time spent in SQL queries', ('action',))
+layer_send_seconds = Histogram('channel_layer_send_seconds', 'Channel layer send time', ('op',))
+http_requests = Counter('http_requests_total', 'HTTP requests handled', ('view', 'status'))
+http_request_seconds = Histogram('http_request_seconds', 'HTTP request time', ('view',))
+
+
+class track:
+    """
+    Time a block and count it under `action`:
+
+        with metrics.track('chat', source) as tracked:
+            ...
+            tracked.failed = True  # counted as an error without raising
+
+    An exception leaving the block is counted as an error too.
+    """
+    __slots__ = ('consumer', 'action', 'start', 'failed')
+
+    def __init__(self, consumer, action):
+        self.consumer = consumer
+        self.action = action
+        self.failed = False
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if enabled:
+            ws_action_seconds.observe(time.perf_counter() - self.start, self.consumer, self.action)
+            outcome = 'error' if exc_type is not None or self.failed else 'ok'
+            ws_actions.inc(self.consumer, self.action, outcome)
+
+
+class timed_send:
+    # with timed_send('group_send'): await layer.group_send(...)
+    __slots__ = ('op', 'start')
+
+    def __init__(self, op):
+        self.op = op
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc, tb):
+        if enabled:
+            layer_send_seconds.observe(time.perf_counter() - self.start, self.op)
+
+
+class TimedViewMixin:
+    """
+    For APIViews: counts requests by status and times them under `metrics_name`.
+    """
+    metrics_name = None
+
+    def dispatch(self, request, *args, **kwargs):
+        start = time.perf_counter()
+        response = super().dispatch(request, *args, **kwargs)
+        if enabled:
+            name = self.metrics_name or type(self).__name__
+            http_request_seconds.observe(time.perf_counter() - start, name)
+            http_requests.inc(name, response.status_code)
+        return response
+
+
+def _collect_executors():
+    from .executor import executor_stats
+
+    stats = sorted(executor_stats().items())
+    lines = []
+    for key, kind, help in (
+        ('workers', 'gauge', 'Threads of a DB executor pool'),
+        ('queued', 'gauge', 'Calls waiting for a DB executor thread'),
+        ('running', 'gauge', 'Calls running on a DB executor pool'),
+        ('max_queued', 'gauge', 'Most calls ever waiting for a DB executor pool'),
+        ('completed', 'counter', 'Calls finished by a DB executor pool'),
+    ):
+        name = f'db_executor_{key}' + ('_total' if kind == 'counter' else '')
+        lines += [f'# HELP {name} {help}', f'# TYPE {name} {kind}']
+        lines += [f'{name}{{pool="{pool}"}} {values[key]}' for pool, values in stats]
+    return lines
+
+
+def _collect_sessions():
+    from .calls import calls
+    from .presence import get_presence
+
+    return [
+        '# HELP online_users Users with an open chat socket on this process',
+        '# TYPE online_users gauge',
+        f'online_users {len(set(get_presence().local.values()))}',
+        '# HELP active_calls Ringing or active calls known to this process',
+        '# TYPE active_calls gauge',
+        f'active_calls {calls.active_count()}',
+    ]
+
+
+def _collect_graph():
+    from .graph import graph
+
+    return [
+        '# HELP graph_cache_entries Users and connections in the social graph cache',
+        '# TYPE graph_cache_entries gauge',
+        f'graph_cache_entries {len(graph)}',
+        '# HELP graph_cache_lookups_total Social graph cache lookups',
+        '# TYPE graph_cache_lookups_total counter',
+        f'graph_cache_lookups_total{{result="hit"}} {graph.hits}',
+        f'graph_cache_lookups_total{{result="miss"}} {graph.misses}',
+    ]
+
+
+def _collect_recent_sends():
+    from .dedup import recent_sends
+
+    return [
+        '# HELP recent_sends_entries Client ids in the recent message.send window',
+        '# TYPE recent_sends_entries gauge',
+        f'recent_sends_entries {len(recent_sends)}',
+        '# HELP recent_sends_duplicates_total Resent messages answered from the window',
+        '# TYPE recent_sends_duplicates_total counter',
+        f'recent_sends_duplicates_total {recent_sends.hits}',
+    ]
+
+
+def _collect_writer():
+    from .writebehind import get_writer
+
+    writer = get_writer()
+    if writer is None:
+        return []
+    return [
+        '# HELP message_writer_pending Messages sent but not yet committed',
+        '# TYPE message_writer_pending gauge',
+        f'message_writer_pending {writer.pending}',
+        '# HELP message_writer_batches_total Group commits of the message writer',
+        '# TYPE message_writer_batches_total counter',
+        f'message_writer_batches_total {writer.batches}',
+        '# HELP message_writer_rows_total Messages written by group commits',
+        '# TYPE message_writer_rows_total counter',
+        f'message_writer_rows_total {writer.rows}',
+    ]
+
+
+# Called at scrape time, each returns exposition lines
+collectors = [
+    _collect_executors, _collect_sessions, _collect_graph, _collect_recent_sends, _collect_writer
+]
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    for collect in collectors:
+        lines += collect()
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    # Tests and benchmarks start from zero
+    for metric in registry:
+        with metric._lock:
+            metric._values.clear()
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-17 07:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0005_message_history_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='connection',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='main.message'),
+        ),
+        migrations.AddField(
+            model_name='connection',
+            name='receiver_unread',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='connection',
+            name='sender_unread',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
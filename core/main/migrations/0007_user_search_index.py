@@ -0,0 +1,33 @@
+from django.db import migrations
+
+
+def create_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS main_user_search USING fts5("
+        "username, first_name, last_name, prefix='1 2 3', tokenize='unicode61')"
+    )
+    User = apps.get_model('main', 'User')
+    for pk, username, first_name, last_name in User.objects.values_list('pk', 'username', 'first_name', 'last_name'):
+        schema_editor.execute(
+            'INSERT INTO main_user_search (rowid, username, first_name, last_name) VALUES (%s, %s, %s, %s)',
+            [pk, username, first_name, last_name]
+        )
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute('DROP TABLE IF EXISTS main_user_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0006_connection_stats'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 07:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0007_user_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='thumbnail_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 5.2.18 on 2026-10-17 08:41
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+# (name, table, event, condition, kind, object id, connection id, user id)
+TRIGGERS = [
+    ('change_message_sent', 'main_message', 'INSERT', None, 'message', 'NEW.id', 'NEW.connection_id', 'NULL'),
+    ('change_message_status', 'main_message', 'UPDATE OF status', 'NEW.status IS NOT OLD.status',
+     'message', 'NEW.id', 'NEW.connection_id', 'NULL'),
+    ('change_request_made', 'main_connection', 'INSERT', None, 'request', 'NEW.id', 'NEW.id', 'NULL'),
+    ('change_request_accepted', 'main_connection', 'UPDATE OF accepted', 'NEW.accepted IS NOT OLD.accepted',
+     'request', 'NEW.id', 'NEW.id', 'NULL'),
+    ('change_profile', 'main_user', 'UPDATE OF username, first_name, last_name, thumbnail, thumbnail_hash',
+     'NEW.username IS NOT OLD.username OR NEW.first_name IS NOT OLD.first_name OR NEW.last_name IS NOT OLD.last_name '
+     'OR NEW.thumbnail IS NOT OLD.thumbnail OR NEW.thumbnail_hash IS NOT OLD.thumbnail_hash',
+     'profile', 'NEW.id', 'NULL', 'NEW.id'),
+]
+
+
+def create_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for name, table, event, condition, kind, object_id, connection_id, user_id in TRIGGERS:
+        when = f' WHEN {condition}' if condition else ''
+        schema_editor.execute(
+            f"CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON {table} FOR EACH ROW{when} BEGIN "
+            f"INSERT INTO main_change (kind, object_id, connection_id, user_id) "
+            f"VALUES ('{kind}', {object_id}, {connection_id}, {user_id}); END"
+        )
+
+
+def drop_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for name, *_ in TRIGGERS:
+        schema_editor.execute(f'DROP TRIGGER IF EXISTS {name}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0009_message_client_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Change',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('message', 'Message'), ('request', 'Request'), ('profile', 'Profile')], max_length=10)),
+                ('object_id', models.BigIntegerField()),
+                ('connection', models.ForeignKey(db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='main.connection')),
+                ('user', models.ForeignKey(db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['connection', 'id'], name='change_connection_id'), models.Index(fields=['user', 'id'], name='change_user_id')],
+            },
+        ),
+        migrations.RunPython(create_triggers, drop_triggers),
+    ]
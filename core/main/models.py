@@ -1,10 +1,15 @@
-from django.db import models
+from django.db import models, transaction, connection as db_connection
+from django.db.models import Case, F, Q, When
+from django.db.models.functions import Greatest
 from django.contrib.auth.models import AbstractUser
+from django.utils import timezone
 
 # Create your models here.
 
 class User(AbstractUser):
     thumbnail = models.ImageField(upload_to='thumbnails/', null=True, blank=True)
+    # sha256 of the uploaded image, names the resized variants (see main/thumbnails.py)
+    thumbnail_hash = models.CharField(max_length=64, blank=True, default='')
 
 class Connection(models.Model):
     sender = models.ForeignKey(User, related_name='sent_connections', on_delete=models.CASCADE)
@@ -12,22 +17,142 @@ class Connection(models.Model):
     accepted = models.BooleanField(default=False)
     updated = models.DateTimeField(auto_now=True)
     created = models.DateTimeField(auto_now_add=True)
+    # Denormalized for friend.list, maintained alongside message writes
+    # (rebuild with `manage.py rebuild_connection_stats`)
+    last_message = models.ForeignKey('Message', related_name='+', null=True, blank=True, on_delete=models.SET_NULL)
+    sender_unread = models.PositiveIntegerField(default=0)
+    receiver_unread = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return f"{self.sender.username} -> {self.receiver.username}"
+
+    def unread_field(self, user):
+        # Counter of messages `user` has not read yet in this conversation
+        return 'sender_unread' if user.pk == self.sender_id else 'receiver_unread'
+
+    def unread_for(self, user):
+        return getattr(self, self.unread_field(user))
+
+    @classmethod
+    def record_message(cls, message):
+        # Point the preview at a new message and bump the recipient's unread counter
+        connection = message.connection
+        recipient_unread = 'receiver_unread' if message.sender_id == connection.sender_id else 'sender_unread'
+        cls.objects.filter(pk=connection.pk).update(
+            last_message=message,
+            **{recipient_unread: F(recipient_unread) + 1}
+        )
+
+    @classmethod
+    def record_read(cls, connection_id, reader, count):
+        # Take `count` newly read messages off the reader's unread counter
+        if not count:
+            return
+        cls.objects.filter(pk=connection_id).update(
+            sender_unread=Case(
+                When(sender=reader, then=Greatest(F('sender_unread') - count, 0, output_field=models.PositiveIntegerField())),
+                default=F('sender_unread')
+            ),
+            receiver_unread=Case(
+                When(receiver=reader, then=Greatest(F('receiver_unread') - count, 0, output_field=models.PositiveIntegerField())),
+                default=F('receiver_unread')
+            )
+        )
     
 
+class MessageQuerySet(models.QuerySet):
+    def mark_delivered_for(self, user):
+        """
+        Flip every 'sent' message addressed to `user` to 'delivered' with a
+        single UPDATE and return the affected (message id, sender username) pairs.
+        """
+        if db_connection.features.can_return_columns_from_insert:
+            # UPDATE ... RETURNING is available wherever INSERT ... RETURNING is (SQLite 3.35+, PostgreSQL)
+            message_table = self.model._meta.db_table
+            connection_table = Connection._meta.db_table
+            with db_connection.cursor() as cursor:
+                cursor.execute(
+                    f"UPDATE {message_table} SET status = 'delivered' "
+                    f"WHERE status = 'sent' AND sender_id <> %s AND connection_id IN ("
+                    f"SELECT id FROM {connection_table} WHERE accepted AND (sender_id = %s OR receiver_id = %s)"
+                    f") RETURNING id, sender_id",
+                    [user.pk, user.pk, user.pk]
+                )
+                rows = cursor.fetchall()
+            if not rows:
+                return []
+            usernames = dict(User.objects.filter(pk__in={sender_id for _, sender_id in rows}).values_list('pk', 'username'))
+            return [(message_id, usernames[sender_id]) for message_id, sender_id in rows]
+
+        pending = self.filter(
+            Q(connection__sender=user) | Q(connection__receiver=user),
+            connection__accepted=True,
+            status='sent'
+        ).exclude(sender=user)
+        with transaction.atomic():
+            rows = list(pending.select_for_update().values_list('id', 'sender__username'))
+            if rows:
+                # Exactly the rows read, so later inserts stay out of the update
+                pending.filter(id__in=[message_id for message_id, _ in rows]).update(status='delivered')
+        return rows
+
+
 class Message(models.Model):
     connection = models.ForeignKey(Connection, related_name='messages', on_delete=models.CASCADE)
     sender = models.ForeignKey(User, related_name='my_messages', on_delete=models.CASCADE)
     text = models.TextField()
-    created = models.DateTimeField(auto_now_add=True)
+    # Not auto_now_add, so the write-behind writer can store the time clients were sent
+    created = models.DateTimeField(default=timezone.now, editable=False)
     STATUS_CHOICES = [
         ('sent', 'Sent'),
         ('delivered', 'Delivered'),
         ('read', 'Read'),
     ]
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='sent')
+    # Set by the sending client so a resent message.send is stored once
+    client_id = models.CharField(max_length=64, null=True, blank=True)
+
+    objects = MessageQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Serves keyset pagination of a conversation's history
+            models.Index(fields=['connection', 'created', 'id'], name='message_conn_created_id'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['connection', 'sender', 'client_id'], condition=models.Q(client_id__isnull=False),
+                name='message_unique_client_id'
+            ),
+        ]
 
     def __str__(self):
-        return f"Message {self.text} from {self.sender.username} in connection {self.connection.id}"
\ No newline at end of file
+        return f"Message {self.text} from {self.sender.username} in connection {self.connection.id}"
+
+class Change(models.Model):
+    """
+    Change log read by the sync action (see main/sync.py): one row for every
+    message sent or changing status, request made or accepted, and profile
+    edited. The id is the change sequence clients keep as their cursor. Rows
+    are appended by SQLite triggers (migration 0010), so bulk updates, the
+    write-behind writer and the admin are all covered.
+    """
+    KIND_CHOICES = [
+        ('message', 'Message'),
+        ('request', 'Request'),
+        ('profile', 'Profile'),
+    ]
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    object_id = models.BigIntegerField()
+    # Whose change it is: the conversation for messages and requests, the user for profiles.
+    # No constraints, the log outlives what it points at; the indexes below cover lookups
+    connection = models.ForeignKey(
+        Connection, null=True, related_name='+', on_delete=models.DO_NOTHING, db_constraint=False, db_index=False
+    )
+    user = models.ForeignKey(User, null=True, related_name='+', on_delete=models.DO_NOTHING, db_constraint=False, db_index=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['connection', 'id'], name='change_connection_id'),
+            models.Index(fields=['user', 'id'], name='change_user_id'),
+        ]
@@ -0,0 +1,53 @@
+"""
+Opaque keyset cursors for message history.
+
+A cursor encodes the (created, id) of the last row on a page; the next page
+is everything strictly older than it. The filter bounds `created` on its own
+as well as in the tie-break, so SQLite seeks the Message(connection, created,
+id) index straight to the cursor however deep the client scrolls; with only
+the OR form it seeks on the connection and walks past every newer row.
+"""
+import base64
+from datetime import datetime
+
+from django.db.models import Q
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def page_size(value):
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def encode_cursor(created, pk):
+    raw = f'{created.isoformat()}|{pk}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    # Returns (created, id) or None for a missing / malformed token
+    if not token or not isinstance(token, str):
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+        created, pk = raw.rsplit('|', 1)
+        return datetime.fromisoformat(created), int(pk)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def older_than(cursor):
+    created, pk = cursor
+    # The created bound on its own lets the index seek to the cursor
+    return Q(created__lte=created) & (Q(created__lt=created) | Q(id__lt=pk))
+
+
+def not_newer_than(cursor):
+    # The cursor's row and everything older
+    created, pk = cursor
+    return Q(created__lte=created) & (Q(created__lt=created) | Q(id__lte=pk))
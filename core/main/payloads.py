@@ -0,0 +1,168 @@
+"""
+Serialization fast path for the chat payloads.
+
+Builds the same JSON shapes as MessageSerializer, RequestSerializer and
+FriendListSerializer from .values() rows, without a DRF serializer per row:
+
+    message  {id, connection, sender: card, text, created, status, client_id}
+    request  {id, sender: card, receiver: card, accepted, created, updated}
+    friend   {id, friend: card, preview, unread, updated}
+
+A card is what UserSerializer gives for a user in a list
+({username, first_name, last_name, thumbnail}). Cards are kept per worker
+in an LRU of PROFILE_CARDS['SIZE'] users for PROFILE_CARDS['TTL'] seconds,
+and dropped when the user's names or thumbnail change (see main/signals.py).
+A card dict is shared by every payload that lists the user, so it must not
+be modified. Parity with the DRF serializers is covered by the tests.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from rest_framework import serializers
+
+from . import thumbnails
+from .models import User
+
+CARD_COLUMNS = ('id', 'username', 'first_name', 'last_name', 'thumbnail', 'thumbnail_hash')
+# Columns a card is built from, saving any other field leaves cards alone
+CARD_FIELDS = {'username', 'first_name', 'last_name', 'thumbnail', 'thumbnail_hash'}
+MESSAGE_COLUMNS = ('id', 'connection_id', 'sender_id', 'text', 'created', 'status', 'client_id')
+REQUEST_COLUMNS = ('id', 'sender_id', 'receiver_id', 'accepted', 'created', 'updated')
+FRIEND_COLUMNS = ('id', 'sender_id', 'receiver_id', 'last_message__text', 'sender_unread', 'receiver_unread', 'updated')
+
+# The DRF field itself, so timestamps format exactly as the serializers do
+_datetime = serializers.DateTimeField().to_representation
+
+
+def build_card(row):
+    id, username, first_name, last_name, thumbnail, thumbnail_hash = row
+    return {
+        'username': username,
+        'first_name': first_name,
+        'last_name': last_name,
+        'thumbnail': thumbnails.url_for(thumbnail_hash, thumbnail, thumbnails.LIST_SIZE),
+    }
+
+
+class ProfileCards:
+    def __init__(self, size=10000, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    def get_many(self, ids):
+        """
+        {user id: card} for `ids`, loading the missing ones in one query.
+        """
+        cards = {}
+        missing = []
+        now = time.monotonic()
+        with self._lock:
+            generation = self._generation
+            for user_id in set(ids):
+                entry = self._entries.get(user_id)
+                if entry is None or entry[1] < now:
+                    missing.append(user_id)
+                    continue
+                self._entries.move_to_end(user_id)
+                cards[user_id] = entry[0]
+        if missing:
+            loaded = {row[0]: build_card(row) for row in User.objects.filter(id__in=missing).values_list(*CARD_COLUMNS)}
+            cards.update(loaded)
+            with self._lock:
+                if generation == self._generation:
+                    expires = time.monotonic() + self.ttl
+                    for user_id, card in loaded.items():
+                        self._entries[user_id] = (card, expires)
+                        self._entries.move_to_end(user_id)
+                    while len(self._entries) > self.size:
+                        self._entries.popitem(last=False)
+        return cards
+
+    def get(self, user_id):
+        return self.get_many((user_id,)).get(user_id)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+
+_config = getattr(settings, 'PROFILE_CARDS', {})
+cards = ProfileCards(size=_config.get('SIZE', 10000), ttl=_config.get('TTL', 300))
+
+
+def _message(row, card):
+    id, connection_id, sender_id, text, created, status, client_id = row
+    return {
+        'id': id,
+        'connection': connection_id,
+        'sender': card,
+        'text': text,
+        'created': _datetime(created),
+        'status': status,
+        'client_id': client_id,
+    }
+
+
+def message(instance):
+    # Payload of a Message instance, e.g. one just created
+    return _message(
+        tuple(getattr(instance, column) for column in MESSAGE_COLUMNS),
+        cards.get(instance.sender_id)
+    )
+
+
+def messages(rows):
+    # Payloads of MESSAGE_COLUMNS rows, in order
+    found = cards.get_many(row[2] for row in rows)
+    return [_message(row, found.get(row[2])) for row in rows]
+
+
+def _request(row, found):
+    id, sender_id, receiver_id, accepted, created, updated = row
+    return {
+        'id': id,
+        'sender': found.get(sender_id),
+        'receiver': found.get(receiver_id),
+        'accepted': accepted,
+        'created': _datetime(created),
+        'updated': _datetime(updated),
+    }
+
+
+def request(connection):
+    # Payload of a Connection instance
+    row = tuple(getattr(connection, column) for column in REQUEST_COLUMNS)
+    return _request(row, cards.get_many(row[1:3]))
+
+
+def requests(queryset):
+    rows = list(queryset.values_list(*REQUEST_COLUMNS))
+    found = cards.get_many(user_id for row in rows for user_id in row[1:3])
+    return [_request(row, found) for row in rows]
+
+
+def friends(queryset, user):
+    rows = list(queryset.values_list(*FRIEND_COLUMNS))
+    found = cards.get_many(receiver_id if sender_id == user.pk else sender_id for _, sender_id, receiver_id, *_ in rows)
+    payloads = []
+    for id, sender_id, receiver_id, preview, sender_unread, receiver_unread, updated in rows:
+        mine = sender_id == user.pk
+        payloads.append({
+            'id': id,
+            'friend': found.get(receiver_id if mine else sender_id),
+            'preview': preview or '',
+            'unread': sender_unread if mine else receiver_unread,
+            'updated': _datetime(updated),
+        })
+    return payloads
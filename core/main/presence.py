@@ -0,0 +1,330 @@
+"""
+Presence registry shared by ChatConsumer and VideoCallConsumer.
+
+A user is online while at least one of their sockets is registered and that
+socket has been refreshed within PRESENCE['TTL'] seconds. Sockets are counted
+per channel name, so a user with a phone and a tablet stays online until both
+disconnect. Backends are selected in settings:
+
+    PRESENCE = {
+        'BACKEND': 'main.presence.SQLitePresenceBackend',
+        'TTL': 90,
+        'GRACE': 5,
+        'OPTIONS': {'path': BASE_DIR / 'presence.sqlite3'},
+    }
+
+Status changes are only pushed to sockets watching the user (see
+watch_group). Going offline is announced GRACE seconds after the last socket
+closes, and only if the user has not come back by then, so a flapping mobile
+connection produces no traffic at all.
+
+InMemoryPresenceBackend only sees the sockets of its own process and is meant
+for a single worker and for tests. SQLitePresenceBackend keeps the registry in
+a local file so every ASGI worker on the host shares it; its calls block, so
+PresenceRegistry runs them on the 'presence' DB executor (see
+main/executor.py) instead of the event loop.
+"""
+import asyncio
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .executor import db_sync_to_async
+
+
+class BasePresenceBackend:
+    # Whether calls may block, and so must not run on the event loop
+    blocking = False
+
+    def __init__(self, ttl=90, **options):
+        self.ttl = ttl
+
+    def add(self, username, channel_name):
+        # Register a socket, returns True if it is the user's first live one
+        raise NotImplementedError
+
+    def remove(self, username, channel_name):
+        # Drop a socket, returns True if the user has no live sockets left
+        raise NotImplementedError
+
+    def touch(self, channel_names):
+        # Refresh the heartbeat of sockets owned by this process
+        raise NotImplementedError
+
+    def count(self, username):
+        raise NotImplementedError
+
+    def is_online(self, username):
+        return self.count(username) > 0
+
+    def online(self, usernames):
+        return {username for username in usernames if self.is_online(username)}
+
+
+class InMemoryPresenceBackend(BasePresenceBackend):
+    def __init__(self, ttl=90, **options):
+        super().__init__(ttl, **options)
+        # username -> {channel_name: last heartbeat}
+        self._sockets = {}
+        self._owners = {}
+        self._lock = threading.Lock()
+
+    def _live(self, username, now):
+        sockets = self._sockets.get(username)
+        if not sockets:
+            return 0
+        expired = [name for name, seen in sockets.items() if now - seen > self.ttl]
+        for name in expired:
+            del sockets[name]
+            self._owners.pop(name, None)
+        if not sockets:
+            del self._sockets[username]
+        return len(sockets)
+
+    def add(self, username, channel_name):
+        now = time.monotonic()
+        with self._lock:
+            first = self._live(username, now) == 0
+            self._sockets.setdefault(username, {})[channel_name] = now
+            self._owners[channel_name] = username
+            return first
+
+    def remove(self, username, channel_name):
+        now = time.monotonic()
+        with self._lock:
+            sockets = self._sockets.get(username)
+            if sockets:
+                sockets.pop(channel_name, None)
+            self._owners.pop(channel_name, None)
+            return self._live(username, now) == 0
+
+    def touch(self, channel_names):
+        now = time.monotonic()
+        with self._lock:
+            for name in channel_names:
+                username = self._owners.get(name)
+                if username is not None:
+                    self._sockets[username][name] = now
+
+    def count(self, username):
+        with self._lock:
+            return self._live(username, time.monotonic())
+
+
+class SQLitePresenceBackend(BasePresenceBackend):
+    """
+    File-backed registry shared by all workers on a host.
+
+    Lookups go through the primary key / username index and are cached for
+    `cache_ttl` seconds per process, so the message hot path stays a dict hit.
+    """
+    blocking = True
+
+    def __init__(self, ttl=90, path='presence.sqlite3', cache_ttl=1.0, **options):
+        super().__init__(ttl, **options)
+        self.cache_ttl = cache_ttl
+        self._cache = {}
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), timeout=5, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS presence ('
+            'channel_name TEXT PRIMARY KEY, username TEXT NOT NULL, last_seen REAL NOT NULL)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS presence_username ON presence (username, last_seen)')
+
+    def _count(self, username, now):
+        row = self._db.execute(
+            'SELECT COUNT(*) FROM presence WHERE username = ? AND last_seen > ?',
+            (username, now - self.ttl)
+        ).fetchone()
+        return row[0]
+
+    def add(self, username, channel_name):
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                first = self._count(username, now) == 0
+                self._db.execute(
+                    'INSERT OR REPLACE INTO presence (channel_name, username, last_seen) VALUES (?, ?, ?)',
+                    (channel_name, username, now)
+                )
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+            self._cache.pop(username, None)
+            return first
+
+    def remove(self, username, channel_name):
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._db.execute('DELETE FROM presence WHERE channel_name = ?', (channel_name,))
+                # Sockets of crashed workers stop being refreshed, clear them out
+                self._db.execute('DELETE FROM presence WHERE username = ? AND last_seen <= ?', (username, now - self.ttl))
+                last = self._count(username, now) == 0
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+            self._cache.pop(username, None)
+            return last
+
+    def touch(self, channel_names):
+        channel_names = list(channel_names)
+        if not channel_names:
+            return
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                'UPDATE presence SET last_seen = ? WHERE channel_name = ?',
+                [(now, name) for name in channel_names]
+            )
+
+    def count(self, username):
+        with self._lock:
+            return self._count(username, time.time())
+
+    def is_online(self, username):
+        now = time.monotonic()
+        cached = self._cache.get(username)
+        if cached and cached[1] > now:
+            return cached[0]
+        online = self.count(username) > 0
+        self._cache[username] = (online, now + self.cache_ttl)
+        return online
+
+    def online(self, usernames):
+        now = time.monotonic()
+        online = set()
+        missing = []
+        for username in set(usernames):
+            cached = self._cache.get(username)
+            if cached and cached[1] > now:
+                if cached[0]:
+                    online.add(username)
+            else:
+                missing.append(username)
+        if not missing:
+            return online
+        placeholders = ','.join('?' * len(missing))
+        with self._lock:
+            rows = self._db.execute(
+                f'SELECT DISTINCT username FROM presence WHERE username IN ({placeholders}) AND last_seen > ?',
+                (*missing, time.time() - self.ttl)
+            ).fetchall()
+        found = {row[0] for row in rows}
+        expires = now + self.cache_ttl
+        for username in missing:
+            self._cache[username] = (username in found, expires)
+        return online | found
+
+
+def watch_group(username):
+    # Channel layer group of the sockets currently showing `username`
+    return f'presence_{username}'
+
+
+class PresenceRegistry:
+    """
+    Front for the configured backend. Tracks the sockets owned by this
+    process and refreshes them from a single heartbeat task.
+    """
+
+    def __init__(self, backend, grace=5):
+        self.backend = backend
+        self.grace = grace
+        self.local = {}
+        self._heartbeat = None
+        # username -> task announcing them offline once the grace period is over
+        self._pending_offline = {}
+
+    async def _call(self, func, *args):
+        if self.backend.blocking:
+            return await db_sync_to_async(func, 'presence')(*args)
+        return func(*args)
+
+    async def connect(self, username, channel_name):
+        self.local[channel_name] = username
+        self._ensure_heartbeat()
+        return await self._call(self.backend.add, username, channel_name)
+
+    async def disconnect(self, username, channel_name):
+        self.local.pop(channel_name, None)
+        return await self._call(self.backend.remove, username, channel_name)
+
+    def is_online(self, username):
+        # Blocks on a cache miss with a blocking backend: for DB executor
+        # threads (message.send); on the event loop use online()
+        return self.backend.is_online(username)
+
+    async def online(self, usernames):
+        return await self._call(self.backend.online, list(usernames))
+
+    async def count(self, username):
+        return await self._call(self.backend.count, username)
+
+    def schedule_offline(self, username, announce):
+        """
+        Await `announce()` after the grace period unless the user is back
+        online by then, either here or on another worker.
+        """
+        self.cancel_offline(username)
+        if not self.grace:
+            return asyncio.ensure_future(announce())
+
+        async def later():
+            try:
+                await asyncio.sleep(self.grace)
+                if not await self.online([username]):
+                    await announce()
+            finally:
+                if self._pending_offline.get(username) is task:
+                    del self._pending_offline[username]
+
+        task = asyncio.ensure_future(later())
+        self._pending_offline[username] = task
+        return task
+
+    def cancel_offline(self, username):
+        # True if an offline announcement was still pending, i.e. peers never saw the user leave
+        task = self._pending_offline.pop(username, None)
+        if task is None or task.done():
+            return False
+        task.cancel()
+        return True
+
+    def _ensure_heartbeat(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._heartbeat and not self._heartbeat.done() and self._heartbeat.get_loop() is loop:
+            return
+        self._heartbeat = loop.create_task(self._beat())
+
+    async def _beat(self):
+        interval = max(self.backend.ttl / 3, 1)
+        while self.local:
+            await asyncio.sleep(interval)
+            await self._call(self.backend.touch, list(self.local))
+
+
+_registry = None
+
+
+def get_presence():
+    global _registry
+    if _registry is None:
+        config = getattr(settings, 'PRESENCE', {})
+        backend_class = import_string(config.get('BACKEND', 'main.presence.InMemoryPresenceBackend'))
+        backend = backend_class(ttl=config.get('TTL', 90), **config.get('OPTIONS', {}))
+        _registry = PresenceRegistry(backend, grace=config.get('GRACE', 5))
+    return _registry
@@ -0,0 +1,286 @@
+"""
+Deterministic replay of captured traffic (see main/capture.py).
+
+The database is seeded from the capture itself: one user per hashed user,
+one accepted connection per hashed connection id (between the users seen
+sending on it, or with a stand-in peer) and between users that addressed
+each other by name. Sockets are then opened and frames sent on the captured
+timeline, `speed` times faster, through core.asgi.application. Lengths are
+turned back into payloads of the same size; ids only known to the original
+database (message ids, cursors) are taken from what the replaying socket has
+received. Thumbnail uploads are skipped.
+
+Requests that answer the sender are timed as in main/loadtest.py, and the
+DB executor counts the SQL queries of every action. compare() checks a run
+against a stored baseline.
+"""
+import asyncio
+import io
+import json
+import random
+
+from django.core.management import call_command
+
+from . import payloads, search
+from .capture import USER_FIELDS, USER_LIST_FIELDS, CONNECTION_FIELDS, LENGTH_FIELDS, PAYLOAD_FIELDS
+from .dedup import recent_sends
+from .executor import query_counts
+from .graph import graph
+from .loadtest import TIMEOUT, Client, CommunicatorSocket, Recorder
+from .models import User, Connection, Message
+from .views import get_authenticated_user_data
+
+# Sources answered on the sender's own socket, timed until the answer arrives
+TIMED = ('message.send', 'message.list', 'friend.list', 'request.list', 'search', 'presence.watch', 'sync')
+SKIPPED = ('thumbnail',)
+
+
+def load(path):
+    with open(path) as f:
+        lines = [json.loads(line) for line in f if line.strip()]
+    if not lines or lines[0].get('v') != 1:
+        raise ValueError(f'{path} is not a traffic capture')
+    return lines[1:]
+
+
+def seed(records, history=20):
+    """
+    Create the users and connections the capture refers to. Returns
+    {hashed connection id: connection id}.
+    """
+    owners = {}
+    users = set()
+    participants = {}
+    pairs = set()
+    for record in records:
+        if record.get('e') == 'open':
+            owners[record['s']] = record['u']
+            users.add(record['u'])
+        frame = record.get('f')
+        if not frame or record['s'] not in owners:
+            continue
+        user = owners[record['s']]
+        for key in CONNECTION_FIELDS:
+            if frame.get(key):
+                participants.setdefault(frame[key], []).append(user)
+        named = [frame[key] for key in USER_FIELDS if frame.get(key)]
+        named += [name for key in USER_LIST_FIELDS for name in frame.get(key) or ()]
+        for name in named:
+            users.add(name)
+            if name != user:
+                pairs.add(tuple(sorted((user, name))))
+
+    ends = {}
+    for connection_id, seen in participants.items():
+        seen = list(dict.fromkeys(seen))
+        # A connection only one side used gets a stand-in peer
+        ends[connection_id] = (seen[0], seen[1] if len(seen) > 1 else 'p' + connection_id[1:])
+        users.update(ends[connection_id])
+        pairs.discard(tuple(sorted(ends[connection_id])))
+
+    User.objects.bulk_create(User(username=name) for name in sorted(users))
+    by_name = User.objects.in_bulk(list(users), field_name='username')
+    ids = {}
+    for connection_id, (sender, receiver) in sorted(ends.items()):
+        ids[connection_id] = Connection.objects.create(sender=by_name[sender], receiver=by_name[receiver], accepted=True).id
+    Connection.objects.bulk_create(
+        Connection(sender=by_name[a], receiver=by_name[b], accepted=True) for a, b in sorted(pairs)
+    )
+    Message.objects.bulk_create(
+        Message(connection=connection, sender=connection.sender, text=f'seed {n}', status='read')
+        for connection in Connection.objects.all()
+        for n in range(history)
+    )
+    # bulk_create skips the signals that keep these in step
+    search.rebuild()
+    graph.clear()
+    payloads.cards.clear()
+    recent_sends.clear()
+    call_command('rebuild_connection_stats', stdout=io.StringIO())
+    return ids
+
+
+class ReplaySocket:
+    def __init__(self):
+        self.client = None
+        self.last_message_id = None
+        self.next_cursor = None
+        self.sync_cursor = None
+        self.nonce = 0
+        self.pending_search = None
+        self.waits = []
+
+    async def on_event(self, event):
+        data = event.get('data')
+        if event.get('source') == 'message.send' and isinstance(data, dict):
+            self.last_message_id = data.get('id')
+        elif event.get('source') == 'message.list' and isinstance(data, dict):
+            self.next_cursor = data.get('next')
+        elif event.get('source') == 'sync' and isinstance(data, dict):
+            self.sync_cursor = data.get('cursor')
+
+
+class Replay:
+    def __init__(self, records, connection_ids, speed=1.0, seed=0):
+        self.records = records
+        self.connection_ids = connection_ids
+        self.speed = speed
+        self.rng = random.Random(seed)
+        self.usernames = sorted(User.objects.values_list('username', flat=True))
+        self.tokens = {
+            user.username: get_authenticated_user_data(user)['tokens']['access']
+            for user in User.objects.all()
+        }
+        self.recorder = Recorder()
+        self.sent = 0
+        self.skipped = 0
+
+    def expand(self, socket, frame):
+        # Turn a captured frame back into one the consumers accept, or None to skip it
+        frame = dict(frame)
+        if frame.get('source') in SKIPPED:
+            return None
+        for key in CONNECTION_FIELDS:
+            if frame.get(key):
+                frame[key] = self.connection_ids.get(frame[key])
+        for key in LENGTH_FIELDS:
+            if key in frame:
+                length = max(1, frame[key] or 0)
+                if key == 'query':
+                    frame[key] = self.rng.choice(self.usernames)[:length]
+                else:
+                    socket.nonce += 1
+                    frame[key] = f'{socket.nonce} '.ljust(length, 'x')
+        for key in PAYLOAD_FIELDS:
+            if key in frame:
+                frame[key] = {'sdp': 'x' * max(1, frame[key] - 11)}
+        if frame.get('message_id') is not None:
+            if socket.last_message_id is None:
+                return None
+            frame['message_id'] = socket.last_message_id
+        if frame.get('up_to') is not None:
+            frame['up_to'] = socket.last_message_id or 2 ** 31 - 1
+        if frame.get('cursor') is True:
+            # Synced earlier in the capture: from what this run last heard, else from scratch
+            frame['cursor'] = socket.sync_cursor
+        if frame.get('next') is True:
+            frame['next'] = socket.next_cursor
+        return frame
+
+    async def send(self, socket, frame):
+        source = frame.get('source')
+        if source not in TIMED:
+            await socket.client.socket.send(frame)
+            return
+        if source == 'message.send' and frame.get('client_id'):
+            # A resend is answered with the first message, text and all
+            client_id = frame['client_id']
+            matches = lambda e: e.get('source') == 'message.send' and e['data'].get('client_id') == client_id
+        elif source == 'message.send':
+            text = frame['text']
+            matches = lambda e: e.get('source') == 'message.send' and e['data'].get('text') == text
+        else:
+            matches = lambda e: e.get('source') == source
+        future = socket.client.expect(matches)
+        if source == 'search':
+            # The consumer drops a search superseded within its debounce, only the last one answers
+            if socket.pending_search is not None:
+                socket.pending_search.cancel()
+            socket.pending_search = future
+        start = asyncio.get_running_loop().time()
+        await socket.client.socket.send(frame)
+
+        async def wait():
+            try:
+                await asyncio.wait_for(future, TIMEOUT)
+            except asyncio.CancelledError:
+                return
+            except asyncio.TimeoutError:
+                self.recorder.error(source)
+            else:
+                self.recorder.record(source, asyncio.get_running_loop().time() - start)
+        socket.waits.append(asyncio.create_task(wait()))
+
+    async def run_socket(self, record, queue, application):
+        query = f"?token={self.tokens[record['u']]}&batch=1"
+        path = f"/chat/{query}" if record['k'] == 'chat' else f"/ws/video/{query}"
+        socket = ReplaySocket()
+        socket.client = Client(CommunicatorSocket(application, path), socket.on_event)
+        await socket.client.start()
+        while True:
+            frame = await queue.get()
+            if frame is None:
+                break
+            frame = self.expand(socket, frame)
+            if frame is None:
+                self.skipped += 1
+                continue
+            self.sent += 1
+            await self.send(socket, frame)
+        # Answers still in flight arrive before the socket goes
+        await asyncio.gather(*socket.waits)
+        await socket.client.close()
+
+    async def drive(self):
+        from channels.routing import get_default_application
+
+        application = get_default_application()
+        loop = asyncio.get_running_loop()
+        queues = {}
+        tasks = []
+        start = loop.time()
+        for record in self.records:
+            delay = record['t'] / self.speed - (loop.time() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if record.get('e') == 'open':
+                queues[record['s']] = asyncio.Queue()
+                tasks.append(asyncio.create_task(self.run_socket(record, queues[record['s']], application)))
+            elif record.get('e') == 'close':
+                queue = queues.pop(record['s'], None)
+                if queue is not None:
+                    queue.put_nowait(None)
+            elif record['s'] in queues:
+                queues[record['s']].put_nowait(record['f'])
+        # Close what the capture left open
+        for queue in queues.values():
+            queue.put_nowait(None)
+        await asyncio.gather(*tasks)
+        return loop.time() - start
+
+    def run(self):
+        query_counts.reset()
+        query_counts.enabled = True
+        try:
+            elapsed = asyncio.run(self.drive())
+        finally:
+            query_counts.enabled = False
+        return {
+            'config': {'speed': self.speed, 'frames': self.sent, 'skipped': self.skipped},
+            'elapsed_s': elapsed,
+            **self.recorder.report(elapsed),
+            'queries': query_counts.per_call(),
+        }
+
+
+def compare(results, baseline, latency_tolerance=0.25, min_ms=5.0):
+    """
+    Regressions of `results` against `baseline`, as readable strings:
+    p95 latency more than `latency_tolerance` (and `min_ms`) above the
+    baseline, or more SQL queries per call for any action.
+    """
+    regressions = []
+    for action, before in baseline.get('actions', {}).items():
+        after = results.get('actions', {}).get(action)
+        if after is None:
+            continue
+        limit = max(before['p95_ms'] * (1 + latency_tolerance), before['p95_ms'] + min_ms)
+        if after['p95_ms'] > limit:
+            regressions.append(f"{action}: p95 {before['p95_ms']:.1f} ms -> {after['p95_ms']:.1f} ms")
+        if after['errors'] > before['errors']:
+            regressions.append(f"{action}: errors {before['errors']} -> {after['errors']}")
+    for action, before in baseline.get('queries', {}).items():
+        after = results.get('queries', {}).get(action)
+        if after is not None and after > before + 1e-6:
+            regressions.append(f"{action}: {before:.2f} -> {after:.2f} queries per call")
+    return regressions
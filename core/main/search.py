@@ -0,0 +1,217 @@
+"""
+User search index.
+
+On SQLite users are mirrored into an FTS5 table (main_user_search, created by
+migration 0007) with prefix indexes, kept in sync by the User save/delete
+signals in main/signals.py. A query matches users where every word is a
+prefix of a word in their username, first or last name, ranked with bm25 so
+username hits come first. Other databases fall back to indexed istartswith
+lookups.
+"""
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+
+from .models import User
+
+TABLE = 'main_user_search'
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 50
+# bm25 column weights: username, first_name, last_name
+WEIGHTS = '10.0, 2.0, 2.0'
+
+
+def uses_fts():
+    return connection.vendor == 'sqlite'
+
+
+def tokens(query):
+    # Same word split as the FTS5 unicode61 tokenizer (underscore separates words)
+    return re.findall(r'[^\W_]+', (query or '').lower())
+
+
+def limit_and_offset(limit, offset):
+    try:
+        limit = max(1, min(int(limit), MAX_LIMIT))
+    except (TypeError, ValueError):
+        limit = DEFAULT_LIMIT
+    try:
+        offset = max(0, int(offset))
+    except (TypeError, ValueError):
+        offset = 0
+    return limit, offset
+
+
+def _query_rows(words, limit, offset=0):
+    # Ranked (id, username, first_name, last_name) rows straight from the index
+    if not uses_fts():
+        users = User.objects.all()
+        for word in words:
+            users = users.filter(
+                Q(username__istartswith=word) | Q(first_name__istartswith=word) | Q(last_name__istartswith=word)
+            )
+        return list(users.order_by('username').values_list('pk', 'username', 'first_name', 'last_name')[offset:offset + limit])
+
+    match = ' '.join(f'"{word}"*' for word in words)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT rowid, username, first_name, last_name FROM {TABLE} WHERE {TABLE} MATCH %s '
+            f'ORDER BY bm25({TABLE}, {WEIGHTS}), rowid LIMIT %s OFFSET %s',
+            [match, limit, offset]
+        )
+        return cursor.fetchall()
+
+
+def row_matches(row, words):
+    # Python twin of the index match: every word prefixes a word of the row
+    row_tokens = tokens(' '.join(row[1:]))
+    return all(any(token.startswith(word) for token in row_tokens) for word in words)
+
+
+class PrefixCache:
+    """
+    Shared LRU + TTL cache of search results keyed by query words.
+
+    Each entry holds up to `rows` ranked rows and whether that is the whole
+    match set. A complete entry for "ab" answers "abc" by filtering its rows,
+    so typing a longer query rarely reaches the index.
+    """
+
+    def __init__(self, size=1024, ttl=60, rows=200):
+        self.size = size
+        self.ttl = ttl
+        self.rows = rows
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped by every invalidation, so rows read before one are not stored
+        self._generation = 0
+
+    def _get(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[2] < now:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _put(self, key, rows, complete, now):
+        self._entries[key] = (rows, complete, now + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def _broader(self, words):
+        # Queries whose match set contains this one: shorter last word, then fewer words
+        words = list(words)
+        while words:
+            last = words.pop()
+            for end in range(len(last) - 1, 0, -1):
+                yield tuple(words) + (last[:end],)
+            if words:
+                yield tuple(words)
+
+    def lookup(self, words):
+        """
+        (rows, complete) for the query words, from the cache when possible.
+        """
+        key = tuple(words)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._get(key, now)
+            if entry:
+                return entry[0], entry[1]
+            for broader in self._broader(words):
+                entry = self._get(broader, now)
+                if entry and entry[1]:
+                    rows = [row for row in entry[0] if row_matches(row, words)]
+                    self._put(key, rows, True, now)
+                    return rows, True
+            generation = self._generation
+        rows = _query_rows(words, self.rows + 1)
+        complete = len(rows) <= self.rows
+        rows = rows[:self.rows]
+        with self._lock:
+            if generation == self._generation:
+                self._put(key, rows, complete, time.monotonic())
+        return rows, complete
+
+    def invalidate_user(self, user_id, names=()):
+        """
+        Drop entries that list the user or that their (new) names would now match.
+        """
+        row = (user_id, *names)
+        with self._lock:
+            self._generation += 1
+            stale = [
+                key for key, (rows, _, _) in self._entries.items()
+                if any(cached[0] == user_id for cached in rows) or (names and row_matches(row, key))
+            ]
+            for key in stale:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+
+_config = getattr(settings, 'SEARCH', {})
+cache = PrefixCache(
+    size=_config.get('CACHE_SIZE', 1024),
+    ttl=_config.get('CACHE_TTL', 60),
+    rows=_config.get('CACHE_ROWS', 200),
+)
+
+
+def search_user_ids(query, exclude_id=None, limit=DEFAULT_LIMIT, offset=0):
+    """
+    Ranked ids of users matching `query`, one page of at most `limit`.
+    """
+    words = tokens(query)
+    if not words:
+        return []
+    rows, complete = cache.lookup(words)
+    ids = [row[0] for row in rows if row[0] != exclude_id]
+    if complete or offset + limit <= len(ids):
+        return ids[offset:offset + limit]
+    # Deep page past what the cache keeps
+    rows = _query_rows(words, limit + 1, offset)
+    return [row[0] for row in rows if row[0] != exclude_id][:limit]
+
+
+def index_user(user):
+    if not uses_fts():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT OR REPLACE INTO {TABLE} (rowid, username, first_name, last_name) VALUES (%s, %s, %s, %s)',
+            [user.pk, user.username, user.first_name, user.last_name]
+        )
+
+
+def remove_user(pk):
+    if not uses_fts():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {TABLE} WHERE rowid = %s', [pk])
+
+
+def rebuild():
+    cache.clear()
+    if not uses_fts():
+        return 0
+    rows = list(User.objects.values_list('pk', 'username', 'first_name', 'last_name'))
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {TABLE}')
+        cursor.executemany(
+            f'INSERT INTO {TABLE} (rowid, username, first_name, last_name) VALUES (%s, %s, %s, %s)',
+            rows
+        )
+    return len(rows)
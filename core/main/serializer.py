@@ -1,12 +1,23 @@
 from mailbox import Message
 from rest_framework import serializers
 from .models import User , Connection , Message
+from . import thumbnails
 
 class UserSerializer(serializers.ModelSerializer):
+    # Users in lists get the small variant, ProfileSerializer the large one
+    thumbnail_size = thumbnails.LIST_SIZE
+    thumbnail = serializers.SerializerMethodField()
+
     class Meta:
         model = User
         fields = [ 'username', 'first_name', 'last_name', 'thumbnail' ]
 
+    def get_thumbnail(self, obj):
+        return thumbnails.variant_url(obj, self.thumbnail_size)
+
+class ProfileSerializer(UserSerializer):
+    thumbnail_size = thumbnails.PROFILE_SIZE
+
 class SignUPSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
@@ -54,10 +65,11 @@ class RequestSerializer(serializers.ModelSerializer):
 class FriendListSerializer(serializers.ModelSerializer):
     friend = serializers.SerializerMethodField()
     preview = serializers.SerializerMethodField()
+    unread = serializers.SerializerMethodField()
 
     class Meta:
         model = Connection
-        fields = ['id', 'friend', 'preview', 'updated']
+        fields = ['id', 'friend', 'preview', 'unread', 'updated']
 
     def get_friend(self, obj):
         if self.context.get("user") == obj.sender:
@@ -65,20 +77,17 @@ class FriendListSerializer(serializers.ModelSerializer):
         return UserSerializer(obj.sender).data
 
     def get_preview(self, obj):
-        # Get the latest message in this connection, regardless of sender
-        last_message = (
-            Message.objects
-            .filter(connection=obj)
-            .order_by('-created')
-            .first()
-        )
-        if last_message:
-            return last_message.text
+        # Latest message is kept on the connection, select_related('last_message') to avoid a query
+        if obj.last_message:
+            return obj.last_message.text
         return ""
 
+    def get_unread(self, obj):
+        return obj.unread_for(self.context.get("user"))
+
 class MessageSerializer(serializers.ModelSerializer):
     sender = UserSerializer(read_only=True)
 
     class Meta:
         model = Message
-        fields = ['id', 'connection', 'sender', 'text', 'created', 'status']
\ No newline at end of file
+        fields = ['id', 'connection', 'sender', 'text', 'created', 'status', 'client_id']
\ No newline at end of file
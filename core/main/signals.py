@@ -0,0 +1,43 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from . import payloads, search
+from .graph import graph
+from .models import User, Connection
+
+SEARCH_FIELDS = {'username', 'first_name', 'last_name'}
+
+
+@receiver(post_save, sender=User)
+def index_user(sender, instance, created, update_fields=None, **kwargs):
+    # Sign-ins save last_login only, nothing searchable changed
+    if update_fields is not None and not SEARCH_FIELDS.intersection(update_fields):
+        return
+    search.index_user(instance)
+    search.cache.invalidate_user(instance.pk, (instance.username, instance.first_name, instance.last_name))
+
+
+@receiver(post_delete, sender=User)
+def unindex_user(sender, instance, **kwargs):
+    search.remove_user(instance.pk)
+    search.cache.invalidate_user(instance.pk)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def forget_card(sender, instance, update_fields=None, **kwargs):
+    # New names or thumbnail: the cached profile card is stale
+    if update_fields is not None and not payloads.CARD_FIELDS.intersection(update_fields):
+        return
+    payloads.cards.invalidate(instance.pk)
+
+
+
+@receiver(post_save, sender=Connection)
+@receiver(post_delete, sender=Connection)
+def forget_connection(sender, instance, **kwargs):
+    # Requests made or accepted outside the consumers (admin, shell) reach the graph cache too
+    usernames = User.objects.filter(
+        pk__in=(instance.sender_id, instance.receiver_id)
+    ).values_list('username', flat=True)
+    graph.invalidate(list(usernames), [instance.pk])
@@ -1,3 +1,1303 @@
-from django.test import TestCase
+import asyncio
+import base64
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from channels.layers import InMemoryChannelLayer, channel_layers, get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.core.management import call_command
+from django.db import connection as db_connection, transaction
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from main import batching, calls, capture, checks, codecs, data, fanout, loadtest, logs, metrics, payloads, presence, replay, search, sync, thumbnails, writebehind
+from main.consumers import ChatConsumer, VideoCallConsumer
+from main.dedup import recent_sends
+from main.executor import DatabaseExecutor, query_counts
+from main.graph import graph
+from main.models import User, Connection, Change, Message
+from main.pagination import decode_cursor, encode_cursor, not_newer_than, older_than
+from main.serializer import MessageSerializer, RequestSerializer, FriendListSerializer
+
+
+def open_socket(consumer, user, path='chat/', subprotocols=None):
+    # A consumer instance with `user` already authenticated, as the JWT middleware would leave it
+    communicator = WebsocketCommunicator(consumer.as_asgi(), path, subprotocols=subprotocols)
+    communicator.scope['user'] = user
+    return communicator
+
+
+def fresh_layers():
+    # InMemoryChannelLayer queues belong to the event loop that made them; each test runs its own
+    channel_layers.backends.clear()
+
+
+class PresenceTests(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def backends(self, ttl=90):
+        return [
+            presence.InMemoryPresenceBackend(ttl=ttl),
+            presence.SQLitePresenceBackend(ttl=ttl, path=os.path.join(self.tmpdir.name, f'presence{ttl}.sqlite3'), cache_ttl=0),
+        ]
+
+    def test_online_until_the_last_socket_closes(self):
+        for backend in self.backends():
+            registry = presence.PresenceRegistry(backend, grace=0)
+
+            async def run():
+                steps = [
+                    await registry.connect('alice', 'phone'),
+                    await registry.connect('alice', 'tablet'),
+                    await registry.disconnect('alice', 'phone'),
+                    await registry.online(['alice', 'bob']),
+                    await registry.disconnect('alice', 'tablet'),
+                    await registry.online(['alice', 'bob']),
+                ]
+                registry.local.clear()
+                return steps
+            self.assertEqual(asyncio.run(run()), [True, False, False, {'alice'}, True, set()], type(backend).__name__)
+
+    def test_sockets_expire_without_heartbeat(self):
+        for backend in self.backends(ttl=0.05):
+            self.assertTrue(backend.add('alice', 'phone'))
+            self.assertTrue(backend.is_online('alice'))
+            time.sleep(0.1)
+            self.assertEqual(backend.count('alice'), 0, type(backend).__name__)
+            # The next socket counts as the first again
+            self.assertTrue(backend.add('alice', 'tablet'))
+
+    def test_offline_is_announced_after_the_grace_period(self):
+        registry = presence.PresenceRegistry(presence.InMemoryPresenceBackend(), grace=0.05)
+        announced = []
+
+        async def announce():
+            announced.append('alice')
+
+        async def run(back):
+            await registry.connect('alice', 'phone')
+            await registry.disconnect('alice', 'phone')
+            registry.schedule_offline('alice', announce)
+            if back == 'here':
+                await registry.connect('alice', 'phone')
+                # Peers never saw them leave, so nothing to announce
+                self.assertTrue(registry.cancel_offline('alice'))
+            elif back == 'elsewhere':
+                # A socket on another worker
+                registry.backend.add('alice', 'other-worker')
+            await asyncio.sleep(0.1)
+            registry.backend.remove('alice', 'phone')
+            registry.backend.remove('alice', 'other-worker')
+            registry.local.clear()
+
+        for back, expected in (('here', []), ('elsewhere', []), (None, ['alice'])):
+            announced.clear()
+            asyncio.run(run(back))
+            self.assertEqual(announced, expected, back)
+
+    def test_sqlite_calls_stay_off_the_event_loop(self):
+        threads = []
+
+        class Recording(presence.SQLitePresenceBackend):
+            def add(self, username, channel_name):
+                threads.append(threading.current_thread().name)
+                return super().add(username, channel_name)
+
+        registry = presence.PresenceRegistry(Recording(path=os.path.join(self.tmpdir.name, 'rec.sqlite3')), grace=0)
+
+        async def run():
+            await registry.connect('alice', 'phone')
+            registry.local.clear()
+        asyncio.run(run())
+        self.assertTrue(threads[0].startswith('db-presence'), threads)
+
+
+class MarkDeliveredTests(TransactionTestCase):
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.connection = Connection.objects.create(sender=self.alice, receiver=self.bob, accepted=True)
+
+    def test_only_messages_addressed_to_the_user(self):
+        for returning in (True, False):
+            Message.objects.all().delete()
+            carol = User.objects.create(username=f'carol{returning:d}')
+            pending = Connection.objects.create(sender=carol, receiver=self.bob)
+            to_bob = [
+                Message.objects.create(connection=self.connection, sender=self.alice, text=text) for text in ('one', 'two')
+            ]
+            Message.objects.create(connection=self.connection, sender=self.bob, text='from bob')
+            Message.objects.create(connection=self.connection, sender=self.alice, text='seen', status='read')
+            # Not a friend yet
+            Message.objects.create(connection=pending, sender=carol, text='hello?')
+            with mock.patch.object(db_connection.features, 'can_return_columns_from_insert', returning):
+                rows = Message.objects.mark_delivered_for(self.bob)
+                self.assertEqual(Message.objects.mark_delivered_for(self.bob), [])
+            self.assertEqual(sorted(rows), [(message.id, 'alice') for message in to_bob], returning)
+            self.assertEqual(
+                list(Message.objects.order_by('id').values_list('status', flat=True)),
+                ['delivered', 'delivered', 'sent', 'read', 'sent']
+            )
+
+
+class PaginationTests(TransactionTestCase):
+    def setUp(self):
+        graph.clear()
+        payloads.cards.clear()
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.connection = Connection.objects.create(sender=self.alice, receiver=self.bob, accepted=True)
+
+    def add(self, count, connection=None, created=None):
+        messages = Message.objects.bulk_create(
+            Message(connection=connection or self.connection, sender=self.alice, text=f'm{n}', status='read')
+            for n in range(count)
+        )
+        if created is not None:
+            Message.objects.filter(id__in=[message.id for message in messages]).update(created=created)
+        return [message.id for message in messages]
+
+    def pages(self, size, cursor=None):
+        ids = []
+        while True:
+            page, _ = asyncio.run(data.list_messages(self.alice, self.connection.id, cursor, size, False))
+            ids.append([message['id'] for message in page['messages']])
+            if not page['next']:
+                return ids
+            cursor = decode_cursor(page['next'])
+
+    def test_page_boundaries(self):
+        ids = self.add(4)
+        self.assertEqual(self.pages(4), [ids[::-1]])
+        more = self.add(1)
+        self.assertEqual(self.pages(4), [(ids + more)[:0:-1], [ids[0]]])
+
+    def test_ties_on_created(self):
+        # All in the same instant: id breaks the tie, nothing repeated or skipped
+        ids = self.add(7, created=timezone.now())
+        self.assertEqual(self.pages(3), [ids[:3:-1], ids[3:0:-1], [ids[0]]])
+
+    def test_bad_and_foreign_cursors(self):
+        for token in (None, '', 'not base64!', 12, encode_cursor(timezone.now(), 1)[:-3], 'eHx5'):
+            self.assertIsNone(decode_cursor(token), token)
+        ids = self.add(3)
+        other = Connection.objects.create(sender=self.alice, receiver=User.objects.create(username='carol'), accepted=True)
+        foreign = Message.objects.get(id=self.add(2, connection=other)[-1])
+        # Only a position: the page still comes from this conversation
+        self.assertEqual(self.pages(10, (foreign.created, foreign.id)), [ids[::-1]])
+
+    def test_cursor_filters_seek_on_created(self):
+        cursor = (timezone.now(), 10)
+        for bound in (older_than(cursor), not_newer_than(cursor)):
+            rows = Message.objects.filter(bound, connection_id=self.connection.id).order_by('-created', '-id')
+            sql, params = rows.query.sql_with_params()
+            with db_connection.cursor() as db:
+                db.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+                plan = ' '.join(row[-1] for row in db.fetchall())
+            # A range on created, not a walk over the whole conversation
+            self.assertIn('message_conn_created_id (connection_id=? AND created<?)', plan)
+
+
+class ConnectionStatsTests(TransactionTestCase):
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.connection = Connection.objects.create(sender=self.alice, receiver=self.bob, accepted=True)
+
+    def send(self, sender, text, status='sent'):
+        message = Message.objects.create(connection=self.connection, sender=sender, text=text, status=status)
+        Connection.record_message(message)
+        return message
+
+    def stats(self):
+        connection = Connection.objects.get(pk=self.connection.pk)
+        return connection.last_message_id, connection.receiver_unread, connection.sender_unread
+
+    def test_record_message_and_read(self):
+        self.send(self.alice, 'one')
+        self.send(self.alice, 'two')
+        last = self.send(self.bob, 'three')
+        self.assertEqual(self.stats(), (last.id, 2, 1))
+
+        Connection.record_read(self.connection.id, self.bob, 1)
+        self.assertEqual(self.stats(), (last.id, 1, 1))
+        # More than is unread stops at 0, and only touches the reader's side
+        Connection.record_read(self.connection.id, self.bob, 5)
+        self.assertEqual(self.stats(), (last.id, 0, 1))
+        Connection.record_read(self.connection.id, self.alice, 0)
+        self.assertEqual(self.stats(), (last.id, 0, 1))
+
+    def test_rebuild_connection_stats(self):
+        self.send(self.alice, 'read', status='read')
+        self.send(self.alice, 'unread')
+        last = self.send(self.bob, 'unread too', status='delivered')
+        empty = Connection.objects.create(sender=self.bob, receiver=User.objects.create(username='carol'), accepted=True)
+        Connection.objects.update(last_message=None, sender_unread=9, receiver_unread=9)
+
+        out = io.StringIO()
+        call_command('rebuild_connection_stats', stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'Rebuilt 2 connections')
+        self.assertEqual(self.stats(), (last.id, 1, 1))
+        empty = Connection.objects.get(pk=empty.pk)
+        self.assertEqual((empty.last_message_id, empty.sender_unread, empty.receiver_unread), (None, 0, 0))
+
+class ReadWatermarkTests(TransactionTestCase):
+    def setUp(self):
+        graph.clear()
+        payloads.cards.clear()
+        fresh_layers()
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.connection = Connection.objects.create(sender=self.alice, receiver=self.bob, accepted=True)
+
+    def message(self, sender, text):
+        message = Message.objects.create(connection=self.connection, sender=sender, text=text, status='delivered')
+        Connection.record_message(message)
+        return message
+
+    def test_up_to_marks_the_peers_messages_and_sends_one_receipt(self):
+        first = self.message(self.alice, 'one')
+        mine = self.message(self.bob, 'from bob, inside the range')
+        second = self.message(self.alice, 'two')
+        later = self.message(self.alice, 'after the watermark')
+
+        async def run():
+            alice = open_socket(ChatConsumer, self.alice)
+            bob = open_socket(ChatConsumer, self.bob)
+            await alice.connect()
+            await bob.connect()
+            frame = {'source': 'message.read', 'connection_id': self.connection.id, 'up_to': second.id}
+            await bob.send_json_to(frame)
+            receipt = await alice.receive_json_from()
+            # Nothing newly read the second time, so no second receipt
+            await bob.send_json_to(frame)
+            quiet = await alice.receive_nothing(timeout=0.2)
+            await alice.disconnect()
+            await bob.disconnect()
+            return receipt, quiet
+        receipt, quiet = asyncio.run(run())
+
+        self.assertEqual(receipt, {'source': 'message.read', 'data': {
+            'connection_id': self.connection.id, 'up_to': second.id, 'status': 'read'
+        }})
+        self.assertTrue(quiet)
+        statuses = dict(Message.objects.values_list('id', 'status'))
+        self.assertEqual(
+            [statuses[m.id] for m in (first, mine, second, later)],
+            ['read', 'delivered', 'read', 'delivered']
+        )
+        connection = Connection.objects.get(pk=self.connection.pk)
+        # bob read two of alice's three; alice has bob's one still unread
+        self.assertEqual((connection.receiver_unread, connection.sender_unread), (1, 1))
+
+    def test_only_the_other_participant_marks_a_message_read(self):
+        message = self.message(self.alice, 'hi')
+        carol = User.objects.create(username='carol')
+        # An outsider, and the sender, are ignored
+        for user in (carol, self.alice):
+            self.assertIsNone(asyncio.run(data.mark_read(user, message.id)))
+        self.assertEqual(Message.objects.get(pk=message.pk).status, 'delivered')
+        self.assertEqual(asyncio.run(data.mark_read(self.bob, message.id)), 'alice')
+        self.assertEqual(Message.objects.get(pk=message.pk).status, 'read')
+
+
+class ExecutorTests(SimpleTestCase):
+    def test_cancelled_while_queued_leaves_the_counters_straight(self):
+        executor = DatabaseExecutor('test', 1)
+        release = threading.Event()
+        ran = []
+        block = executor.wrap(lambda: release.wait(5))
+        work = executor.wrap(lambda: ran.append(True))
+
+        async def run():
+            first = asyncio.ensure_future(block())
+            queued = asyncio.ensure_future(work())
+            await asyncio.sleep(0.05)
+            self.assertEqual(executor.stats()['queued'], 1)
+            # Superseded before a thread was free
+            queued.cancel()
+            await asyncio.sleep(0.01)
+            self.assertTrue(queued.cancelled())
+            self.assertEqual(executor.stats()['queued'], 0)
+            release.set()
+            await first
+            await work()
+        asyncio.run(run())
+        executor.pool.shutdown(wait=True)
+        stats = executor.stats()
+        self.assertEqual((stats['queued'], stats['running'], ran), (0, 0, [True]))
+
+
+class SearchIndexTests(TransactionTestCase):
+    def setUp(self):
+        search.cache.clear()
+        self.addCleanup(search.cache.clear)
+
+    def found(self, query):
+        return [User.objects.get(pk=pk).username for pk in search.search_user_ids(query)]
+
+    def test_prefix_words_and_ranking(self):
+        User.objects.create(username='zed', first_name='Annika', last_name='Smith')
+        User.objects.create(username='annika_x', first_name='Bo')
+        User.objects.create(username='anders', last_name='Smithers')
+        User.objects.create(username='bob')
+        # A username hit ranks above a first name hit
+        self.assertEqual(self.found('anni'), ['annika_x', 'zed'])
+        self.assertEqual(self.found('an'), ['anders', 'annika_x', 'zed'])
+        # Every word must prefix some word of the user
+        self.assertEqual(self.found('an smith'), ['anders', 'zed'])
+        self.assertEqual(self.found('ann smithe'), [])
+        self.assertEqual(self.found('x'), ['annika_x'])
+        self.assertEqual(self.found('  '), [])
+
+    def test_profile_edits_keep_the_index_in_step(self):
+        user = User.objects.create(username='carol', first_name='Old')
+        self.assertEqual(self.found('old'), ['carol'])
+        user.first_name = 'Newname'
+        user.save(update_fields=['first_name'])
+        self.assertEqual(self.found('old'), [])
+        self.assertEqual(self.found('newn'), ['carol'])
+        user.delete()
+        self.assertEqual(self.found('newn'), [])
+
+    def test_rebuild_command(self):
+        User.objects.create(username='dora')
+        User.objects.create(username='dorian')
+        with db_connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {search.TABLE}')
+        search.cache.clear()
+        self.assertEqual(self.found('dor'), [])
+        out = io.StringIO()
+        call_command('rebuild_search_index', stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'Indexed 2 users')
+        self.assertEqual(sorted(self.found('dor')), ['dora', 'dorian'])
+
+
+class SearchCacheTests(SimpleTestCase):
+    def test_rows_read_before_an_invalidation_are_not_cached(self):
+        cache = search.PrefixCache()
+        queries = []
+
+        def query_rows(words, limit, offset=0):
+            queries.append(words)
+            if len(queries) == 1:
+                # A rename lands while the index is being read
+                cache.invalidate_user(7, ('alicia',))
+                return [(1, 'alice', '', '')]
+            return [(1, 'alice', '', ''), (7, 'alicia', '', '')]
+
+        with mock.patch.object(search, '_query_rows', query_rows):
+            self.assertEqual(cache.lookup(('ali',)), ([(1, 'alice', '', '')], True))
+            rows, complete = cache.lookup(('ali',))
+            # Read again instead of the stale rows
+            self.assertEqual([row[0] for row in rows], [1, 7])
+            cache.lookup(('ali',))
+        self.assertEqual(len(queries), 2)
+
+
+@mock.patch('main.consumers.SEARCH_DEBOUNCE', 0)
+class SearchSocketTests(TransactionTestCase):
+    def setUp(self):
+        graph.clear()
+        search.cache.clear()
+        fresh_layers()
+        self.alice = User.objects.create(username='alice')
+        User.objects.create(username='alfred')
+
+    def test_a_failed_search_is_logged_and_the_socket_keeps_serving(self):
+        async def run():
+            communicator = open_socket(ChatConsumer, self.alice)
+            await communicator.connect()
+            with mock.patch('main.data.search_users', side_effect=RuntimeError('index gone')):
+                await communicator.send_json_to({'source': 'search', 'query': 'al'})
+                quiet = await communicator.receive_nothing(timeout=0.2)
+            await communicator.send_json_to({'source': 'search', 'query': 'al'})
+            reply = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return quiet, reply
+        with self.assertLogs('main.consumers', 'ERROR') as logged:
+            quiet, reply = asyncio.run(run())
+        self.assertTrue(quiet)
+        self.assertEqual(logged.records[0].getMessage(), 'search failed')
+        self.assertEqual([user['username'] for user in reply['data']], ['alfred'])
+
+
+def png_bytes(color='red', size=(40, 30)):
+    from PIL import Image
+
+    out = io.BytesIO()
+    Image.new('RGB', size, color).save(out, 'PNG')
+    return out.getvalue()
+
+
+class ThumbnailTests(TransactionTestCase):
+    def setUp(self):
+        metrics.reset()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name))
+        self.alice = User.objects.create(username='alice')
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def upload(self, raw, name='me.png'):
+        return self.client.post('/api/thumbnail/', {'file': SimpleUploadedFile(name, raw)}, format='multipart')
+
+    def test_upload_renders_every_variant(self):
+        response = self.upload(png_bytes())
+        self.assertEqual(response.status_code, 200)
+        self.alice.refresh_from_db()
+        digest = self.alice.thumbnail_hash
+        self.assertEqual(len(digest), 64)
+        self.assertEqual(self.alice.thumbnail.name, thumbnails.variant_name(digest, max(thumbnails.SIZES)))
+        from PIL import Image
+        for size in thumbnails.SIZES:
+            with Image.open(default_storage.path(thumbnails.variant_name(digest, size))) as image:
+                self.assertEqual(image.size, (size, size))
+        self.assertEqual(metrics.http_requests.value('ThumbnailUpload', 200), 1)
+
+    def test_same_image_reuses_the_stored_variants(self):
+        raw = png_bytes('blue')
+        self.upload(raw)
+        bob = User.objects.create(username='bob')
+        with mock.patch.object(thumbnails, 'get_pool') as pool, \
+                TemporaryUploadedFile('other.png', 'image/png', len(raw), None) as uploaded:
+            uploaded.write(raw)
+            uploaded.seek(0)
+            thumbnails.store_thumbnail(bob, uploaded)
+        # Same hash, so nothing was rendered again
+        pool.assert_not_called()
+        self.alice.refresh_from_db()
+        self.assertEqual(bob.thumbnail_hash, self.alice.thumbnail_hash)
+
+    def test_oversize_uploads_are_refused(self):
+        with mock.patch.object(thumbnails, 'MAX_UPLOAD', 1000):
+            response = self.upload(png_bytes(size=(400, 400)) + os.urandom(2000))
+            self.assertEqual(response.status_code, 413)
+            self.assertEqual(response.json(), {'error': 'Image is too large'})
+            # Past the limit while streaming, whatever the body claimed
+            handler = thumbnails.UploadLimitHandler()
+            handler.handle_raw_input(None, {}, 10, 'boundary')
+            self.assertEqual(handler.receive_data_chunk(b'x' * 600, 0), b'x' * 600)
+            with self.assertRaises(thumbnails.TooLarge):
+                handler.receive_data_chunk(b'x' * 600, 600)
+            # The pipeline checks on its own too, for the socket upload
+            with self.assertRaises(thumbnails.TooLarge):
+                thumbnails.store_base64_thumbnail(self.alice, base64.b64encode(os.urandom(2000)).decode())
+        self.alice.refresh_from_db()
+        self.assertEqual(self.alice.thumbnail_hash, '')
+        self.assertEqual(os.listdir(settings.MEDIA_ROOT), [])
+
+    def test_bad_requests(self):
+        self.assertEqual(self.upload(b'not an image').json(), {'error': 'Could not read image'})
+        response = self.client.post('/api/thumbnail/', {}, format='multipart')
+        self.assertEqual((response.status_code, response.json()), (400, {'error': 'file is required'}))
+        self.client.force_authenticate(None)
+        self.assertEqual(self.upload(png_bytes()).status_code, 401)
+
+
+class CodecTests(TransactionTestCase):
+    def setUp(self):
+        graph.clear()
+        fresh_layers()
+        self.alice = User.objects.create(username='alice')
+
+    def exchange(self, consumer, subprotocols, frames, path='chat/'):
+        # (negotiated subprotocol, raw frames received after each one sent)
+        async def run():
+            communicator = open_socket(consumer, self.alice, path, subprotocols)
+            connected, subprotocol = await communicator.connect()
+            self.assertTrue(connected)
+            if consumer is VideoCallConsumer:
+                received = [await communicator.receive_from()]
+            else:
+                received = []
+            for frame in frames:
+                if isinstance(frame, bytes):
+                    await communicator.send_to(bytes_data=frame)
+                else:
+                    await communicator.send_to(text_data=frame)
+                received.append(await communicator.receive_from())
+            await communicator.disconnect()
+            return subprotocol, received
+        return asyncio.run(run())
+
+    @skipUnless(codecs.msgpack, 'msgpack is not installed')
+    def test_chat_msgpack_round_trip(self):
+        frame = codecs.msgpack.packb({'source': 'friend.list'})
+        subprotocol, received = self.exchange(ChatConsumer, ['msgpack', 'json'], [frame, json.dumps({'source': 'friend.list'})])
+        self.assertEqual(subprotocol, 'msgpack')
+        # A JSON text frame is still understood on a msgpack socket, answered in msgpack
+        for reply in received:
+            self.assertIsInstance(reply, bytes)
+            self.assertEqual(codecs.msgpack.unpackb(reply), {'source': 'friend.list', 'data': []})
+
+    def test_chat_json_fallback(self):
+        for subprotocols in (None, ['cbor', 'json'], ['cbor']):
+            subprotocol, received = self.exchange(ChatConsumer, subprotocols, [json.dumps({'source': 'friend.list'})])
+            self.assertEqual(subprotocol, 'json' if subprotocols == ['cbor', 'json'] else None)
+            self.assertEqual(json.loads(received[0]), {'source': 'friend.list', 'data': []})
+
+    @skipUnless(codecs.msgpack, 'msgpack is not installed')
+    def test_video_msgpack_round_trip(self):
+        subprotocol, received = self.exchange(
+            VideoCallConsumer, ['msgpack'], [codecs.msgpack.packb({'action': 'ping'}), b'\xc1'], path='ws/video/'
+        )
+        self.assertEqual(subprotocol, 'msgpack')
+        welcome, pong, error = [codecs.msgpack.unpackb(frame) for frame in received]
+        self.assertEqual((welcome['action'], welcome['username']), ('connection_success', 'alice'))
+        self.assertEqual(pong, {'action': 'pong'})
+        self.assertEqual(error, {'action': 'error', 'message': 'Invalid frame format'})
+
+    def test_video_json_fallback(self):
+        subprotocol, received = self.exchange(VideoCallConsumer, None, [json.dumps({'action': 'ping'})], path='ws/video/')
+        self.assertIsNone(subprotocol)
+        self.assertEqual(json.loads(received[0])['action'], 'connection_success')
+        self.assertEqual(json.loads(received[1]), {'action': 'pong'})
+
+
+@mock.patch.object(batching, 'WINDOW', 0.3)
+@mock.patch.object(batching, 'BYPASS', {'urgent'})
+class OutboundBatchTests(TransactionTestCase):
+    def setUp(self):
+        graph.clear()
+        fresh_layers()
+        metrics.reset()
+        self.alice = User.objects.create(username='alice')
+
+    def deliver(self, sources, path='chat/?batch=1', frames=1):
+        # Frames the socket sends for events to the user's group, one per source
+        async def run():
+            communicator = open_socket(ChatConsumer, self.alice, path)
+            await communicator.connect()
+            layer = get_channel_layer()
+            for i, source in enumerate(sources):
+                await layer.group_send('alice', {'type': 'broadcast_group', 'source': source, 'data': i})
+            received = [await communicator.receive_json_from() for _ in range(frames)]
+            self.assertTrue(await communicator.receive_nothing(timeout=0.4))
+            await communicator.disconnect()
+            return received
+        return asyncio.run(run())
+
+    def test_events_in_one_window_go_out_as_one_batch(self):
+        received = self.deliver(['a', 'b', 'c'])
+        self.assertEqual(received, [{'source': 'batch', 'data': [
+            {'source': 'a', 'data': 0}, {'source': 'b', 'data': 1}, {'source': 'c', 'data': 2}
+        ]}])
+        self.assertIn('ws_outbound_batch_size_bucket{le="5"} 1', metrics.render())
+
+    def test_a_lone_event_is_sent_unwrapped(self):
+        self.assertEqual(self.deliver(['a']), [{'source': 'a', 'data': 0}])
+
+    def test_max_events_flushes_without_waiting_for_the_window(self):
+        with mock.patch.object(batching, 'MAX_EVENTS', 3):
+            received = self.deliver(['a'] * 5, frames=2)
+        self.assertEqual([[event['data'] for event in frame['data']] for frame in received], [[0, 1, 2], [3, 4]])
+
+    def test_bypass_flushes_pending_and_goes_out_alone(self):
+        received = self.deliver(['a', 'b', 'urgent'], frames=2)
+        self.assertEqual(received, [
+            {'source': 'batch', 'data': [{'source': 'a', 'data': 0}, {'source': 'b', 'data': 1}]},
+            {'source': 'urgent', 'data': 2},
+        ])
+
+    def test_without_batch_every_event_is_its_own_frame(self):
+        received = self.deliver(['a', 'b'], path='chat/', frames=2)
+        self.assertEqual(received, [{'source': 'a', 'data': 0}, {'source': 'b', 'data': 1}])
+
+
+class FanoutTests(SimpleTestCase):
+    def test_in_memory_send_reaches_each_live_member_once(self):
+        async def run():
+            layer = InMemoryChannelLayer(group_expiry=60)
+            await layer.group_add('alice', 'both')
+            await layer.group_add('bob', 'both')
+            await layer.group_add('bob', 'bob-only')
+            await layer.group_add('alice', 'stale')
+            # Joined longer ago than the group expiry
+            layer.groups['alice']['stale'] -= 120
+            await fanout.group_send_many(layer, ['alice', 'bob', 'alice', 'nobody'], {'type': 'hello'})
+            received = {}
+            for channel in ('both', 'bob-only', 'stale'):
+                while True:
+                    try:
+                        message = await asyncio.wait_for(layer.receive(channel), 0.05)
+                    except asyncio.TimeoutError:
+                        break
+                    received.setdefault(channel, []).append(message)
+            return layer, received
+        layer, received = asyncio.run(run())
+        self.assertEqual(received, {'both': [{'type': 'hello'}], 'bob-only': [{'type': 'hello'}]})
+        self.assertNotIn('stale', layer.groups['alice'])
+
+    def test_in_memory_layer_without_the_internals_falls_back_to_group_send(self):
+        class Changed(InMemoryChannelLayer):
+            # As if a Channels upgrade had renamed it
+            _clean_expired = None
+
+        self.assertTrue(fanout._in_memory_internals(InMemoryChannelLayer()))
+        self.assertFalse(fanout._in_memory_internals(Changed()))
+
+        async def run():
+            layer = InMemoryChannelLayer()
+            await layer.group_add('alice', 'one')
+            await layer.group_add('bob', 'one')
+            with mock.patch.object(fanout, '_in_memory_internals', return_value=False), \
+                    mock.patch.object(layer, 'group_send', wraps=layer.group_send) as group_send:
+                await fanout.group_send_many(layer, ['alice', 'bob'], {'type': 'hello'})
+            received = [await layer.receive('one') for _ in range(2)]
+            return group_send.call_count, received
+        sends, received = asyncio.run(run())
+        self.assertEqual(sends, 2)
+        self.assertEqual(received, [{'type': 'hello'}] * 2)
+
+
+class PresenceWatchTests(TransactionTestCase):
+    def setUp(self):
+        graph.clear()
+        fresh_layers()
+        self.enterContext(mock.patch.object(
+            presence, '_registry', presence.PresenceRegistry(presence.InMemoryPresenceBackend(), grace=0)
+        ))
+        self.alice, self.bob, self.carol, self.dave = [
+            User.objects.create(username=name) for name in ('alice', 'bob', 'carol', 'dave')
+        ]
+        Connection.objects.create(sender=self.alice, receiver=self.bob, accepted=True)
+        Connection.objects.create(sender=self.dave, receiver=self.bob, accepted=True)
+        # Asked, not accepted: not a friend yet
+        Connection.objects.create(sender=self.alice, receiver=self.carol)
+
+    def test_status_reaches_only_sockets_watching_a_friend(self):
+        async def run():
+            alice = open_socket(ChatConsumer, self.alice)
+            dave = open_socket(ChatConsumer, self.dave)
+            await alice.connect()
+            await dave.connect()
+            await alice.send_json_to({'source': 'presence.watch', 'usernames': ['bob', 'carol', 'nobody']})
+            watched = await alice.receive_json_from()
+
+            # Carol is not alice's friend, so her coming online stays quiet
+            carol = open_socket(ChatConsumer, self.carol)
+            await carol.connect()
+            self.assertTrue(await alice.receive_nothing(timeout=0.1))
+
+            bob = open_socket(ChatConsumer, self.bob)
+            await bob.connect()
+            online = await alice.receive_json_from()
+            await bob.disconnect()
+            offline = await alice.receive_json_from()
+            # Dave is bob's friend but is not showing him
+            self.assertTrue(await dave.receive_nothing(timeout=0.1))
+            for communicator in (alice, carol, dave):
+                await communicator.disconnect()
+            return watched, online, offline
+        watched, online, offline = asyncio.run(run())
+        self.assertEqual(watched, {'source': 'presence.watch', 'data': {'bob': False}})
+        self.assertEqual(online, {'source': 'user.status', 'data': {'username': 'bob', 'online': True}})
+        self.assertEqual(offline, {'source': 'user.status', 'data': {'username': 'bob', 'online': False}})
+
+
+class CallSessionTests(SimpleTestCase):
+    def setUp(self):
+        self.calls = calls.CallRegistry()
+
+    def test_a_user_in_another_call_is_busy(self):
+        session = self.calls.start('alice', 'bob')
+        for caller, recipient in (('carol', 'bob'), ('carol', 'alice'), ('bob', 'carol')):
+            with self.assertRaises(calls.Busy):
+                self.calls.start(caller, recipient)
+        # Calling the same person again replaces the ringing session
+        again = self.calls.start('bob', 'alice')
+        self.assertNotEqual(again.id, session.id)
+        self.assertEqual(self.calls.active_count(), 1)
+
+    def test_hang_up_frees_both_users(self):
+        self.calls.start('alice', 'bob')
+        self.assertEqual(self.calls.apply('bob', 'alice', 'accept').state, calls.ACTIVE)
+        # Not their call
+        self.assertIsNone(self.calls.apply('carol', 'bob', 'end-call'))
+        session = self.calls.apply('alice', 'bob', 'end-call')
+        self.assertEqual(session.state, calls.ENDED)
+        self.assertIsNone(self.calls.find('bob', 'alice'))
+        self.assertIsNone(self.calls.apply('bob', 'alice', 'answer'))
+        self.calls.start('carol', 'bob')
+
+    def test_decline_ends_a_ringing_call(self):
+        self.calls.start('alice', 'bob')
+        self.assertEqual(self.calls.apply('bob', 'alice', 'decline').state, calls.ENDED)
+        self.assertEqual(self.calls.active_count(), 0)
+
+    def test_sessions_time_out(self):
+        with mock.patch.object(calls, 'RINGING_TTL', -1):
+            self.calls.start('alice', 'bob')
+        # Nobody picked up in time
+        self.assertIsNone(self.calls.find('alice', 'bob'))
+        self.calls.start('carol', 'bob')
+
+        self.calls.start('alice', 'dave')
+        with mock.patch.object(calls, 'ACTIVE_TTL', -1):
+            self.calls.apply('dave', 'alice', 'accept')
+        # Active, but silent for longer than ACTIVE_TTL
+        self.assertIsNone(self.calls.apply('alice', 'dave', 'candidate'))
+        self.assertEqual(self.calls.active_count(), 1)
+
+    def test_callee_busy_on_their_worker_is_reported_to_the_caller(self):
+        fresh_layers()
+        calls.calls.clear()
+        self.addCleanup(calls.calls.clear)
+
+        async def run():
+            carol = open_socket(VideoCallConsumer, User(username='carol'), 'ws/video/')
+            bob = open_socket(VideoCallConsumer, User(username='bob'), 'ws/video/')
+            for communicator in (carol, bob):
+                await communicator.connect()
+                await communicator.receive_json_from()
+            # bob's worker has him in a call carol's worker never heard of
+            calls.calls.start('bob', 'dave')
+            await get_channel_layer('signaling').group_send('video_bob', {
+                'type': 'call.signal', 'action': 'call', 'call_id': 'c1', 'caller': 'carol', 'recipient': 'bob',
+            })
+            busy = await carol.receive_json_from()
+            rang = not await bob.receive_nothing(timeout=0.1)
+            for communicator in (carol, bob):
+                await communicator.disconnect()
+            return busy, rang
+        busy, rang = asyncio.run(run())
+        self.assertEqual(busy, {'action': 'busy', 'recipient': 'bob'})
+        self.assertFalse(rang)
+        self.assertEqual(calls.calls.find('bob', 'dave').state, calls.RINGING)
+
+
+class CandidateBatchTests(TransactionTestCase):
+    def setUp(self):
+        fresh_layers()
+        calls.calls.clear()
+        self.addCleanup(calls.calls.clear)
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+
+    def call(self, script):
+        # Open both video sockets, ring bob, then run script(alice, bob)
+        async def run():
+            alice = open_socket(VideoCallConsumer, self.alice, 'ws/video/')
+            bob = open_socket(VideoCallConsumer, self.bob, 'ws/video/')
+            for communicator in (alice, bob):
+                await communicator.connect()
+                await communicator.receive_json_from()
+            await alice.send_json_to({'action': 'call', 'recipient': 'bob'})
+            self.assertEqual((await bob.receive_json_from())['action'], 'call')
+            try:
+                return await script(alice, bob)
+            finally:
+                for communicator in (alice, bob):
+                    await communicator.disconnect()
+        return asyncio.run(run())
+
+    @mock.patch('main.consumers.CANDIDATE_WINDOW', 0.1)
+    def test_candidates_in_one_window_go_out_as_one_frame(self):
+        async def script(alice, bob):
+            for candidate in ('c1', 'c2', 'c3'):
+                await alice.send_json_to({'action': 'candidate', 'recipient': 'bob', 'candidate': candidate})
+            # Nothing until the window closes
+            self.assertTrue(await bob.receive_nothing(timeout=0.05))
+            frame = await bob.receive_json_from()
+            await alice.send_json_to({'action': 'candidate', 'recipient': 'bob', 'candidate': 'c4'})
+            return frame, await bob.receive_json_from()
+        first, second = self.call(script)
+        self.assertEqual((first['action'], first['candidates'], first['sender']), ('candidates', ['c1', 'c2', 'c3'], 'alice'))
+        self.assertEqual(second['candidates'], ['c4'])
+        self.assertEqual(first['call_id'], calls.calls.find('alice', 'bob').id)
+
+    @mock.patch('main.consumers.CANDIDATE_WINDOW', 5)
+    def test_candidates_sent_before_the_answer_arrive_before_it(self):
+        async def script(alice, bob):
+            await alice.send_json_to({'action': 'offer', 'recipient': 'bob', 'offer': 'sdp-offer'})
+            self.assertEqual((await bob.receive_json_from())['action'], 'offer')
+            for candidate in ('b1', 'b2'):
+                await bob.send_json_to({'action': 'candidate', 'recipient': 'alice', 'candidate': candidate})
+            await bob.send_json_to({'action': 'answer', 'recipient': 'alice', 'answer': 'sdp-answer'})
+            # The answer flushes the pending batch without waiting out the window
+            return [await alice.receive_json_from() for _ in range(2)]
+        candidates, answer = self.call(script)
+        self.assertEqual((candidates['action'], candidates['candidates']), ('candidates', ['b1', 'b2']))
+        self.assertEqual((answer['action'], answer['answer']), ('answer', 'sdp-answer'))
+        # Signaling stays off the chat layer
+        self.assertNotIn('video_alice', get_channel_layer().groups)
+
+
+class LoadHarnessTests(TransactionTestCase):
+    def setUp(self):
+        search.cache.clear()
+
+    def test_short_run_covers_every_action(self):
+        usernames = loadtest.seed(users=4, friends=1, history=3)
+        results = loadtest.run_load(usernames, duration=2, think=0.05, seed=1)
+        self.assertEqual(results['config']['users'], 4)
+        self.assertEqual(results['total']['errors'], 0)
+        for action in loadtest.DEFAULT_MIX:
+            self.assertIn(action, results['actions'])
+            self.assertGreater(results['actions'][action]['count'], 0)
+            self.assertGreater(results['actions'][action]['p50_ms'], 0)
+
+
+class CaptureReplayTests(TransactionTestCase):
+    def setUp(self):
+        search.cache.clear()
+        capture._capture = None
+        self.path = tempfile.mktemp(suffix='.jsonl')
+
+    def tearDown(self):
+        if capture._capture is not None:
+            capture._capture.close()
+        capture._capture = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_capture_hides_content(self):
+        traffic = capture.TrafficCapture(self.path, salt='test')
+        frame = traffic.anonymize({
+            'source': 'message.send', 'connection_id': 7, 'text': 'secret words', 'next': 'cursor', 'page_size': 20
+        })
+        self.assertEqual(frame['source'], 'message.send')
+        self.assertEqual(frame['connection_id'], traffic.connection(7))
+        self.assertEqual(frame['text'], len('secret words'))
+        self.assertEqual((frame['next'], frame['page_size']), (True, 20))
+        self.assertNotIn('secret', json.dumps(frame))
+
+    def test_replay_matches_its_own_baseline(self):
+        usernames = loadtest.seed(users=4, friends=1, history=3)
+        with override_settings(CAPTURE={'ENABLED': True, 'PATH': self.path, 'SALT': 'test'}):
+            loadtest.run_load(usernames, duration=1.5, think=0.05, seed=2)
+        capture._capture.close()
+        records = replay.load(self.path)
+        self.assertTrue(any(record.get('f') for record in records))
+        self.assertNotIn('load1', open(self.path).read())
+
+        # Replay into a fresh database
+        Message.objects.all().delete()
+        Connection.objects.all().delete()
+        User.objects.all().delete()
+        connection_ids = replay.seed(records, history=3)
+        results = replay.Replay(records, connection_ids, speed=4).run()
+        self.assertEqual(results['total']['errors'], 0)
+        self.assertGreater(results['config']['frames'], 0)
+        self.assertIn('message.send', results['queries'])
+        self.assertEqual(replay.compare(results, results), [])
+
+        fewer = {**results, 'queries': {**results['queries'], 'message.send': results['queries']['message.send'] - 1}}
+        self.assertEqual(len(replay.compare(results, fewer)), 1)
+
+
+class MetricsTests(TransactionTestCase):
+    def setUp(self):
+        search.cache.clear()
+        metrics.reset()
+
+    def test_endpoint_reports_socket_and_view_metrics(self):
+        usernames = loadtest.seed(users=4, friends=1, history=3)
+        loadtest.run_load(usernames, duration=1, think=0.05, seed=3)
+        User.objects.create_user(username='signin', password='secret')
+        self.client.post('/api/signin/', {'username': 'signin', 'password': 'secret'})
+        self.client.post('/api/signin/', {'username': 'signin', 'password': 'wrong'})
+
+        self.assertGreater(metrics.ws_actions.value('chat', 'message.send', 'ok'), 0)
+        self.assertGreater(metrics.ws_action_seconds.count('video', 'call'), 0)
+        self.assertEqual(metrics.ws_sockets.value('chat'), 0)
+        self.assertGreater(metrics.db_queries.value('message.send'), 0)
+        self.assertGreater(metrics.layer_send_seconds.count('group_send_many'), 0)
+        self.assertEqual(metrics.http_requests.value('SignIn', 200), 1)
+        self.assertEqual(metrics.http_requests.value('SignIn', 401), 1)
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.content.decode()
+        self.assertIn('ws_action_seconds_bucket{consumer="chat",action="message.send",le="+Inf"}', body)
+        self.assertIn('db_executor_completed_total{pool="writes"}', body)
+        self.assertIn('http_requests_total{view="SignIn",status="401"} 1', body)
+
+    @override_settings(METRICS={'TOKEN': 'scrape'})
+    def test_endpoint_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scrape')
+        self.assertEqual(response.status_code, 200)
+
+
+class LoggingTests(TransactionTestCase):
+    def test_lines_are_json_without_content(self):
+        stream = io.StringIO()
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(logs.JsonFormatter())
+        logger = logging.getLogger('main.tests.logging')
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+        log = logs.get_logger('main.tests.logging')
+
+        log.info('receive', source='message.send', frame={'text': 'secret words', 'connection_id': 7})
+        line = json.loads(stream.getvalue())
+        self.assertEqual((line['level'], line['msg'], line['source']), ('INFO', 'receive', 'message.send'))
+        self.assertEqual(line['frame'], {'text': '<12 chars>', 'connection_id': 7})
+        self.assertNotIn('secret', stream.getvalue())
+
+    def test_rate_limit_counts_what_it_drops(self):
+        sample = logs.RateLimitFilter(rate=0.001, burst=2)
+        records = [logging.LogRecord('main.frames', logging.DEBUG, '', 0, 'receive', (), None) for _ in range(5)]
+        self.assertEqual([sample.filter(record) for record in records], [True, True, False, False, False])
+        sample._buckets['receive'][0] = 1
+        record = logging.LogRecord('main.frames', logging.DEBUG, '', 0, 'receive', (), None)
+        self.assertTrue(sample.filter(record))
+        self.assertEqual(record.fields['suppressed'], 3)
+
+
+class SocialGraphTests(TransactionTestCase):
+    def setUp(self):
+        graph.clear()
+        payloads.cards.clear()
+        query_counts.reset()
+        query_counts.enabled = True
+        self.alice = User.objects.create_user(username='alice', password='x')
+        self.bob = User.objects.create_user(username='bob', password='x')
+        self.connection = Connection.objects.create(sender=self.alice, receiver=self.bob, accepted=True)
+
+    def tearDown(self):
+        query_counts.enabled = False
+
+    def test_warm_handlers_skip_the_database(self):
+        for _ in range(3):
+            self.assertEqual(asyncio.run(data.typing_connection(self.alice, 'bob')), self.connection.id)
+        # Only the first lookup went to the executor
+        self.assertEqual(query_counts.totals['message.typing'], [1, 1])
+
+        asyncio.run(data.send_message(self.alice, self.connection.id, 'hi', lambda username: False))
+        cold = query_counts.totals['message.send'][1]
+        serialized, other, duplicate = asyncio.run(data.send_message(self.alice, self.connection.id, 'hi', lambda username: False))
+        self.assertEqual(other, 'bob')
+        # No connection lookup, nor sender card, the second time
+        self.assertEqual(query_counts.totals['message.send'][1] - cold, cold - 2)
+
+        # Not a participant
+        carol = User.objects.create_user(username='carol', password='x')
+        self.assertEqual(asyncio.run(data.send_message(carol, self.connection.id, 'hi', lambda username: False)), (None, None, False))
+
+    def test_accepting_a_request_invalidates(self):
+        carol = User.objects.create_user(username='carol', password='x')
+        self.assertIsNone(asyncio.run(data.typing_connection(self.alice, 'carol')))
+        asyncio.run(data.request_connect(carol, 'alice'))
+        request = asyncio.run(data.request_accept(self.alice, 'carol'))
+        self.assertEqual(asyncio.run(data.typing_connection(self.alice, 'carol')), request['id'])
+
+
+class PayloadParityTests(TransactionTestCase):
+    def setUp(self):
+        payloads.cards.clear()
+        self.alice = User.objects.create_user(username='alice', password='x', first_name='Alice', last_name='O\'Hara')
+        self.bob = User.objects.create_user(username='bob', password='x', first_name='Bób "B"')
+        self.carol = User.objects.create_user(username='carol', password='x')
+        User.objects.filter(pk=self.alice.pk).update(thumbnail_hash='ab' * 32)
+        User.objects.filter(pk=self.bob.pk).update(thumbnail='thumbnails/legacy.png')
+        self.connection = Connection.objects.create(sender=self.alice, receiver=self.bob, accepted=True)
+        Connection.objects.create(sender=self.carol, receiver=self.alice, accepted=True)
+        Connection.objects.create(sender=self.bob, receiver=self.carol)
+        for n, sender in enumerate([self.alice, self.bob, self.alice]):
+            message = Message.objects.create(connection=self.connection, sender=sender, text=f'hello {n} ✓', status='sent')
+            Connection.record_message(message)
+        self.alice.refresh_from_db()
+
+    def assertSameJSON(self, drf, fast):
+        self.assertEqual(json.dumps(drf), json.dumps(fast))
+
+    def test_messages(self):
+        messages = Message.objects.filter(connection=self.connection).order_by('-created', '-id')
+        self.assertSameJSON(
+            MessageSerializer(list(messages.select_related('sender')), many=True).data,
+            payloads.messages(list(messages.values_list(*payloads.MESSAGE_COLUMNS)))
+        )
+        message = Message.objects.create(connection=self.connection, sender=self.alice, text='new', status='delivered')
+        self.assertSameJSON(MessageSerializer(message).data, payloads.message(message))
+
+    def test_requests_and_friends(self):
+        connections = Connection.objects.order_by('id')
+        self.assertSameJSON(
+            RequestSerializer(list(connections.select_related('sender', 'receiver')), many=True).data,
+            payloads.requests(connections)
+        )
+        connection = Connection.objects.get(pk=self.connection.pk)
+        self.assertSameJSON(RequestSerializer(connection).data, payloads.request(connection))
+        friends = Connection.objects.filter(accepted=True).order_by('id')
+        for user in (self.alice, self.bob, self.carol):
+            self.assertSameJSON(
+                FriendListSerializer(list(friends.select_related('sender', 'receiver', 'last_message')), context={'user': user}, many=True).data,
+                payloads.friends(friends, user)
+            )
+
+    def test_card_follows_profile_changes(self):
+        self.assertEqual(payloads.cards.get(self.carol.pk)['first_name'], '')
+        self.carol.first_name = 'Carol'
+        self.carol.save(update_fields=['first_name'])
+        self.assertEqual(payloads.cards.get(self.carol.pk)['first_name'], 'Carol')
+
+
+@override_settings(WRITE_BEHIND={'ENABLED': True, 'WINDOW': 0.005, 'MAX_ROWS': 3, 'ID_BLOCK': 4})
+class WriteBehindTests(TransactionTestCase):
+    def setUp(self):
+        graph.clear()
+        payloads.cards.clear()
+        recent_sends.clear()
+        writebehind._writer = None
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.connection = Connection.objects.create(sender=self.alice, receiver=self.bob, accepted=True)
+
+    def tearDown(self):
+        writebehind.get_writer().stop()
+        writebehind._writer = None
+
+    def test_messages_are_announced_then_committed(self):
+        async def run():
+            sent = await asyncio.gather(*(
+                data.send_message(sender, self.connection.id, f'hi {n}', lambda username: False)
+                for n, sender in enumerate([self.alice, self.bob, self.alice, self.alice, self.bob])
+            ))
+            page, _ = await data.list_messages(self.alice, self.connection.id, None, 20, False)
+            return [serialized for serialized, _, _ in sent], page
+        sent, page = asyncio.run(run())
+
+        # Reads wait for the writer, and see what the senders were told
+        self.assertEqual(len({message['id'] for message in sent}), 5)
+        self.assertEqual(sorted(page['messages'], key=lambda m: m['id']), sorted(sent, key=lambda m: m['id']))
+        self.assertGreaterEqual(writebehind.get_writer().batches, 2)
+        connection = Connection.objects.get(pk=self.connection.pk)
+        self.assertEqual((connection.receiver_unread, connection.sender_unread), (3, 2))
+        self.assertEqual(connection.last_message_id, Message.objects.order_by('-created', '-id').first().id)
+        # Ordinary inserts never reuse reserved ids
+        self.assertGreater(Message.objects.create(connection=connection, sender=self.bob, text='x').id, max(message['id'] for message in sent))
+
+    def test_consumers_under_load(self):
+        usernames = loadtest.seed(users=4, friends=1, history=3)
+        results = loadtest.run_load(usernames, duration=1.5, think=0.05, seed=4)
+        self.assertEqual(results['total']['errors'], 0)
+        self.assertGreater(writebehind.get_writer().rows, 0)
+        self.assertEqual(writebehind.get_writer().pending, 0)
+
+    def test_resend_reaching_another_worker_is_dropped(self):
+        async def run():
+            first, _, _ = await data.send_message(self.alice, self.connection.id, 'hi', lambda username: False, 'c1')
+            # As if the resend had gone to a worker that never saw the first
+            recent_sends.clear()
+            await writebehind.get_writer().saved()
+            again, _, duplicate = await data.send_message(self.alice, self.connection.id, 'hi', lambda username: False, 'c1')
+            return first, again, duplicate
+        first, again, duplicate = asyncio.run(run())
+        self.assertTrue(duplicate)
+        self.assertEqual(again, first)
+
+        # Both copies queued before either was committed
+        writer = writebehind.get_writer()
+        copies = [
+            Message(id=writer.ids.take(), connection=self.connection, sender=self.bob, text='yo', created=timezone.now(), client_id='c2')
+            for _ in range(2)
+        ]
+        writer._write(copies + [
+            Message(id=writer.ids.take(), connection=self.connection, sender=self.bob, text='other', created=timezone.now())
+        ])
+        self.assertEqual(list(Message.objects.filter(sender=self.bob).values_list('text', flat=True).order_by('id')), ['yo', 'other'])
+
+    def test_waiting_on_a_dropped_resend_gives_the_first_copy(self):
+        writer = writebehind.get_writer()
+        first, again = [
+            Message(id=writer.ids.take(), connection=self.connection, sender=self.bob, text='yo', created=timezone.now(), client_id='c3')
+            for _ in range(2)
+        ]
+        recent_sends.add((self.connection.id, self.bob.pk, 'c3'), payloads.message(again))
+
+        async def run():
+            # The second copy is the last one queued, which reads wait on
+            writer.add(first)
+            writer.add(again)
+            page, _ = await data.list_messages(self.alice, self.connection.id, None, 20, False)
+            friends = await data.friend_list(self.alice)
+            stored = await data.message_saved(self.bob, payloads.message(again))
+            return page, friends, stored
+        page, friends, stored = asyncio.run(run())
+
+        self.assertEqual([message['id'] for message in page['messages']], [first.id])
+        self.assertEqual(len(friends), 1)
+        self.assertEqual(stored['id'], first.id)
+        # Later resends to this worker are answered with the stored copy
+        self.assertEqual(recent_sends.get((self.connection.id, self.bob.pk, 'c3'))['id'], first.id)
+        self.assertEqual(Connection.objects.get(pk=self.connection.pk).sender_unread, 1)
+
+    def test_history_order_goes_by_created_across_id_blocks(self):
+        writer = writebehind.get_writer()
+        low, high = writer.ids.take(), writer.ids.take()
+        now = timezone.now()
+        # Another worker's block handed out the higher id to the older message
+        late = Message(id=low, connection=self.connection, sender=self.alice, text='late', created=now, status='delivered')
+        early = Message(
+            id=high, connection=self.connection, sender=self.alice, text='early',
+            created=now - timedelta(seconds=1), status='delivered'
+        )
+        writer._write([late])
+        writer._write([early])
+
+        # Stored with the time the clients were sent
+        self.assertEqual(Message.objects.get(pk=early.id).created, early.created)
+        connection = Connection.objects.get(pk=self.connection.pk)
+        self.assertEqual((connection.last_message_id, connection.receiver_unread), (late.id, 2))
+
+        _, count = asyncio.run(data.mark_read_up_to(self.bob, self.connection.id, early.id))
+        self.assertEqual(count, 1)
+        self.assertEqual(Message.objects.get(pk=late.id).status, 'delivered')
+        _, count = asyncio.run(data.mark_read_up_to(self.bob, self.connection.id, late.id))
+        self.assertEqual(count, 1)
+
+    def test_delivered_fallback_flips_exactly_the_rows_read(self):
+        writer = writebehind.get_writer()
+        high = writer.ids.take() + 10
+        messages = [
+            Message.objects.create(id=high, connection=self.connection, sender=self.alice, text='higher id'),
+            Message.objects.create(connection=self.connection, sender=self.alice, text='lower id'),
+        ]
+        with mock.patch.object(db_connection.features, 'can_return_columns_from_insert', False):
+            rows = Message.objects.mark_delivered_for(self.bob)
+        self.assertEqual(sorted(rows), sorted((message.id, 'alice') for message in messages))
+        self.assertEqual(set(Message.objects.values_list('status', flat=True)), {'delivered'})
+
+
+class IdempotentSendTests(TransactionTestCase):
+    def setUp(self):
+        graph.clear()
+        payloads.cards.clear()
+        recent_sends.clear()
+        query_counts.reset()
+        query_counts.enabled = True
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.connection = Connection.objects.create(sender=self.alice, receiver=self.bob, accepted=True)
+
+    def tearDown(self):
+        query_counts.enabled = False
+
+    def send(self, sender, text, client_id):
+        return asyncio.run(data.send_message(sender, self.connection.id, text, lambda username: False, client_id))
+
+    def test_resend_returns_the_first_message(self):
+        first, _, duplicate = self.send(self.alice, 'hi', 'c1')
+        self.assertFalse(duplicate)
+        self.assertEqual(first['client_id'], 'c1')
+        queries = query_counts.totals['message.send'][1]
+        again, other, duplicate = self.send(self.alice, 'hi (edited on retry)', 'c1')
+        self.assertTrue(duplicate)
+        self.assertEqual((again, other), (first, 'bob'))
+        # Answered from the window
+        self.assertEqual(query_counts.totals['message.send'][1], queries)
+
+        # Past the window, the constraint catches it
+        recent_sends.clear()
+        again, _, duplicate = self.send(self.alice, 'hi', 'c1')
+        self.assertTrue(duplicate)
+        self.assertEqual(again['id'], first['id'])
+        self.assertEqual(Message.objects.count(), 1)
+        self.assertEqual(Connection.objects.get(pk=self.connection.pk).receiver_unread, 1)
+
+    def test_client_ids_are_per_sender(self):
+        self.send(self.alice, 'hi', 'c1')
+        _, _, duplicate = self.send(self.bob, 'hi', 'c1')
+        self.assertFalse(duplicate)
+        for client_id in (None, None, '', 'x' * 65, 7):
+            self.assertFalse(self.send(self.alice, 'hi', client_id)[2])
+        self.assertEqual(Message.objects.count(), 7)
+        self.assertEqual(Message.objects.filter(client_id__isnull=False).count(), 2)
+
+
+class SyncTests(TransactionTestCase):
+    def setUp(self):
+        graph.clear()
+        payloads.cards.clear()
+        recent_sends.clear()
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.carol = User.objects.create(username='carol')
+        self.connection = Connection.objects.create(sender=self.alice, receiver=self.bob, accepted=True)
+        self.other = Connection.objects.create(sender=self.alice, receiver=self.carol, accepted=True)
+
+    def send(self, sender, connection, text):
+        serialized, _, _ = asyncio.run(data.send_message(sender, connection.id, text, lambda username: False))
+        return serialized
+
+    def sync(self, user, cursor, limit=sync.CHUNK):
+        return asyncio.run(data.sync(user, cursor, limit))
+
+    def test_changes_since_cursor(self):
+        start = self.sync(self.bob, None)
+        self.assertEqual((start['messages'], start['more']), ([], False))
+        cursor = start['cursor']
+
+        first = self.send(self.alice, self.connection, 'one')
+        self.send(self.alice, self.other, 'not for bob')
+        asyncio.run(data.mark_read_up_to(self.bob, self.connection.id, first['id']))
+        self.alice.first_name = 'Alice'
+        self.alice.save()
+        dave = User.objects.create(username='dave')
+        asyncio.run(data.request_connect(dave, 'bob'))
+
+        frame = self.sync(self.bob, cursor)
+        self.assertFalse(frame['more'] or frame['reset'])
+        # The message once, as it is now
+        self.assertEqual([(m['text'], m['status']) for m in frame['messages']], [('one', 'read')])
+        self.assertEqual([p['first_name'] for p in frame['profiles']], ['Alice'])
+        self.assertEqual([(r['sender']['username'], r['accepted']) for r in frame['requests']], [('dave', False)])
+        # Nothing new since
+        again = self.sync(self.bob, frame['cursor'])
+        self.assertEqual((again['cursor'], again['messages'], again['requests'], again['profiles']), (frame['cursor'], [], [], []))
+        # Carol hears about her own conversation only
+        self.assertEqual([m['text'] for m in self.sync(self.carol, cursor)['messages']], ['not for bob'])
+
+    def test_chunks_and_reset(self):
+        cursor = self.sync(self.bob, None)['cursor']
+        sent = [self.send(self.alice, self.connection, f'hi {n}')['id'] for n in range(5)]
+        seen = []
+        chunks = 0
+        while True:
+            frame = self.sync(self.bob, cursor, limit=2)
+            seen += [m['id'] for m in frame['messages']]
+            cursor = frame['cursor']
+            chunks += 1
+            if not frame['more']:
+                break
+        self.assertEqual((seen, chunks), (sent, 3))
+
+        self.assertGreater(sync.prune(retain=2), 0)
+        self.assertEqual(Change.objects.count(), 2)
+        self.assertTrue(self.sync(self.bob, 0)['reset'])
+        self.assertTrue(self.sync(self.bob, sync.head() + 10)['reset'])
+        self.assertFalse(self.sync(self.bob, sync.head() - 2)['reset'])
+
+    def test_check_reports_triggers_dropped_by_a_table_rebuild(self):
+        self.assertEqual(sync.missing_triggers(), [])
+        self.assertEqual(checks.change_log_triggers(None, databases=['default']), [])
+        with transaction.atomic():
+            # What a migration rebuilding main_message leaves behind
+            with db_connection.cursor() as cursor:
+                cursor.execute('DROP TRIGGER change_message_status')
+            errors = checks.change_log_triggers(None, databases=['default'])
+            transaction.set_rollback(True)
+        self.assertEqual([error.id for error in errors], ['main.E001'])
+        self.assertIn('change_message_status', errors[0].msg)
+        self.assertEqual(sync.missing_triggers(), [])
@@ -0,0 +1,139 @@
+"""
+Profile thumbnail pipeline.
+
+Uploads are streamed to a temporary file, hashed, and resized into a fixed
+set of square variants by a process pool so decoding never runs on the event
+loop or holds the GIL of the serving process. Variants are stored by content
+hash under thumbnails/<hash[:2]>/<hash>/<size>.<ext>, so re-uploading the
+same image (or two users picking the same one) reuses the files on disk.
+
+UploadLimitHandler goes in front of the temporary file handler for uploads:
+a body declared larger than MAX_UPLOAD is refused before any of it is
+parsed, and one that grows past it stops being copied. Under ASGI the HTTP
+server has buffered the request by then, so cap the body at the proxy too.
+"""
+import base64
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.files.uploadhandler import FileUploadHandler
+
+_config = getattr(settings, 'THUMBNAILS', {})
+SIZES = tuple(_config.get('SIZES', (64, 128, 512)))
+FORMAT = _config.get('FORMAT', 'WEBP')
+WORKERS = _config.get('WORKERS', 2)
+MAX_UPLOAD = _config.get('MAX_UPLOAD', 10 * 1024 * 1024)
+# Variant sent wherever users are listed, and for a user's own profile
+LIST_SIZE = _config.get('LIST_SIZE', 128)
+PROFILE_SIZE = _config.get('PROFILE_SIZE', 512)
+EXTENSIONS = {'WEBP': 'webp', 'JPEG': 'jpg', 'PNG': 'png'}
+
+
+class InvalidImage(Exception):
+    pass
+
+
+class TooLarge(InvalidImage):
+    def __init__(self):
+        super().__init__('Image is too large')
+
+
+class UploadLimitHandler(FileUploadHandler):
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        if content_length > MAX_UPLOAD:
+            raise TooLarge()
+
+    def receive_data_chunk(self, raw_data, start):
+        # Without a Content-Length, or with a wrong one
+        if start + len(raw_data) > MAX_UPLOAD:
+            raise TooLarge()
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
+
+
+def variant_name(digest, size):
+    return f'thumbnails/{digest[:2]}/{digest}/{size}.{EXTENSIONS[FORMAT]}'
+
+
+def variant_url(user, size):
+    return url_for(user.thumbnail_hash, user.thumbnail.name, size)
+
+
+def url_for(digest, name, size):
+    # variant_url from the two stored columns, for .values() rows
+    if digest:
+        return default_storage.url(variant_name(digest, size))
+    # Thumbnails uploaded before variants existed
+    if name:
+        return default_storage.url(name)
+    return None
+
+
+def render_variants(source_path, targets, image_format):
+    # Runs in a worker process: decode once, write one square crop per size
+    from PIL import Image, ImageOps
+
+    with Image.open(source_path) as image:
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGBA' if image_format == 'PNG' else 'RGB')
+        for size, path in targets:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            variant = ImageOps.fit(image, (size, size), Image.LANCZOS)
+            partial = f'{path}.part'
+            variant.save(partial, image_format, quality=85)
+            os.replace(partial, path)
+
+
+_pool = None
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=WORKERS)
+    return _pool
+
+
+def file_digest(fileobj):
+    digest = hashlib.sha256()
+    for chunk in fileobj.chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def store_thumbnail(user, uploaded):
+    """
+    Make `uploaded` (a Django File on disk) the user's thumbnail. Blocks the
+    calling thread while the pool renders variants, so call it from a view
+    or a DB executor thread.
+    """
+    if uploaded.size > MAX_UPLOAD:
+        raise TooLarge()
+    digest = file_digest(uploaded)
+    targets = [(size, default_storage.path(variant_name(digest, size))) for size in SIZES]
+    if not all(os.path.exists(path) for _, path in targets):
+        try:
+            get_pool().submit(render_variants, uploaded.temporary_file_path(), targets, FORMAT).result()
+        except Exception:
+            raise InvalidImage('Could not read image')
+    user.thumbnail_hash = digest
+    user.thumbnail.name = variant_name(digest, max(SIZES))
+    user.save(update_fields=['thumbnail', 'thumbnail_hash'])
+    return user
+
+
+def store_base64_thumbnail(user, image_str):
+    # Legacy WebSocket upload: spool the decoded bytes to disk and run the same pipeline
+    from django.core.files.uploadedfile import TemporaryUploadedFile
+
+    raw = base64.b64decode(image_str)
+    with TemporaryUploadedFile('thumbnail', 'application/octet-stream', len(raw), None) as uploaded:
+        uploaded.write(raw)
+        uploaded.flush()
+        uploaded.seek(0)
+        return store_thumbnail(user, uploaded)
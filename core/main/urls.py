@@ -1,5 +1,5 @@
 from django.urls import path
-from .views import SignIn, SignUP
+from .views import SignIn, SignUP, ThumbnailUpload
 from django.urls import include
 from django.conf import settings
 from django.conf.urls.static import static
@@ -8,6 +8,7 @@ from django.conf.urls.static import static
 urlpatterns = [
     path('signin/', SignIn.as_view(), name='signin'),
     path('signup/', SignUP.as_view(), name='signup'),
+    path('thumbnail/', ThumbnailUpload.as_view(), name='thumbnail'),
 ]
 
 if settings.DEBUG:
@@ -1,11 +1,21 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from django.contrib.auth import authenticate
-from rest_framework.permissions import AllowAny
-from .serializer import UserSerializer
+from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import DataAndFiles, MultiPartParser
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.http.multipartparser import MultiPartParser as DjangoMultiPartParser, MultiPartParserError
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from .serializer import ProfileSerializer
+from . import thumbnails
 from rest_framework_simplejwt.tokens import RefreshToken
 from .serializer import SignUPSerializer
 from .models import User
+from django.conf import settings
+from django.http import HttpResponse
+from . import metrics
 
 
 # Create your views here.
@@ -13,7 +23,7 @@ def get_authenticated_user_data(user):
     tokens = RefreshToken.for_user(user)
 
     return {
-        'user': UserSerializer(user).data,
+        'user': ProfileSerializer(user).data,
         'tokens': {
             'access': str(tokens.access_token),
             'refresh': str(tokens),
@@ -22,7 +32,7 @@ def get_authenticated_user_data(user):
     
 
 
-class SignIn(APIView):
+class SignIn(metrics.TimedViewMixin, APIView):
     permission_classes = [AllowAny]
     def post(self, request):
         username = request.data.get('username')
@@ -35,7 +45,7 @@ class SignIn(APIView):
         user_data = get_authenticated_user_data(user)
         return Response(user_data, status=200)
     
-class SignUP(APIView):
+class SignUP(metrics.TimedViewMixin, APIView):
     permission_classes = [AllowAny]
     def post(self, request):
         new_user = SignUPSerializer(data=request.data)
@@ -44,4 +54,50 @@ class SignUP(APIView):
 
         user_data = get_authenticated_user_data(user)
 
-        return Response(user_data, status=201)
\ No newline at end of file
+        return Response(user_data, status=201)
+
+
+class ThumbnailParser(MultiPartParser):
+    # Streams the file to a temp file, never memory, and stops past THUMBNAILS['MAX_UPLOAD']
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        request = parser_context['request']
+        meta = request.META.copy()
+        meta['CONTENT_TYPE'] = media_type
+        handlers = [thumbnails.UploadLimitHandler(request), TemporaryFileUploadHandler(request)]
+        try:
+            parser = DjangoMultiPartParser(meta, stream, handlers, parser_context.get('encoding', settings.DEFAULT_CHARSET))
+            return DataAndFiles(*parser.parse())
+        except MultiPartParserError as e:
+            raise ParseError(f'Multipart form parse error - {e}')
+
+
+class ThumbnailUpload(metrics.TimedViewMixin, APIView):
+    permission_classes = [IsAuthenticated]
+    parser_classes = [ThumbnailParser]
+
+    def post(self, request):
+        try:
+            image = request.FILES.get('file')
+            if not image:
+                return Response({'error': 'file is required'}, status=400)
+            user = thumbnails.store_thumbnail(request.user, image)
+        except thumbnails.TooLarge as e:
+            return Response({'error': str(e)}, status=413)
+        except thumbnails.InvalidImage as e:
+            return Response({'error': str(e)}, status=400)
+        data = ProfileSerializer(user).data
+        # Let the user's open sockets pick up the new thumbnail
+        async_to_sync(get_channel_layer().group_send)(
+            user.username,
+            {'type': 'broadcast_group', 'source': 'thumbnail', 'data': data}
+        )
+        return Response(data, status=200)
+
+
+def metrics_view(request):
+    # Prometheus scrape endpoint, see main/metrics.py
+    token = getattr(settings, 'METRICS', {}).get('TOKEN')
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return HttpResponse(status=401)
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,303 @@
+"""
+Write-behind persistence for message.send.
+
+With WRITE_BEHIND['ENABLED'] set, a sent message gets its id from a block
+reserved ahead of time and is fanned out straight away. A writer thread then
+inserts queued messages in one transaction every WINDOW seconds, or as soon
+as MAX_ROWS are waiting, and updates each conversation's preview and unread
+counter once per batch. The sender hears `message.saved` once the
+transaction has committed:
+
+    WRITE_BEHIND = {
+        'ENABLED': True,
+        'WINDOW': 0.005,     # at most this long in memory before a commit starts
+        'MAX_ROWS': 200,
+        'MAX_PENDING': 5000, # past this, senders wait for the commit
+        'ID_BLOCK': 1000,
+    }
+
+A crash loses at most the messages of the window being written. A batch
+that breaks message_unique_client_id (a resend that reached another worker
+while the first copy was still queued, see main/dedup.py) is written again
+row by row and the duplicates are dropped; waiting for a dropped one gives
+the id of the stored first copy, which the sender is told instead. Reads of
+messages (message.list, message.read, reconnect receipts, friend.list
+previews) first wait for whatever is queued, so nobody reads around the
+writer.
+
+Ids are reserved by bumping the table's AUTOINCREMENT counter in
+sqlite_sequence, so ordinary inserts, in this worker or any other, never
+reuse them. That needs SQLite, which is what this project runs on. Each
+worker takes from its own block, so a higher id is not a newer message:
+order messages by (created, id), as history does.
+"""
+import asyncio
+import atexit
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+
+from . import logs
+from .models import Connection, Message
+
+log = logs.get_logger(__name__)
+
+# Dropped duplicates remembered for saved() calls that come after the write
+REPLACED_KEPT = 1000
+
+
+class IdBlocks:
+    """
+    Hands out message ids from blocks of `size` reserved in sqlite_sequence.
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self._next = 0
+        self._end = 0
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        table = Message._meta.db_table
+        with transaction.atomic(), connection.cursor() as cursor:
+            # The row only exists once something was inserted
+            cursor.execute(
+                f"INSERT INTO sqlite_sequence (name, seq) SELECT %s, COALESCE(MAX(id), 0) FROM {table} "
+                "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = %s)",
+                [table, table]
+            )
+            cursor.execute('UPDATE sqlite_sequence SET seq = seq + %s WHERE name = %s', [self.size, table])
+            cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = %s', [table])
+            end = cursor.fetchone()[0]
+        return end - self.size + 1, end + 1
+
+    def take(self):
+        # Runs on a DB executor thread: the odd call reserves a new block
+        with self._lock:
+            if self._next >= self._end:
+                self._next, self._end = self._reserve()
+            message_id = self._next
+            self._next += 1
+            return message_id
+
+
+class MessageWriter:
+    def __init__(self, window=0.005, max_rows=200, max_pending=5000, id_block=1000):
+        if connection.vendor != 'sqlite':
+            raise ImproperlyConfigured('WRITE_BEHIND needs SQLite')
+        self.window = window
+        self.max_rows = max_rows
+        self.max_pending = max_pending
+        self.ids = IdBlocks(id_block)
+        self._queue = queue.Queue()
+        # message id -> futures waiting for it to be saved
+        self._waiters = {}
+        self._queued = set()
+        # dropped duplicate id -> id of the stored first copy, the most recent few
+        self._replaced = OrderedDict()
+        self._last_added = None
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.batches = 0
+        self.rows = 0
+        self._thread = threading.Thread(target=self._run, name='message-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def add(self, message):
+        # Queue a Message with its id and created set; from any thread
+        with self._lock:
+            self.pending += 1
+            self._queued.add(message.id)
+            self._last_added = message.id
+            self._queue.put(message)
+
+    def busy(self):
+        return self.pending >= self.max_pending
+
+    async def saved(self, message_id=None):
+        """
+        Wait until message `message_id` is committed and return the id it is
+        stored under: its own, or the first copy's for a dropped duplicate.
+        Raises what the write failed with. Without an id, waits until
+        everything queued so far is written or has failed, and never raises.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            everything = message_id is None
+            if everything:
+                # Batches commit in queue order, so the last one queued is the last to land
+                message_id = self._last_added
+            if message_id not in self._queued:
+                return self._replaced.get(message_id, message_id)
+            self._waiters.setdefault(message_id, []).append((loop, future, everything))
+        return await future
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                break
+            batch = [first]
+            deadline = time.monotonic() + self.window
+            stop = False
+            while len(batch) < self.max_rows:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    message = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if message is None:
+                    stop = True
+                    break
+                batch.append(message)
+            self._write(batch)
+            if stop:
+                break
+        connection.close()
+
+    def _write(self, batch):
+        # message id -> the error it failed with
+        errors = {}
+        # message id -> id of the first copy, for dropped duplicates
+        replaced = {}
+        try:
+            with transaction.atomic():
+                # With the id and created the clients were already sent
+                Message.objects.bulk_create(batch)
+                record_batch(batch)
+        except IntegrityError:
+            # A resend that reached two workers: keep the rest of the batch
+            try:
+                errors, replaced = self._write_each(batch)
+            except Exception as e:
+                log.exception('message batch failed', rows=len(batch))
+                errors = {message.id: e for message in batch}
+        except Exception as e:
+            log.exception('message batch failed', rows=len(batch))
+            errors = {message.id: e for message in batch}
+        with self._lock:
+            self.pending -= len(batch)
+            self.batches += 1
+            self.rows += len(batch) - len(errors) - len(replaced)
+            self._queued.difference_update(message.id for message in batch)
+            self._replaced.update(replaced)
+            while len(self._replaced) > REPLACED_KEPT:
+                self._replaced.popitem(last=False)
+            waiters = [
+                (loop, future, replaced.get(message.id, message.id), None if everything else errors.get(message.id))
+                for message in batch for loop, future, everything in self._waiters.pop(message.id, ())
+            ]
+        for loop, future, message_id, error in waiters:
+            loop.call_soon_threadsafe(_resolve, future, message_id, error)
+
+    def _write_each(self, batch):
+        errors = {}
+        replaced = {}
+        written = []
+        with transaction.atomic():
+            for message in batch:
+                try:
+                    with transaction.atomic():
+                        Message.objects.bulk_create([message])
+                except IntegrityError as e:
+                    first = None
+                    if message.client_id is not None:
+                        first = Message.objects.filter(
+                            connection_id=message.connection_id, sender_id=message.sender_id, client_id=message.client_id
+                        ).values_list('id', flat=True).first()
+                    if first is None:
+                        log.warning('message not written', message_id=message.id, connection_id=message.connection_id)
+                        errors[message.id] = e
+                    else:
+                        log.warning('duplicate message dropped', message_id=message.id, first_id=first)
+                        replaced[message.id] = first
+                else:
+                    written.append(message)
+            if written:
+                record_batch(written)
+        return errors, replaced
+
+    def stop(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+
+def _resolve(future, message_id, error):
+    if future.done():
+        return
+    if error is None:
+        future.set_result(message_id)
+    else:
+        future.set_exception(error)
+
+
+def record_batch(messages):
+    """
+    Connection.record_message for a batch: one UPDATE per conversation with
+    the recipients' unread counters bumped, and the newest message as preview
+    unless the conversation already shows a newer one. Ids come from each
+    worker's own block, so "newest" goes by (created, id) as history does.
+    """
+    by_connection = {}
+    for message in messages:
+        by_connection.setdefault(message.connection_id, []).append(message)
+    shown = {
+        connection_id: (created, message_id)
+        for connection_id, created, message_id in Connection.objects.filter(
+            pk__in=by_connection, last_message__isnull=False
+        ).values_list('pk', 'last_message__created', 'last_message_id')
+    }
+    for connection_id, group in by_connection.items():
+        sender_id = group[0].connection.sender_id
+        to_receiver = sum(1 for message in group if message.sender_id == sender_id)
+        newest = max(group, key=lambda message: (message.created, message.id))
+        preview = {}
+        if connection_id not in shown or (newest.created, newest.id) > shown[connection_id]:
+            preview['last_message'] = newest
+        Connection.objects.filter(pk=connection_id).update(
+            receiver_unread=F('receiver_unread') + to_receiver,
+            sender_unread=F('sender_unread') + (len(group) - to_receiver),
+            **preview
+        )
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """
+    The process-wide MessageWriter, or None when write-behind is off.
+    """
+    global _writer
+    config = getattr(settings, 'WRITE_BEHIND', {})
+    if not config.get('ENABLED'):
+        return None
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = MessageWriter(
+                    window=config.get('WINDOW', 0.005),
+                    max_rows=config.get('MAX_ROWS', 200),
+                    max_pending=config.get('MAX_PENDING', 5000),
+                    id_block=config.get('ID_BLOCK', 1000),
+                )
+    return _writer
+
+
+async def settled():
+    # Reads of messages call this first so they see everything sent before them
+    writer = get_writer()
+    if writer is not None and writer.pending:
+        await writer.saved()